@@ -0,0 +1,742 @@
+#!/usr/bin/python
+
+"""
+BatchJPEGDownloader, Copyright (c) 2016 Oliver Meister (o.meister@gmx.net)
+
+This file contains the asyncio backend of BatchJPEGDownloader. It downloads many files 
+concurrently on a single thread, which allows thousands of requests to be in flight at once.
+
+The backend is kept in a separate module, as it requires Python 3.6 or higher, 
+while batchjpegdownloader.py still runs on Python 2.7.
+It is loaded by batchjpegdownloader.py when the asyncio engine is selected on the command line.
+"""
+
+import asyncio
+
+from batchjpegdownloader import BatchDownloader, DownloadResult, DownloadStatistics, FileTransfer, ListFileURLGenerator
+
+class AsyncListFileURLGenerator(ListFileURLGenerator):
+    """
+    Read a list of URLs from a file and iterate over the URLs asynchronously.
+
+    This class supports both the synchronous iteration of ListFileURLGenerator and
+    iteration with `async for`, so it may be passed to either downloader.
+    """
+
+    def __aiter__(self):
+        """Return an asynchronous iterator over the URLs of the list file."""
+        return _AsyncIteratorAdapter(iter(self))
+
+class _AsyncIteratorAdapter:
+    """Wrap a synchronous iterator into an asynchronous iterator."""
+
+    def __init__(self, iterator):
+        """Store the synchronous iterator."""
+        self.iterator = iterator
+
+    def __aiter__(self):
+        """The adapter is its own asynchronous iterator."""
+        return self
+
+    async def __anext__(self):
+        """Return the next element of the wrapped iterator."""
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+class AsyncBatchDownloader(BatchDownloader):
+    """
+    Download files from a list of URLs with asyncio.
+
+    This class is a drop-in replacement for BatchDownloader for HTTP and HTTPS URLs. Other schemes, such as FTP, 
+    which the thread engine downloads with urllib, fail with an IO Error. The number of workers limits the number of 
+    downloads that are in flight at the same time, and `host_limit` additionally limits the number
+    of concurrent downloads from each host. Connections are kept alive and reused for later requests to the same host.
+    The event loop only waits for the network: files, the journal, the digests and the hooks are handled in the 
+    default executor of the loop.
+
+    Attributes:
+        host_limit (int): Maximum number of concurrent downloads per host. None means no limit apart from the number of workers.
+        timeout (float): Time in seconds after which a connection attempt or a read that receives no data fails.
+        idle_connections (dict): Idle connections as lists of _Connection objects by (scheme, host, port), 
+            the most recently released last.
+    """
+
+    # Redirects are followed up to this depth.
+    max_redirects = 10
+
+    def __init__(self, download_directory, workers = 100, host_limit = None, timeout = None, **options):
+        """
+        Initialize an asyncio batch downloader for a list of files.
+
+        Args:
+            download_directory (str): Target directory for the downloaded files.
+            workers (int): Maximum number of downloads that are in flight at the same time.
+            host_limit (int): Maximum number of concurrent downloads per host.
+            timeout (float): Time in seconds after which a connection attempt or a read that receives no data fails.
+                Defaults to the socket timeout of the connection pool of the thread engine, which is 60 seconds by default.
+            options: Further keyword arguments of BatchDownloader, such as `default_overwrite`, `buffer_size` or `resume`.
+                The `queue_size` is unused, as URLs are read from the iterable only when a download slot is free.
+
+        Example:
+            downloader = AsyncBatchDownloader(download_directory = "downloads", workers = 1000, host_limit = 16)
+
+        Raises:
+            ValueError: If the number of workers, the host limit or the buffer size is smaller than 1.
+        """
+
+        BatchDownloader.__init__(self, download_directory, workers = workers, host_limit = host_limit, **options)
+
+        self.timeout = timeout if timeout is not None else self.connection_pool.timeout
+        self.idle_connections = {}
+
+    def run(self, urls, statistics = None, cancelled = None):
+        """
+        Download a set of files from the given URLs without printing a summary.
+
+        This method runs a new event loop until all files are downloaded, which is also used by download() and results(). 
+        Use download_async() to download files from a running event loop.
+
+        Args:
+            urls (iterable): an iterable or asynchronous iterable list of URLs.
+            statistics (DownloadStatistics): Counters that are updated during the download. By default, new counters are created.
+            cancelled (threading.Event): If given and set, no further URLs are read.
+
+        Returns:
+            DownloadStatistics: Number of downloaded, skipped and failed files.
+
+        Raises:
+            TypeError: if `urls` is not an iterable object or the entries of `urls` are not of type string.
+            IOError: If a file download fails and `keep_going` is not set.
+        """
+
+        loop = asyncio.new_event_loop()
+
+        try:
+            return loop.run_until_complete(self.run_async(urls, statistics, cancelled))
+        finally:
+            loop.close()
+
+    async def download_async(self, urls):
+        """
+        Download a set of files from the given URLs to the local folder defined in the download_directory attribute.
+
+        URLs are read from `urls` only when a download slot is free. Unless `keep_going` is set, the first failed download
+        stops reading further URLs and is raised once the downloads that are already in flight have finished. 
+        A summary is printed at the end.
+
+        Args:
+            urls (iterable): an iterable or asynchronous iterable list of URLs.
+
+        Returns:
+            DownloadStatistics: Number of downloaded, skipped and failed files.
+
+        Raises:
+            TypeError: if `urls` is not an iterable object or the entries of `urls` are not of type string.
+            IOError: If a file download fails and `keep_going` is not set.
+        """
+
+        statistics = await self.run_async(urls)
+
+        print(self.summary(statistics))
+
+        return statistics
+
+    async def run_async(self, urls, statistics = None, cancelled = None):
+        """
+        Download a set of files from the given URLs on the running event loop without printing a summary.
+
+        Args:
+            urls (iterable): an iterable or asynchronous iterable list of URLs.
+            statistics (DownloadStatistics): Counters that are updated during the download. By default, new counters are created.
+            cancelled (threading.Event): If given and set, no further URLs are read.
+
+        Returns:
+            DownloadStatistics: Number of downloaded, skipped and failed files.
+
+        Raises:
+            TypeError: if `urls` is not an iterable object or the entries of `urls` are not of type string.
+            IOError: If a file download fails and `keep_going` is not set.
+        """
+
+        # Accept both asynchronous and synchronous iterables and throw a Type Error otherwise.
+
+        if hasattr(urls, "__aiter__"):
+            iterator = urls.__aiter__()
+        else:
+            try:
+                iterator = _AsyncIteratorAdapter(iter(urls))
+            except TypeError:
+                print("Error: " + repr(urls) + " object is not iterable.")
+                raise
+
+        if statistics is None:
+            statistics = DownloadStatistics()
+
+        slots = asyncio.Semaphore(self.workers)
+        host_slots = {}
+        errors = []
+        tasks = set()
+
+        async def download_task(url, filename):
+            # Files with the same name are downloaded one after another. The lock of a file is dropped with its last download.
+            entry = self.filename_locks.setdefault(filename, [asyncio.Lock(), 0])
+            entry[1] += 1
+
+            try:
+                async with entry[0]:
+                    if self.host_limit is None:
+                        statistics.add(await self.download_file_async(url, filename))
+                    else:
+                        host = _host_key(url)
+
+                        async with host_slots.setdefault(host, asyncio.Semaphore(self.host_limit)):
+                            statistics.add(await self.download_file_async(url, filename))
+            except Exception as e:
+                statistics.add("failed")
+
+                # Errors other than IOError are unexpected and stop the download even if `keep_going` is set.
+                if not self.keep_going or not isinstance(e, (IOError, asyncio.TimeoutError)):
+                    errors.append(e)
+            finally:
+                entry[1] -= 1
+
+                if entry[1] == 0:
+                    del self.filename_locks[filename]
+
+                slots.release()
+
+        # Repeated URLs are dropped before any request is sent.
+        seen = set() if self.deduplication_index is not None else None
+
+        self.start_hooks(urls)
+
+        try:
+            async for url in iterator:
+                if seen is not None:
+                    if url in seen:
+                        statistics.add("duplicate")
+                        self.notify(DownloadResult(url, status = "duplicate"))
+                        continue
+
+                    seen.add(url)
+
+                # Wait for a free slot before reading the next URL.
+                await slots.acquire()
+
+                if errors or (cancelled is not None and cancelled.is_set()):
+                    slots.release()
+                    break
+
+                try:
+                    filename = self.local_filename(url)
+                except TypeError:
+                    slots.release()
+                    raise
+
+                task = asyncio.ensure_future(download_task(url, filename))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            # Wait until all downloads in flight are done.
+            if tasks:
+                await asyncio.wait(list(tasks))
+
+            self.finish_hooks()
+
+            if self.thumbnails is not None:
+                await self.in_thread(self.thumbnails.wait)
+
+            # The connections belong to the event loop, which may be closed after the download.
+            for idle in self.idle_connections.values():
+                for connection in idle:
+                    connection.writer.close()
+
+            self.idle_connections = {}
+
+        if errors:
+            raise errors[0]
+
+        return statistics
+
+    async def download_file_async(self, url, filename):
+        """
+        Download a single file from the given URL to the local system.
+
+        The skip and overwrite rules are the same as in BatchDownloader.download_file().
+
+        Args:
+            url (str): URL to the source
+            filename (str): Local path where the file is stored.
+
+        Returns:
+            str: "downloaded" if the file has been downloaded, "skipped" if it already existed 
+                or "not_modified" if it has not changed on the server in refresh mode.
+
+        Raises:
+            IOError: If the file download fails (for example when the URL does not point to a file).
+        """
+
+        import time
+        from sys import stdout
+
+        result = DownloadResult(url, filename)
+
+        if await self.in_thread(self.skip, url, filename):
+            result.status = "skipped"
+            result.duration = time.time() - result.started
+            await self.in_thread(self.notify, result)
+            return "skipped"
+
+        try:
+            await self.in_thread(self.create_parent_directory, filename)
+            result.status = await self.fetch_with_retries_async(url, filename, result)
+
+            if self.existing_files is not None:
+                self.existing_files.add(filename)
+        except Exception as e:
+            result.status = "failed"
+            result.error = str(e) or type(e).__name__
+            raise
+        finally:
+            result.duration = time.time() - result.started
+
+            if self.verbose:
+                stdout.write("Downloading " + repr(url) + " to " + repr(filename) + "..." + self.result_message(result) + "\n")
+
+            # Hooks may write files or wait for a consumer of the results, which must not block the event loop.
+            await self.in_thread(self.notify, result)
+
+        return result.status
+
+    async def fetch_with_retries_async(self, url, filename, result):
+        """
+        Download `url` to `filename` and repeat the download after temporary failures as defined by the retry policy.
+
+        This is the asynchronous counterpart of BatchDownloader.fetch_with_retries(), which waits without blocking the event loop.
+
+        Raises:
+            IOError: If the last attempt fails, the error is not retryable or the circuit of the host is open.
+        """
+
+        while True:
+            self.check_circuit(url)
+            result.attempts += 1
+
+            try:
+                status = await self.fetch(url, filename, result)
+            except (IOError, asyncio.TimeoutError) as e:
+                self.record_attempt(url, e)
+                delay = self.retry_policy.delay(result.attempts, e)
+
+                if delay is None:
+                    raise
+
+                await asyncio.sleep(delay)
+            else:
+                self.record_attempt(url, None)
+
+                return status
+
+    async def fetch(self, url, filename, result = None):
+        """
+        Request `url` with HTTP/1.1 and write the response body to `filename`.
+
+        Redirects are followed up to `max_redirects` times. The body is handled by a FileTransfer,
+        exactly as in BatchDownloader.fetch(), whose file operations run in the default executor of the event loop.
+        If `result` is given, it receives the size and the timing of the download.
+
+        Returns:
+            str: "downloaded", or "not_modified" if the file has not changed since the last download in refresh mode.
+
+        Raises:
+            IOError: If the connection fails, the URL is not an HTTP(S) URL or the server answers with an error status.
+        """
+
+        import time
+        from urllib.parse import urljoin
+
+        if result is None:
+            result = DownloadResult(url, filename)
+
+        # Only the last attempt of a retried download is measured.
+        result.size = 0
+        result.dns_time = result.connect_time = None
+
+        throttle = self.throttle
+
+        if throttle is not None:
+            host = throttle.host(url)
+            await asyncio.sleep(throttle.request_delay(host))
+
+        self.metrics.record_request()
+
+        transfer = FileTransfer(self, url, filename)
+
+        try:
+            # Wait until the admission control lets the transfer open a file, without blocking the event loop.
+            delay = transfer.admit()
+
+            while delay is not None:
+                await asyncio.sleep(delay)
+                delay = transfer.admit()
+
+            result.admission_time = transfer.admission_time
+            requested = time.time()
+
+            for _ in range(self.max_redirects + 1):
+                connection, status, reason, headers = await self.request(url, transfer.request_headers, result)
+
+                # The connection is only reused if the body has been read completely.
+                complete = status in (204, 304)
+
+                try:
+                    if status in (301, 302, 303, 307, 308) and "location" in headers:
+                        url = urljoin(url, headers["location"])
+                        continue
+
+                    # The connection times are measured by request(), the remaining time is spent waiting for the response.
+                    received = time.time()
+                    result.first_byte_time = received - requested - (result.dns_time or 0.0) - (result.connect_time or 0.0)
+
+                    if await self.in_thread(transfer.start, status, reason, headers):
+                        async for block in self.read_body(connection.reader, headers):
+                            result.size += len(block)
+                            await self.in_thread(transfer.write, block)
+
+                            if throttle is not None:
+                                delay = throttle.transfer_delay(host, len(block))
+
+                                if delay > 0:
+                                    await asyncio.sleep(delay)
+
+                        complete = "content-length" in headers or headers.get("transfer-encoding", "").lower() == "chunked"
+
+                    status = await self.in_thread(transfer.finish)
+                    result.transfer_time = time.time() - received
+                    result.file_size = transfer.size
+                    result.sha256 = transfer.digest
+
+                    return status
+                finally:
+                    self.release_connection(connection, complete)
+
+            raise IOError("Too many redirects for " + repr(url) + ".")
+        except Exception:
+            await self.in_thread(transfer.abort)
+            raise
+        except BaseException:
+            # The download is cancelled, so the file is closed at once instead of waiting for the executor.
+            transfer.abort()
+            raise
+
+    async def request(self, url, headers = None, result = None):
+        """
+        Send a GET request with the additional `headers` to the host of `url` and read the response header.
+
+        An idle connection to the host is reused if there is one. If the server has closed it in the meantime,
+        the request is sent again over a new connection. If `result` is given, the times for the name resolution 
+        and the connection setup of a new connection are added to it.
+
+        Returns:
+            tuple: The _Connection, the status code, the reason phrase and a dictionary of lower-case header names.
+                The connection must be passed to release_connection() once the response has been handled.
+
+        Raises:
+            IOError: If the connection fails or times out, the URL is not a valid HTTP(S) URL or the status line is malformed.
+        """
+
+        from urllib.parse import urlsplit
+
+        # Malformed URLs, for example with a port that is not a number, fail like unreachable hosts.
+        try:
+            parts = urlsplit(url)
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+        except ValueError as e:
+            raise IOError("Invalid URL " + repr(url) + ": " + str(e))
+
+        if parts.scheme not in ("http", "https"):
+            raise IOError("The asyncio engine only downloads HTTP and HTTPS URLs, use the thread engine for " + repr(url) + ".")
+
+        if not parts.hostname:
+            raise IOError("Invalid URL " + repr(url) + ": no host name.")
+
+        path = parts.path or "/"
+
+        if parts.query:
+            path += "?" + parts.query
+
+        # Without a Connection header, HTTP/1.1 keeps the connection open for further requests.
+        request = "GET " + path + " HTTP/1.1\r\nHost: " + parts.netloc + "\r\nUser-Agent: BatchJPEGDownloader\r\n"
+
+        for name, value in (headers or {}).items():
+            request += name + ": " + value + "\r\n"
+
+        try:
+            request = (request + "\r\n").encode("latin-1")
+        except UnicodeError as e:
+            raise IOError("Invalid request for " + repr(url) + ": " + str(e))
+
+        key = (parts.scheme, parts.hostname, port)
+
+        while True:
+            connection = self.take_connection(key)
+
+            if connection is None:
+                connection = await self.connect(key, result)
+
+            try:
+                connection.writer.write(request)
+                status_line = await self.wait_for(connection.reader.readline())
+            except ConnectionError:
+                connection.writer.close()
+
+                if connection.reused:
+                    continue
+
+                raise
+            except BaseException:
+                connection.writer.close()
+                raise
+
+            # A reused connection that the server has closed while it was idle is replaced by a new one.
+            if not status_line and connection.reused:
+                connection.writer.close()
+                continue
+
+            break
+
+        try:
+            status_line = status_line.decode("latin-1").split(None, 2)
+
+            if len(status_line) < 2 or not status_line[0].startswith("HTTP/") or not status_line[1].isdigit():
+                raise IOError("Invalid HTTP response from " + repr(url) + ".")
+
+            response_headers = {}
+
+            while True:
+                line = (await self.wait_for(connection.reader.readline())).decode("latin-1").strip()
+
+                if not line:
+                    break
+
+                name, _, value = line.partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+
+            reason = status_line[2].strip() if len(status_line) > 2 else ""
+
+            connection.keep_alive = status_line[0] == "HTTP/1.1" and response_headers.get("connection", "").lower() != "close"
+
+            return connection, int(status_line[1]), reason, response_headers
+        except BaseException:
+            connection.writer.close()
+            raise
+
+    async def connect(self, key, result = None):
+        """
+        Open a new connection for the (scheme, host, port) triple `key`.
+
+        The addresses of the host are tried in the order of the name resolution until a connection succeeds.
+        If `result` is given, the times for the name resolution and the connection setup are added to it.
+
+        Returns:
+            _Connection: The new connection.
+
+        Raises:
+            IOError: If the name cannot be resolved or no address accepts a connection within `timeout` seconds.
+        """
+
+        import socket
+        import time
+
+        scheme, host, port = key
+
+        # Resolve the host name separately, so that the name resolution and the connection setup can be timed on their own.
+        start = time.time()
+        addresses = await self.wait_for(_running_loop().getaddrinfo(host, port, type = socket.SOCK_STREAM))
+        resolved = time.time()
+
+        error = IOError("No address found for " + repr(host) + ".")
+
+        for address in addresses:
+            try:
+                if scheme == "https":
+                    reader, writer = await self.wait_for(asyncio.open_connection(address[4][0], port, ssl = True, \
+                        server_hostname = host))
+                else:
+                    reader, writer = await self.wait_for(asyncio.open_connection(address[4][0], port))
+            except (IOError, OSError) as e:
+                error = e
+                continue
+
+            break
+        else:
+            raise error
+
+        if result is not None:
+            result.dns_time = (result.dns_time or 0.0) + resolved - start
+            result.connect_time = (result.connect_time or 0.0) + time.time() - resolved
+
+        with self.connection_pool.condition:
+            self.connection_pool.connections_opened += 1
+
+        return _Connection(key, reader, writer)
+
+    def take_connection(self, key):
+        """Return an idle connection for `key` that is not older than the idle timeout of the connection pool, or None."""
+
+        import time
+
+        idle = self.idle_connections.get(key)
+
+        while idle:
+            connection = idle.pop()
+
+            if time.time() - connection.released < self.connection_pool.idle_timeout and not connection.reader.at_eof():
+                connection.reused = True
+
+                with self.connection_pool.condition:
+                    self.connection_pool.connections_reused += 1
+
+                return connection
+
+            connection.writer.close()
+
+        return None
+
+    def release_connection(self, connection, complete):
+        """Keep a connection for later requests if the response body has been read completely, and close it otherwise."""
+
+        import time
+
+        if complete and connection.keep_alive:
+            connection.released = time.time()
+            self.idle_connections.setdefault(connection.key, []).append(connection)
+        else:
+            connection.writer.close()
+
+    async def read_body(self, reader, headers):
+        """
+        Yield the response body in blocks of at most `buffer_size` bytes.
+
+        Bodies with a Content-Length header, chunked transfer encoding and bodies delimited by the end of the connection are supported.
+
+        Raises:
+            IOError: If the connection is closed before the end of the body, no data is received for `timeout` seconds
+                or the Content-Length or a chunk size is malformed.
+        """
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                line = (await self.wait_for(reader.readline())).split(b";", 1)[0].strip()
+
+                try:
+                    size = int(line or b"0", 16)
+                except ValueError:
+                    raise IOError("Invalid chunk size " + repr(line) + ".")
+
+                if size == 0:
+                    # Skip the trailer section.
+                    while (await self.wait_for(reader.readline())).strip():
+                        pass
+                    return
+
+                while size > 0:
+                    block = await self.wait_for(reader.read(min(size, self.buffer_size)))
+
+                    if not block:
+                        raise IOError("Connection closed in the middle of a chunk.")
+
+                    size -= len(block)
+                    yield block
+
+                await self.wait_for(reader.readline())
+
+        elif "content-length" in headers:
+            if not headers["content-length"].isdigit():
+                raise IOError("Invalid Content-Length " + repr(headers["content-length"]) + ".")
+
+            remaining = int(headers["content-length"])
+
+            while remaining > 0:
+                block = await self.wait_for(reader.read(min(remaining, self.buffer_size)))
+
+                if not block:
+                    raise IOError("Connection closed after " + str(int(headers["content-length"]) - remaining) + \
+                        " of " + headers["content-length"] + " bytes.")
+
+                remaining -= len(block)
+                yield block
+        else:
+            while True:
+                block = await self.wait_for(reader.read(self.buffer_size))
+
+                if not block:
+                    return
+
+                yield block
+
+    async def wait_for(self, awaitable):
+        """
+        Wait for a connection attempt or a read, like the socket timeout of the thread engine.
+
+        Raises:
+            IOError: If `awaitable` has not completed after `timeout` seconds.
+        """
+
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            raise IOError("No response within " + str(self.timeout) + " seconds.")
+
+    def in_thread(self, function, *arguments):
+        """Run a blocking call, such as a file operation, in the default executor of the event loop and return its future."""
+        return _running_loop().run_in_executor(None, function, *arguments)
+
+class _Connection:
+    """
+    An HTTP connection of the asyncio engine.
+
+    Attributes:
+        key (tuple): The (scheme, host, port) triple of the connection.
+        reader (asyncio.StreamReader): The reading side of the connection.
+        writer (asyncio.StreamWriter): The writing side of the connection.
+        reused (bool): True if the connection has been taken from the idle connections.
+        keep_alive (bool): True if the server keeps the connection open after the current response.
+        released (float): Time at which the connection has become idle.
+    """
+
+    def __init__(self, key, reader, writer):
+        """Store a new connection."""
+
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+        self.keep_alive = False
+        self.released = None
+
+def _running_loop():
+    """Return the event loop of the running coroutine."""
+
+    # get_running_loop() is available from Python 3.7. In a coroutine, get_event_loop() returns the same loop.
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError:
+        return asyncio.get_event_loop()
+
+def _host_key(url):
+    """Return the (scheme, host, port) triple that identifies the origin of `url`."""
+
+    from urllib.parse import urlsplit
+
+    parts = urlsplit(url)
+
+    # A malformed port fails later in request(), with the same error as in the thread engine.
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+
+    return (parts.scheme, parts.hostname, port)
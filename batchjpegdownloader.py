@@ -28,9 +28,16 @@ def main():
     The main() method is invoked when the script is called directly from command line. 
     It parses the program arguments for a file that contains a list of URLs and passes it to the URL generator 
     that extracts the URLs and is iterable. Next, a batch downloader class is created together with an output directory. 
-    Finally, the URL generator is passed to the downloader to start downloading the files into the output path.
+    Finally, the URL generator is passed to the downloader to start downloading the files into the output path,
+    and the results of the files are printed as they are completed.
+    With several processes, the list is split into shards that are downloaded by separate processes.
     """
 
+    import time
+
+    # The time to the first request is measured from here, so that it includes reading the arguments and the list file.
+    started = time.time()
+
     print("BatchJPEGDownloader, Copyright (c) 2016 Oliver Meister")
     print("")
 
@@ -39,16 +46,192 @@ def main():
     # this class may be replaced by any other type of configuration class.
     config = ArgumentParser()
 
+    if config.processes > 1:
+        ShardCoordinator(config, config.processes).run()
+    else:
+        downloader, url_iterator = create_shard(config, config.shard_index, config.shard_count)
+
+        downloader.metrics.started = started
+
+        # Messages per file are printed from the results instead of by the downloader.
+        verbose = downloader.verbose
+        downloader.verbose = False
+
+        # Download all the files given by the generator and report each file once it is done.
+        # The downloader is closed at the end, which flushes and closes its files and stops the thumbnail pool.
+        with downloader:
+            results = downloader.results(url_iterator)
+
+            for result in results:
+                message = downloader.describe(result) if verbose else None
+
+                if message is not None:
+                    print(message)
+
+        print(results.summary)
+
+        if downloader.metrics.time_to_first_request is not None:
+            print("First request after " + str(round(downloader.metrics.time_to_first_request, 3)) + " seconds.")
+
+def create_shard(config, shard_index = 0, shard_count = 1, processes = 1):
+    """
+    Create the URL generator and the downloader for a shard of the list file of a configuration.
+
+    Args:
+        config (ArgumentParser): The configuration, or any other object with the same properties.
+        shard_index (int): Index of the shard, starting at 0. The shards of the processes of a machine are numbered
+            consecutively, so shard_index // processes is the shard of the machine.
+        shard_count (int): Number of shards of the list file, which is the number of machines times `processes`.
+        processes (int): Number of processes on this machine that download shards at the same time.
+            Rate and bandwidth limits are divided among them, and only a summary is printed per shard.
+
+    Returns:
+        tuple: The downloader and the URLs of the shard, in the order of the DownloadScheduler unless the schedule is 'order'.
+    """
+
+    # Select the download engine: a pool of worker threads or asyncio on a single thread.
+    # The asyncio engine requires Python 3.6 or higher and is therefore loaded only on demand.
+    # Both engines accept the same arguments, so they are interchangeable.
+    if config.engine == "async":
+        from asyncbatchjpegdownloader import AsyncBatchDownloader as downloader_class
+        from asyncbatchjpegdownloader import AsyncListFileURLGenerator as generator_class
+    else:
+        downloader_class = BatchDownloader
+        generator_class = ListFileURLGenerator
+
     # Create a generator that iterates over the list file and specify that we are interested in the JPEG format only
     # We can replace it by any other iterator or generator over a set of URLs.
-    url_iterator = ListFileURLGenerator(config.jpeg_list_file, "*.jpg")
+    # The processes of a machine split the shard of the machine, which is the same for any number of processes.
+    machine_shard_index, process_index = divmod(shard_index, processes)
+
+    url_iterator = generator_class(config.jpeg_list_file, "*.jpg", lazy = config.lazy_validation, \
+        shard_index = machine_shard_index, shard_count = shard_count // processes, shard_by = config.shard_by, \
+        check_urls = config.check_urls, process_index = process_index, process_count = processes)
+
+    # Failed downloads are repeated with an exponentially growing delay and hosts that are down are skipped for a while.
+    retry_policy = RetryPolicy(attempts = config.retries + 1, backoff = config.retry_backoff)
+
+    if config.breaker_threshold is not None:
+        circuit_breaker = CircuitBreaker(threshold = config.breaker_threshold)
+    else:
+        circuit_breaker = None
+
+    # Pace the requests and the bandwidth if any limit is given. The processes of this machine share the limits.
+    limits = [limit / float(processes) if limit is not None else None for limit in \
+        (config.rate_limit, config.bandwidth_limit, config.host_rate_limit, config.host_bandwidth_limit)]
+
+    if any(limit is not None for limit in limits):
+        throttle = Throttle(*limits)
+    else:
+        throttle = None
+
+    # Thumbnails are created in a pool of processes, which the processes of this machine share between them.
+    if config.thumbnail_sizes is not None:
+        thumbnail_processes = config.thumbnail_processes
+
+        if processes > 1:
+            import multiprocessing
+
+            thumbnail_processes = max((thumbnail_processes or multiprocessing.cpu_count()) // processes, 1)
+
+        thumbnails = ThumbnailGenerator(config.thumbnail_sizes, processes = thumbnail_processes)
+    else:
+        thumbnails = None
+
+    # Shards that share the output directory keep their own journal, digest index, log and failures list.
+    if shard_count > 1:
+        shard_name = str(shard_index) + "-of-" + str(shard_count)
+        log_filename = config.log_filename + "." + shard_name if config.log_filename is not None else None
+        failures_filename = config.failures_filename + "." + shard_name if config.failures_filename is not None else None
+        manifest_filename = config.manifest_filename + "." + shard_name if config.manifest_filename is not None else None
+
+        # A shard compares its files with its own part of the previous manifest, if that is the manifest itself.
+        if config.manifest_diff is not None and config.manifest_diff == config.manifest_filename:
+            manifest_diff = manifest_filename
+        else:
+            manifest_diff = config.manifest_diff
+    else:
+        shard_name = None
+        log_filename = config.log_filename
+        failures_filename = config.failures_filename
+        manifest_filename = config.manifest_filename
+        manifest_diff = config.manifest_diff
+
+    # The manifest records the files of every run, or in diff mode only the files that have changed since the previous manifest.
+    if manifest_filename is not None:
+        manifest = DownloadManifest(manifest_filename, config.output_directory, previous_filename = manifest_diff, \
+            diff = manifest_diff is not None, format = DownloadManifest.guess_format(config.manifest_filename))
+    elif manifest_diff is not None:
+        raise ValueError("A previous manifest for --manifest-diff requires a manifest file, which is set with --manifest.")
+    else:
+        manifest = None
+
+    # New downloads are admitted only while the output directory has enough free space and the open files are below a limit.
+    # The processes of this machine see the same free space, as they share the output directory.
+    if config.min_free_space is not None or config.max_open_files is not None:
+        admission = AdmissionControl(config.output_directory, low_water = config.min_free_space or 0, \
+            high_water = config.resume_free_space, max_open_files = config.max_open_files, max_wait = config.max_pause)
+    elif config.resume_free_space is not None or config.max_pause is not None:
+        raise ValueError("--resume-free-space and --max-pause require a low-water mark, which is set with --min-free-space.")
+    else:
+        admission = None
 
     # Create a batch downloader, define the output directory and set file access permissions.
-    downloader = BatchDownloader(download_directory = config.output_directory, \
-        default_overwrite = config.force_download, default_create_directory = config.create_output_directory)
+    # The number of workers controls how many files are downloaded concurrently.
+    downloader = downloader_class(download_directory = config.output_directory, \
+        default_overwrite = config.force_download, default_create_directory = config.create_output_directory, \
+        workers = config.workers, host_limit = config.host_limit, buffer_size = config.buffer_size, \
+        resume = config.resume, refresh = config.refresh, deduplicate = config.deduplicate, \
+        progress = config.progress and processes == 1, log_filename = log_filename, retry_policy = retry_policy, \
+        circuit_breaker = circuit_breaker, keep_going = config.keep_going, failures_filename = failures_filename, \
+        throttle = throttle, validate = config.validate, layout = config.layout, index_existing = config.index_existing, \
+        rename_collisions = config.rename_collisions, shard_name = shard_name, thumbnails = thumbnails, manifest = manifest, \
+        admission = admission)
+
+    # Messages per file of several processes would interleave on the terminal.
+    if processes > 1:
+        downloader.verbose = False
+
+    # Reorder the URLs by their priority annotations and the schedule. HEAD requests share the connections, the throttle
+    # and the circuit breaker of the downloads. In list order, URLs are passed on as they are read, so that the first
+    # download starts at once and lists from the standard input are streamed.
+    if config.schedule != "order":
+        url_iterator = DownloadScheduler(url_iterator, policy = config.schedule, window = config.lookahead, \
+            probe = config.probe_sizes, downloader = downloader)
+    else:
+        url_iterator.warn_priorities = True
+
+    return downloader, url_iterator
 
-    # Download all the files given by the generator.
-    downloader.download(url_iterator)
+def run_shard_process(arguments):
+    """
+    Download a shard in a process of the ShardCoordinator.
+
+    Errors are returned as a message instead of being raised, as exceptions with custom arguments cannot always be 
+    sent back to the coordinator.
+
+    Args:
+        arguments (tuple): The configuration, the shard index, the number of shards and the number of processes.
+
+    Returns:
+        tuple: The shard index, the DownloadStatistics (None if the shard failed), the DownloadMetrics (None if the 
+            downloader could not be created) and the error message (None if the shard succeeded).
+    """
+
+    config, shard_index, shard_count, processes = arguments
+
+    try:
+        downloader, url_iterator = create_shard(config, shard_index, shard_count, processes)
+    except (IOError, ValueError) as e:
+        return shard_index, None, None, str(e)
+
+    try:
+        with downloader:
+            statistics = downloader.download(url_iterator)
+    except (IOError, ValueError, TypeError) as e:
+        return shard_index, None, downloader.metrics, str(e)
+
+    return shard_index, statistics, downloader.metrics, None
 
 class ArgumentParser:
     """Read in command line arguments and store them in object attributes.
@@ -90,13 +273,160 @@ class ArgumentParser:
         parser.add_argument('-o', '--out', type=str, required = True, help='Output directory, where the JPEG files will be stored.')
 
         # Add a mandatory positional argument for the JPEG list file.
-        parser.add_argument('FILE', type=str, help='Text file that contains a URL link to a JPEG file in each line.')
+        parser.add_argument('FILE', type=str, help='Text file that contains a URL link to a JPEG file in each line. ' + \
+            'Files ending with .gz or .zst are decompressed, and - reads the list from the standard input.')
        
         # Add an optional argument to allow creation of the output directory.
         parser.add_argument('-c', '--create', nargs='?', type=bool, const = True, default= False, help='If true, the output directory will be created if it does not exist.')
         
         # Add an optional argument to allow overwriting of existing files.
         parser.add_argument('-f', '--force', nargs='?', type=bool, const = True, default= False, help='If true, existing files will be overwritten.')
+
+        # Add an optional argument for the number of concurrent downloads.
+        parser.add_argument('-j', '--jobs', type=int, default = 1, help='Number of files that are downloaded concurrently (default: 1).')
+
+        # Add an optional argument for the size of the download buffer.
+        parser.add_argument('--buffer-size', type=int, default = 64 * 1024, \
+            help='Size in bytes of the blocks in which files are downloaded and written to disk (default: 65536).')
+
+        # Add an optional argument to resume interrupted batches.
+        parser.add_argument('-r', '--resume', action = 'store_true', \
+            help='Keep a journal in the output directory, skip files it lists as completed and resume partial downloads.')
+
+        # Add an optional argument to refresh existing files with conditional requests.
+        parser.add_argument('--refresh', action = 'store_true', \
+            help='Request existing files again with the validators from the journal and rewrite only files that have changed.')
+
+        # Add an optional argument to avoid storing the same content twice.
+        parser.add_argument('--dedup', action = 'store_true', \
+            help='Download repeated URLs only once and store files with identical content as links to a single copy.')
+
+        # Add an optional argument to validate the list file while downloading.
+        parser.add_argument('--lazy', action = 'store_true', \
+            help='Check the URLs of the list file while downloading instead of in a separate pass before the first download.')
+
+        # Add an optional argument to show a progress line instead of a message per file.
+        parser.add_argument('--progress', action = 'store_true', \
+            help='Show a single progress line with the download rate and the remaining time instead of a message per file.')
+
+        # Add an optional argument to log the result and timing of every file.
+        parser.add_argument('--log-json', metavar = 'LOG', default = None, \
+            help='Append the result, size and timing of every file as a JSON line to the file LOG.')
+
+        # Add optional arguments to retry failed downloads and to continue after failures.
+        parser.add_argument('--retries', type=int, default = 0, \
+            help='Number of times a download is repeated after a connection error or a temporary server error (default: 0).')
+
+        parser.add_argument('--retry-backoff', type=float, default = 0.5, metavar = 'SECONDS', \
+            help='Maximum delay before the first retry, which doubles with every further retry (default: 0.5).')
+
+        parser.add_argument('-k', '--keep-going', action = 'store_true', \
+            help='Continue with the next file after a failed download instead of stopping.')
+
+        parser.add_argument('--failures', metavar = 'LIST', default = None, \
+            help='Append the URLs of failed downloads to the list file LIST, which can be passed as FILE in a later run.')
+
+        parser.add_argument('--breaker-threshold', type=int, default = None, metavar = 'N', \
+            help='Stop requesting files from a host for 30 seconds after N consecutive failures.')
+
+        # Add optional arguments to limit the request rate and the bandwidth, in total and per host.
+        parser.add_argument('--rate-limit', type=float, default = None, metavar = 'REQUESTS', \
+            help='Maximum number of requests per second.')
+
+        parser.add_argument('--bandwidth-limit', type=float, default = None, metavar = 'BYTES', \
+            help='Maximum download bandwidth in bytes per second.')
+
+        parser.add_argument('--host-rate-limit', type=float, default = None, metavar = 'REQUESTS', \
+            help='Maximum number of requests per second to each host.')
+
+        parser.add_argument('--host-bandwidth-limit', type=float, default = None, metavar = 'BYTES', \
+            help='Maximum download bandwidth in bytes per second from each host.')
+
+        # Add an optional argument to check that the downloaded files are JPEG files.
+        parser.add_argument('--validate', choices = ['delete', 'quarantine'], default = None, \
+            help='Check the Content-Type, the JPEG markers and the size of every file while it is downloaded, and delete invalid ' + \
+                'files or move them to the hidden quarantine directory in the output directory.')
+
+        # Add optional arguments for very large downloads.
+        parser.add_argument('--layout', choices = ['flat', 'sharded'], default = 'flat', \
+            help='Store all files in the output directory (flat) or in two levels of subdirectories named after a hash ' + \
+                'of the filename (sharded, default: flat).')
+
+        parser.add_argument('--index', action = 'store_true', \
+            help='Scan the output directory once and check for existing files in memory instead of on the file system.')
+
+        parser.add_argument('--rename-collisions', action = 'store_true', \
+            help='Append a hash of the URL to every filename, so that different URLs with the same filename do not collide.')
+
+        # Add optional arguments to split the list file into shards for several processes or machines.
+        parser.add_argument('-p', '--processes', type=int, default = 1, \
+            help='Number of processes that download shards of the list file at the same time (default: 1).')
+
+        parser.add_argument('--shard-index', type=int, default = 0, metavar = 'INDEX', \
+            help='Download only the shard INDEX (starting at 0) of the list file, for example on one of several machines.')
+
+        parser.add_argument('--shard-count', type=int, default = 1, metavar = 'COUNT', \
+            help='Number of shards of the list file (default: 1).')
+
+        parser.add_argument('--shard-by', choices = ['hash', 'line'], default = 'hash', \
+            help='Assign URLs to shards by a hash of their filename or by contiguous line ranges (default: hash).')
+
+        # Add optional arguments to create thumbnails of the downloaded files.
+        parser.add_argument('--thumbnails', metavar = 'SIZES', default = None, \
+            help='Create thumbnails with the given maximum sizes next to each file, for example 128x128,640x480 ' + \
+                '(requires pip install pillow).')
+
+        parser.add_argument('--thumbnail-processes', type=int, default = None, metavar = 'N', \
+            help='Number of processes that create thumbnails (default: number of cores).')
+
+        # Add optional arguments to write a manifest of the downloaded files.
+        parser.add_argument('--manifest', metavar = 'FILE', default = None, \
+            help='Append the URL, path, size, SHA-256 digest, time and status of every file to FILE, ' + \
+                'as CSV if FILE ends with .csv and as JSON lines otherwise.')
+
+        parser.add_argument('--manifest-diff', metavar = 'PREVIOUS', default = None, \
+            help='Append only files that have been added or changed since the manifest PREVIOUS to the manifest. ' + \
+                'PREVIOUS may be the manifest itself.')
+
+        # Add an optional argument to skip the checks of the list file for the shortest start.
+        parser.add_argument('--no-url-check', action = 'store_true', \
+            help='Do not check the URLs of the list file, neither in a separate pass nor while downloading. ' + \
+                'Starts the first download soonest, for small lists from a trusted source.')
+
+        # Add optional arguments to reorder the downloads.
+        parser.add_argument('--schedule', choices = ['order', 'largest', 'shortest'], default = 'order', \
+            help='Order of the downloads: the order of the list, without reading ahead, or by priority annotations and then ' + \
+                'the largest or the smallest files first, by their size annotations or probed sizes (default: order).')
+
+        parser.add_argument('--lookahead', type=int, default = 1000, metavar = 'N', \
+            help='Number of URLs that are read ahead and reordered by the largest and shortest schedules (default: 1000).')
+
+        parser.add_argument('--probe-sizes', action = 'store_true', \
+            help='Request the sizes of files without a size annotation with HEAD requests for the largest and shortest schedules.')
+
+        # Add optional arguments to admit new downloads only while the output directory has enough free space.
+        parser.add_argument('--min-free-space', type=float, default = None, metavar = 'BYTES', \
+            help='Reserve the Content-Length of every file in the free space of the output directory and pause new downloads ' + \
+                'while less than BYTES are free and not reserved.')
+
+        parser.add_argument('--resume-free-space', type=float, default = None, metavar = 'BYTES', \
+            help='Resume paused downloads once BYTES are free again (default: a quarter more than --min-free-space).')
+
+        parser.add_argument('--max-pause', type=float, default = None, metavar = 'SECONDS', \
+            help='Fail downloads that have been paused for free space for longer than SECONDS (default: wait indefinitely).')
+
+        parser.add_argument('--max-open-files', type=int, default = None, metavar = 'N', \
+            help='Maximum number of files that are open for downloading at the same time, which limits the jobs ' + \
+                '(default with --min-free-space: half of the limit of open files of the process).')
+
+        # Add an optional argument to select the download engine.
+        parser.add_argument('--engine', choices = ['thread', 'async'], default = 'thread', \
+            help='Download engine: a pool of worker threads or asyncio on a single thread (Python 3.6 or higher, ' + \
+                'HTTP and HTTPS URLs only, default: thread).')
+
+        # Add an optional argument to limit the number of concurrent downloads from the same host.
+        parser.add_argument('--host-limit', type=int, default = None, \
+            help='Maximum number of concurrent downloads from the same host (default: number of jobs).')
         
         # Parse the program arguments. argparse will check if all arguments have been correctly provided.
         arguments = parser.parse_args()
@@ -123,6 +453,204 @@ class ArgumentParser:
         """If true, the output directory will be created if it does not exist."""
         return self.arguments.create
 
+    @property
+    def workers(self):
+        """Number of files that are downloaded concurrently."""
+        return self.arguments.jobs
+
+    @property
+    def buffer_size(self):
+        """Size in bytes of the blocks in which files are downloaded and written to disk."""
+        return self.arguments.buffer_size
+
+    @property
+    def resume(self):
+        """If true, interrupted batches are resumed with the help of a journal in the output directory."""
+        return self.arguments.resume
+
+    @property
+    def refresh(self):
+        """If true, existing files are requested again and rewritten only if they have changed on the server."""
+        return self.arguments.refresh
+
+    @property
+    def deduplicate(self):
+        """If true, repeated URLs and files with identical content are stored only once."""
+        return self.arguments.dedup
+
+    @property
+    def lazy_validation(self):
+        """If true, the URLs of the list file are checked while downloading."""
+        return self.arguments.lazy
+
+    @property
+    def progress(self):
+        """If true, a progress line is shown instead of a message per file."""
+        return self.arguments.progress
+
+    @property
+    def log_filename(self):
+        """Name of the JSON-lines log file, or None."""
+        return self.arguments.log_json
+
+    @property
+    def retries(self):
+        """Number of retries after a failed download."""
+        return self.arguments.retries
+
+    @property
+    def retry_backoff(self):
+        """Maximum delay in seconds before the first retry."""
+        return self.arguments.retry_backoff
+
+    @property
+    def keep_going(self):
+        """If true, the download continues after a failed file."""
+        return self.arguments.keep_going
+
+    @property
+    def failures_filename(self):
+        """Name of the list file for failed URLs, or None."""
+        return self.arguments.failures
+
+    @property
+    def breaker_threshold(self):
+        """Number of consecutive failures after which a host is not requested for a while, or None."""
+        return self.arguments.breaker_threshold
+
+    @property
+    def rate_limit(self):
+        """Maximum number of requests per second, or None."""
+        return self.arguments.rate_limit
+
+    @property
+    def bandwidth_limit(self):
+        """Maximum bandwidth in bytes per second, or None."""
+        return self.arguments.bandwidth_limit
+
+    @property
+    def host_rate_limit(self):
+        """Maximum number of requests per second to each host, or None."""
+        return self.arguments.host_rate_limit
+
+    @property
+    def host_bandwidth_limit(self):
+        """Maximum bandwidth in bytes per second from each host, or None."""
+        return self.arguments.host_bandwidth_limit
+
+    @property
+    def validate(self):
+        """Validation mode, either 'delete', 'quarantine' or None."""
+        return self.arguments.validate
+
+    @property
+    def layout(self):
+        """Layout of the output directory, either 'flat' or 'sharded'."""
+        return self.arguments.layout
+
+    @property
+    def index_existing(self):
+        """If true, existing files are looked up in an index of the output directory."""
+        return self.arguments.index
+
+    @property
+    def rename_collisions(self):
+        """If true, different URLs with the same filename are stored under different names."""
+        return self.arguments.rename_collisions
+
+    @property
+    def processes(self):
+        """Number of processes that download shards at the same time."""
+        return self.arguments.processes
+
+    @property
+    def shard_index(self):
+        """Index of the shard of the list file that is downloaded."""
+        return self.arguments.shard_index
+
+    @property
+    def shard_count(self):
+        """Number of shards of the list file."""
+        return self.arguments.shard_count
+
+    @property
+    def shard_by(self):
+        """Assignment of URLs to shards, either 'hash' or 'line'."""
+        return self.arguments.shard_by
+
+    @property
+    def thumbnail_sizes(self):
+        """Maximum sizes of the thumbnails as pairs of integers, or None."""
+        if self.arguments.thumbnails is None:
+            return None
+
+        return ThumbnailGenerator.parse_sizes(self.arguments.thumbnails)
+
+    @property
+    def thumbnail_processes(self):
+        """Number of processes that create thumbnails, or None for the number of cores."""
+        return self.arguments.thumbnail_processes
+
+    @property
+    def manifest_filename(self):
+        """Name of the manifest file, or None."""
+        return self.arguments.manifest
+
+    @property
+    def manifest_diff(self):
+        """Name of the previous manifest for the diff mode, or None."""
+        return self.arguments.manifest_diff
+
+    @property
+    def check_urls(self):
+        """If false, the URLs of the list file are not checked."""
+        return not self.arguments.no_url_check
+
+    @property
+    def schedule(self):
+        """Order of the downloads among URLs of the same priority, either 'order', 'largest' or 'shortest'."""
+        return self.arguments.schedule
+
+    @property
+    def lookahead(self):
+        """Number of URLs that are read ahead and reordered."""
+        return self.arguments.lookahead
+
+    @property
+    def probe_sizes(self):
+        """If true, the sizes of files without a size annotation are requested with HEAD requests."""
+        return self.arguments.probe_sizes
+
+    @property
+    def min_free_space(self):
+        """Number of free bytes below which new downloads are paused, or None without admission control."""
+        return self.arguments.min_free_space
+
+    @property
+    def resume_free_space(self):
+        """Number of free bytes above which paused downloads are resumed."""
+        return self.arguments.resume_free_space
+
+    @property
+    def max_pause(self):
+        """Maximum time in seconds a download waits for free space."""
+        return self.arguments.max_pause
+
+    @property
+    def max_open_files(self):
+        """Maximum number of files that are downloaded at the same time."""
+        return self.arguments.max_open_files
+
+    @property
+    def engine(self):
+        """Download engine, either 'thread' or 'async'."""
+        return self.arguments.engine
+
+    @property
+    def host_limit(self):
+        """Maximum number of concurrent downloads from the same host."""
+        return self.arguments.host_limit
+
 class ListFileURLGenerator:
     """
     Read a list of URLs from a file and iterate over the URLs.
@@ -130,13 +658,56 @@ class ListFileURLGenerator:
     This class is a generator over the lines of an input file.
     Every line that matches a given pattern will be iterated during traversal.
 
+    By default, all URLs are validated in a separate pass before the iteration starts. 
+    In lazy mode, each URL is checked with a cheap syntax check while it is read, so that the iteration 
+    over very large lists starts immediately. Without URL checks, lines are passed on unchecked, which gives 
+    the shortest start for small lists that come from a trusted source. List files ending with '.gz' or '.zst' are decompressed on the fly, 
+    and the file name '-' reads the list from the standard input in lazy mode.
+
+    A list may be split into `shard_count` disjoint shards, of which the generator yields only the shard `shard_index`.
+    Shards are either contiguous line ranges or determined by a hash of the filename part of each URL. The hash keeps
+    all URLs with the same filename in the same shard, so that shards never write to the same file.
+    A shard may be split further into `process_count` parts for the processes of a machine, of which the generator yields
+    only the part `process_index`. The shard itself does not depend on the number of processes, so machines with 
+    different numbers of processes still share the list without overlaps or gaps.
+
+    A URL may be followed by annotations for the DownloadScheduler, separated by whitespace, for example
+    'http://example.com/image.jpg priority=10 size=250000'. Annotated URLs are yielded as AnnotatedURL objects, 
+    which are strings with the additional attributes `priority` and `size`.
+
     Attributes:
         filename (str): Input file that contains a list of URLs, seperated by new lines
         
         pattern (str): File pattern for the generator output. May contain wildcards.
+
+        lazy (bool): If True, URLs are validated during the iteration instead of in a separate pass.
+
+        check_urls (bool): If False, URLs are not validated at all.
+
+        url_count (int): Number of URLs of the shard that match the pattern, counted in the validation pass. None in lazy mode.
+
+        shard_index (int): Index of the shard that is iterated, starting at 0.
+
+        shard_count (int): Number of shards.
+
+        shard_by (str): Either "hash" or "line".
+
+        process_index (int): Index of the part of the shard that is iterated, starting at 0.
+
+        process_count (int): Number of parts of the shard.
     """
 
-    def __init__(self, filename, pattern = "*"):
+    # Regular expression for the syntax check of URLs in lazy mode: a scheme, a non-empty host and an optional path.
+    url_syntax = r"(?:https?|ftp)://[^\s/?#]+(?:[/?#]\S*)?\Z"
+
+    # Number of warnings about ignored URLs that are printed before further ignored URLs are only counted.
+    max_warnings = 10
+
+    # If True, a warning is printed during the iteration if a URL has a priority annotation, as the URLs are not reordered.
+    warn_priorities = False
+
+    def __init__(self, filename, pattern = "*", lazy = False, shard_index = 0, shard_count = 1, shard_by = "hash", \
+        check_urls = True, process_index = 0, process_count = 1):
         """
         Initialize a URL generator from a list of URLs provided in the file `filename`. 
 
@@ -145,59 +716,202 @@ class ListFileURLGenerator:
         Args:
             filename (str): Input file that contains a list of URLs, seperated by new lines
             pattern (str):  Optional filter to include only some file types in the generator. May contain wildcards.
+            lazy (bool): If True, URLs are validated during the iteration instead of in a separate pass.
+            shard_index (int): Index of the shard that is iterated, starting at 0.
+            shard_count (int): Number of shards of the list.
+            shard_by (str): "hash" assigns URLs to shards by a hash of their filename, "line" splits the list into
+                contiguous line ranges, which requires an additional pass to count the lines.
+            check_urls (bool): If False, URLs are neither validated in a separate pass nor checked during the iteration.
+            process_index (int): Index of the part of the shard that is iterated, starting at 0.
+            process_count (int): Number of parts into which the shard is split for the processes of a machine.
 
         Example:
-            generator = ListFileURLGenerator("example/test_valid.list", "*.jpg")
+            generator = ListFileURLGenerator("example/test_valid.list", "*.jpg", shard_index = 2, shard_count = 8)
 
         Raises:
             IOError:    If `filename` is not a valid file name.
-            ValueError: If any URL in the file `filename` is not formatted correctly
+            ValueError: If any URL in the file `filename` is not formatted correctly, the shard is invalid
+                or line ranges are requested for the standard input.
         """
 
         self.filename = filename
+        self.lazy = lazy or filename == "-" or not check_urls
+        self.check_urls = check_urls
+
+        if shard_count < 1 or not 0 <= shard_index < shard_count:
+            raise ValueError("Invalid shard " + repr(shard_index) + " of " + repr(shard_count) + " shards.")
+
+        if process_count < 1 or not 0 <= process_index < process_count:
+            raise ValueError("Invalid part " + repr(process_index) + " of " + repr(process_count) + " parts of the shard.")
+
+        if shard_by not in ("hash", "line"):
+            raise ValueError("Shards must be assigned by 'hash' or 'line', got " + repr(shard_by) + ".")
+
+        if shard_by == "line" and shard_count * process_count > 1 and filename == "-":
+            raise ValueError("The standard input cannot be split into line ranges.")
+
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.shard_by = shard_by
+        self.process_index = process_index
+        self.process_count = process_count
+        self.line_range = None
 
         # Check if we can open the file and fail otherwise
         try:
-            with open(self.filename, 'r') as list_file:
+            with self.open() as list_file:
                 self.pattern = pattern
+                self.matcher = self.compile_pattern(pattern)
+
+                if check_urls:
+                    import re
+
+                    self.url_matcher = re.compile(self.url_syntax, re.IGNORECASE).match
+                else:
+                    self.url_matcher = None
+
+                # The number of URLs is only known after a full pass over the file.
+                self.url_count = None
+
+                # Line ranges of the shards follow from the number of lines, which requires a pass of its own.
+                if shard_by == "line" and shard_count * process_count > 1:
+                    with self.open() as counted_file:
+                        line_count = sum(1 for _ in counted_file)
+
+                    first = shard_index * line_count // shard_count
+                    lines = (shard_index + 1) * line_count // shard_count - first
+
+                    self.line_range = (first + process_index * lines // process_count, \
+                        first + (process_index + 1) * lines // process_count)
+
+                if self.lazy:
+                    return
 
                 # Use the validators package (if available) to check if the urls are correctly formatted:
                 try:
                     import validators
-                    
-                    # Check if every (non-whitespace) line in the file is a valid URL
-                    for url in list_file:
-                        # Remove whitespaces from the URL
-                        url_no_whitespaces = url.strip()
-
-                        if len(url_no_whitespaces) > 0 and not validators.url(url_no_whitespaces):
-                            raise ValueError("Invalid URL: " + repr(url_no_whitespaces) + " in source file " + repr(self.filename))
-
                 except ImportError:
                     # If importing fails, print a warning but continue execution
+                    validators = None
 
                     print("Warning: failed to load the validators package.")
                     print("To check URLs for correctness install the module via")
                     print("pip install validators")
                     print("")
 
+                url_count = 0
+
+                # Check if every (non-whitespace) line in the file is a valid URL and count the URLs of the shard that match the pattern.
+                for line_number, url in enumerate(list_file, 1):
+                    # Remove whitespaces from the URL
+                    url_no_whitespaces = url.strip()
+
+                    if len(url_no_whitespaces) > 0:
+                        if " " in url_no_whitespaces or "\t" in url_no_whitespaces:
+                            url_no_whitespaces = self.parse_annotations(line_number, url_no_whitespaces)
+
+                        if validators is not None and not validators.url(url_no_whitespaces):
+                            raise ValueError("Invalid URL: " + repr(url_no_whitespaces) + " in source file " + repr(self.filename))
+
+                        if self.in_shard(line_number, url_no_whitespaces) and self.matcher(url_no_whitespaces):
+                            url_count += 1
+
+                self.url_count = url_count
+
         except IOError:
             print("Error: " + repr(filename) + " does not appear to be a valid file.")
             raise
 
+    @staticmethod
+    def compile_pattern(pattern):
+        """
+        Return a function that checks if a URL matches the file pattern `pattern`.
+
+        Patterns of the form '*<suffix>' without further wildcards, such as '*.jpg', are matched by comparing the suffix, 
+        which is faster and does not need the fnmatch and re modules at startup.
+        Other patterns are translated to a regular expression by the fnmatch module.
+        """
+
+        if pattern.startswith("*") and not any(wildcard in pattern[1:] for wildcard in "*?["):
+            import operator
+
+            return operator.methodcaller("endswith", pattern[1:])
+
+        # The fnmatch module translates the user-specified file pattern to a regular expression, which is compiled once.
+        import fnmatch
+        import re
+
+        return re.compile(fnmatch.translate(pattern)).match
+
+    def open(self):
+        """
+        Open the list file for reading text, decompressing '.gz' and '.zst' files.
+
+        The standard input is returned for the file name '-'. It is not closed when the returned object is closed.
+
+        Raises:
+            IOError: If the file cannot be opened.
+            ImportError: If a '.zst' file is opened without the zstandard module.
+            TypeError: If the file name is not of type string.
+        """
+
+        import io
+
+        if self.filename == "-":
+            import sys
+
+            return io.open(sys.stdin.fileno(), "r", closefd = False)
+
+        # If the endswith method is not found, throw a Type Error as the file name does not appear to be a string.
+
+        try:
+            compressed = self.filename.endswith(".gz") or self.filename.endswith(".zst")
+        except AttributeError:
+            raise TypeError("Error: " + repr(self.filename) + " object is not of type string.")
+
+        if not compressed:
+            return open(self.filename, "r")
+
+        if self.filename.endswith(".gz"):
+            import gzip
+
+            # On Python 2, gzip files lack the read1 method of TextIOWrapper, which a BufferedReader provides.
+            return io.TextIOWrapper(io.BufferedReader(gzip.open(self.filename, "rb")))
+
+        # Try importing the zstandard module and throw an exception in case importing fails.
+
+        try:
+            import zstandard
+        except ImportError:
+            print("Error: Failed to load the zstandard module, which is required for " + repr(self.filename) + ".")
+            print(" You may have to install the module using the command")
+            print("   pip install zstandard")
+            print("")
+            raise
+
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(self.filename, "rb"), closefd = True))
+
     def __iter__(self):    
         """
         Iterate over the list file in the attribute self.filename and generate an object for every 
         line with a valid URL that matches the filter defined in the attribute self.pattern."
+
+        Only the first `max_warnings` ignored URLs are reported individually, the remaining ones are counted 
+        and reported once at the end of the iteration.
+
+        Raises:
+            ValueError: In lazy mode, if a URL is not formatted correctly.
         """
 
-        # Load the fnmatch module to test filenames against the user-specified file pattern
-        import fnmatch
+        matcher = self.matcher
+        url_matcher = self.url_matcher if self.lazy else None
+        sharded = self.shard_count * self.process_count > 1
+        ignored = 0
 
         # Try opening the file
-        with open(self.filename, 'r') as list_file:
+        with self.open() as list_file:
             # Process every line of the file as a URL
-            for url in list_file:
+            for line_number, url in enumerate(list_file, 1):
                 # Remove whitespaces from the URL
                 url_no_whitespaces = url.strip()
 
@@ -205,80 +919,4006 @@ class ListFileURLGenerator:
                 # If not, print a warning and skip the file.
 
                 if (url_no_whitespaces != ""):
-                    if fnmatch.fnmatch(url_no_whitespaces, self.pattern):
+                    # Annotations follow the URL after whitespace.
+                    if " " in url_no_whitespaces or "\t" in url_no_whitespaces:
+                        url_no_whitespaces = self.parse_annotations(line_number, url_no_whitespaces)
+
+                    if url_matcher is not None and not url_matcher(url_no_whitespaces):
+                        raise ValueError("Invalid URL: " + repr(url_no_whitespaces) + " in line " + str(line_number) + \
+                            " of source file " + repr(self.filename))
+
+                    # URLs of other shards are skipped silently.
+                    if sharded and not self.in_shard(line_number, url_no_whitespaces):
+                        continue
+
+                    if matcher(url_no_whitespaces):
                         # Yield the URL
                         yield url_no_whitespaces
                     else:
-                        #Print a warning for any URL that is not recognized as the correct file type
-                        print("Warning: Ignoring file " + repr(url_no_whitespaces) + \
-                        ", as it does not appear to be of type " + repr(self.pattern) + ".")
+                        ignored += 1
 
-class BatchDownloader:
-    """
-    Download files from a list of URLs.
+                        #Print a warning for any URL that is not recognized as the correct file type
+                        if ignored <= self.max_warnings:
+                            print("Warning: Ignoring file " + repr(url_no_whitespaces) + \
+                            ", as it does not appear to be of type " + repr(self.pattern) + ".")
 
-    Download a list of files defined in an iterable object. Users must provide a download directory and may provide flags to
-    create new directories, overwrite existing files and activate an interactive mode.
-    """
+        if ignored > self.max_warnings:
+            print("Warning: Ignored " + str(ignored - self.max_warnings) + " more files, as they do not appear to be of type " + \
+                repr(self.pattern) + ".")
 
-    def __init__(self, download_directory, default_overwrite = False, default_create_directory = False):
+    def parse_annotations(self, line_number, line):
         """
-        Initialize a batch downloader for a list of files. 
-
-        You may specify a download directory and a set of flags for error handling. 
-        If it does not exist yet, the download directory will be created upon request.
+        Split the annotations 'priority=<integer>' and 'size=<bytes>' from the URL of a stripped line of the list file.
 
-        Args:
-            download_directory (str): Target directory for the downloaded files.
-            default_overwrite (bool): If True, already existing files will be overwritten.
-            default_create_directory (bool): If True, the directory will be created if it does not exist already.
+        Returns:
+            str: The URL itself if the line has no annotations, an AnnotatedURL otherwise.
 
-        Example:
-            downloader = BatchDownloader(download_directory = "downloads", default_create_directory = True)
+        Raises:
+            ValueError: If an annotation is unknown or its value is not an integer.
         """
 
-        self.download_directory = download_directory
-        self.default_overwrite = default_overwrite
-        self.default_create_directory = default_create_directory
+        parts = line.split()
 
-        # Create the download directory if it does not exist yet
-        self.create_download_directory()
+        if len(parts) == 1:
+            return line
+
+        annotations = {}
+
+        for annotation in parts[1:]:
+            name, _, value = annotation.partition("=")
+
+            try:
+                if name not in ("priority", "size") or name in annotations:
+                    raise ValueError(annotation)
+
+                annotations[name] = int(value)
+
+                if name == "size" and annotations[name] < 0:
+                    raise ValueError(annotation)
+            except ValueError:
+                raise ValueError("Invalid annotation " + repr(annotation) + " in line " + str(line_number) + \
+                    " of source file " + repr(self.filename))
+
+        if self.warn_priorities and annotations.get("priority", 0) != 0:
+            print("Warning: Priority annotations are ignored, as the URLs are downloaded in the order of the list. " + \
+                "Use '--schedule largest' or '--schedule shortest' to start URLs of a higher priority first.")
+
+            self.warn_priorities = False
+
+        return AnnotatedURL(parts[0], **annotations)
+
+    def in_shard(self, line_number, url):
+        """Return True if the URL in line `line_number` (starting at 1) belongs to the shard of the generator."""
+
+        if self.shard_count * self.process_count == 1:
+            return True
+
+        if self.line_range is not None:
+            return self.line_range[0] < line_number <= self.line_range[1]
+
+        import zlib
+
+        # Unlike hash(), CRC-32 gives the same result in every process and on every machine.
+        filename = url.rsplit("/", 1)[-1]
+        checksum = zlib.crc32(filename.encode("utf-8")) & 0xffffffff
+
+        # The remainder selects the shard and the quotient the part of the shard, so the parts are nested in the shards.
+        return checksum % self.shard_count == self.shard_index and \
+            (checksum // self.shard_count) % self.process_count == self.process_index
+
+class AnnotatedURL(str):
+    """
+    URL of a list file together with the annotations of its line.
+
+    As a subclass of str, an annotated URL may be passed to the downloader like any other URL.
+
+    Attributes:
+        priority (int): URLs with a higher priority are downloaded first. The default is 0.
+        size (int): Expected size of the file in bytes, or None if it is unknown.
+    """
+
+    def __new__(cls, url, priority = 0, size = None):
+        """Create the URL string and store its annotations."""
+
+        annotated_url = str.__new__(cls, url)
+        annotated_url.priority = priority
+        annotated_url.size = size
+
+        return annotated_url
+
+class DownloadScheduler:
+    """
+    Reorder the URLs of an iterable within a bounded lookahead window before they are downloaded.
+
+    URLs with a higher priority annotation are downloaded first. Among URLs of the same priority, the policy "order" 
+    keeps the order of the list, "largest" starts the largest files first, so that a few huge files near the end of a list 
+    do not leave the other workers idle while they are transferred, and "shortest" starts the smallest files first, 
+    which completes most files soonest. Sizes are taken from the size annotations of the list file or, if `probe` is set,
+    from the Content-Length of HEAD requests for the URLs that enter the window. Files of unknown size are started after 
+    the files of known size.
+
+    Only `window` URLs are read ahead, so a scheduler works on lists of any length. As the window is refilled, 
+    URLs of a low priority may wait until the end of the list.
+
+    Attributes:
+        urls (iterable): The URLs, for example a ListFileURLGenerator.
+        policy (str): Either "order", "largest" or "shortest".
+        window (int): Maximum number of URLs that are read ahead and reordered.
+        probe (bool): If True, the sizes of HTTP(S) URLs without a size annotation are requested with HEAD requests.
+        probe_workers (int): Number of HEAD requests that are sent at the same time.
+        connection_pool (HTTPConnectionPool): The connection pool for HEAD requests.
+        downloader (BatchDownloader): The downloader whose throttle and circuit breaker apply to the HEAD requests, or None.
+        url_count (int): Number of URLs of the iterable, if it is known.
+        probed (int): Number of HEAD requests that have been sent.
+        probe_failures (int): Number of HEAD requests that did not return a size.
+    """
+
+    policies = ("order", "largest", "shortest")
+
+    def __init__(self, urls, policy = "order", window = 1000, probe = False, probe_workers = 8, connection_pool = None, \
+        downloader = None):
+        """
+        Initialize the scheduler.
+
+        Args:
+            urls (iterable): The URLs, for example a ListFileURLGenerator.
+            policy (str): "order", "largest" or "shortest".
+            window (int): Maximum number of URLs that are read ahead and reordered.
+            probe (bool): If True, the sizes of URLs without a size annotation are requested with HEAD requests.
+                Sizes are not probed for the policy "order", which does not use them.
+            probe_workers (int): Number of HEAD requests that are sent at the same time.
+            connection_pool (HTTPConnectionPool): The connection pool for HEAD requests, for example the pool of 
+                the downloader, so that the downloads reuse the connections. By default, the pool of `downloader`
+                or a new pool is used.
+            downloader (BatchDownloader): If given, HEAD requests wait for its throttle like downloads, are not sent to
+                hosts whose circuit is open and update its circuit breaker.
+
+        Example:
+            scheduler = DownloadScheduler(ListFileURLGenerator("example/test_valid.list", "*.jpg"), policy = "largest")
+
+        Raises:
+            ValueError: If the policy is unknown or the window or the number of probe workers is smaller than 1.
+        """
+
+        if policy not in self.policies:
+            raise ValueError("The policy must be one of " + ", ".join(self.policies) + ", got " + repr(policy) + ".")
+
+        if window < 1:
+            raise ValueError("The lookahead window must be at least 1, got " + repr(window) + ".")
+
+        if probe_workers < 1:
+            raise ValueError("The number of probe workers must be at least 1, got " + repr(probe_workers) + ".")
+
+        self.urls = urls
+        self.policy = policy
+        self.window = window
+        self.probe = probe and policy != "order"
+        self.probe_workers = probe_workers
+        self.downloader = downloader
+
+        if connection_pool is None:
+            connection_pool = downloader.connection_pool if downloader is not None else HTTPConnectionPool()
+
+        self.connection_pool = connection_pool
+        self.probed = 0
+        self.probe_failures = 0
+
+        # The number of URLs does not change, so progress reports can still show the remaining time.
+        # Instances of old-style classes raise an AttributeError instead of a TypeError on Python 2.
+        try:
+            self.url_count = len(urls)
+        except (TypeError, AttributeError):
+            self.url_count = getattr(urls, "url_count", None)
+
+    def __iter__(self):
+        """
+        Iterate over the URLs in the order of the policy.
+
+        The window is refilled once it is half empty, so that the sizes of the new URLs are probed together.
+        """
+
+        import heapq
+        import itertools
+
+        iterator = iter(self.urls)
+        heap = []
+        sequence = itertools.count()
+        exhausted = False
+        executor = None
+
+        try:
+            while True:
+                if not exhausted and len(heap) <= self.window // 2:
+                    batch = list(itertools.islice(iterator, self.window - len(heap)))
+                    exhausted = len(batch) < self.window - len(heap)
+
+                    sizes = [getattr(url, "size", None) for url in batch]
+                    unknown = [i for i, size in enumerate(sizes) if size is None and self.probable(batch[i])]
+
+                    if unknown:
+                        if executor is None:
+                            from concurrent.futures import ThreadPoolExecutor
+
+                            executor = ThreadPoolExecutor(max_workers = self.probe_workers)
+
+                        for i, size in zip(unknown, executor.map(self.probe_size, [batch[i] for i in unknown])):
+                            sizes[i] = size
+
+                        self.probed += len(unknown)
+                        self.probe_failures += sum(1 for i in unknown if sizes[i] is None)
+
+                    # The sequence number keeps the order of the list among URLs with the same key.
+                    for url, size in zip(batch, sizes):
+                        heapq.heappush(heap, (self.key(url, size), next(sequence), url))
+
+                if not heap:
+                    return
+
+                yield heapq.heappop(heap)[2]
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def probable(self, url):
+        """Return True if the size of `url` is requested with a HEAD request."""
+        return self.probe and (url.startswith("http://") or url.startswith("https://"))
+
+    def probe_size(self, url):
+        """
+        Return the Content-Length of `url` from a HEAD request, or None if the request fails or the length is unknown.
+
+        With a downloader, the request takes its turn at the throttle and is skipped if the circuit of the host is open,
+        and its outcome is recorded by the circuit breaker, exactly as for a download.
+        """
+
+        import time
+
+        downloader = self.downloader
+
+        try:
+            if downloader is not None:
+                downloader.check_circuit(url)
+
+                if downloader.throttle is not None:
+                    time.sleep(downloader.throttle.request_delay(downloader.throttle.host(url)))
+
+            with self.connection_pool.urlopen(url, method = "HEAD") as response:
+                if response.status != 200:
+                    raise HTTPStatusError(url, response.status, response.reason)
+
+                length = response.getheader("content-length")
+        except (IOError, ValueError) as e:
+            if downloader is not None and isinstance(e, IOError):
+                downloader.record_attempt(url, e)
+
+            return None
+
+        if downloader is not None:
+            downloader.record_attempt(url, None)
+
+        return int(length) if length is not None and length.strip().isdigit() else None
+
+    def key(self, url, size):
+        """Return the sort key of `url` with the given size, where smaller keys are downloaded first."""
+
+        priority = -getattr(url, "priority", 0)
+
+        if self.policy == "order":
+            return (priority,)
+
+        if size is None:
+            return (priority, 1, 0)
+
+        return (priority, 0, -size if self.policy == "largest" else size)
+
+class HTTPStatusError(IOError):
+    """
+    Error for a server response with an unexpected HTTP status code.
+
+    Attributes:
+        url (str): URL of the request.
+        status (int): HTTP status code of the response.
+        reason (str): Reason phrase of the response.
+        retry_after (float): Delay in seconds that the server requested with a Retry-After header, or None.
+    """
+
+    def __init__(self, url, status, reason = "", retry_after = None):
+        """Initialize the error with the URL, status code and reason phrase of the response."""
+
+        IOError.__init__(self, "HTTP error " + str(status) + " " + reason + " for " + repr(url) + ".")
+
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+class InvalidFileError(IOError):
+    """
+    Error for a downloaded file that is not a valid JPEG file, for example an HTML error page or a truncated image.
+
+    Attributes:
+        url (str): URL of the download.
+        problem (str): Description of the problem.
+    """
+
+    def __init__(self, url, problem):
+        """Initialize the error with the URL of the download and a description of the problem."""
+
+        IOError.__init__(self, "Invalid file " + repr(url) + ": " + problem)
+
+        self.url = url
+        self.problem = problem
+
+class CircuitOpenError(IOError):
+    """
+    Error for a download that has not been attempted because its host has failed too often.
+
+    Attributes:
+        url (str): URL of the download.
+    """
+
+    def __init__(self, url):
+        """Initialize the error with the URL of the download."""
+
+        IOError.__init__(self, "Host of " + repr(url) + " is unavailable after repeated failures.")
+
+        self.url = url
+
+class DiskSpaceError(IOError):
+    """
+    Error for a download that has not been started because the download directory does not have enough free space.
+
+    Attributes:
+        url (str): URL of the download.
+        required (int): Number of bytes the download needs, or the low-water mark if the download waited for space in vain.
+        available (int): Number of free bytes that are not reserved by other downloads.
+    """
+
+    def __init__(self, url, required, available):
+        """Initialize the error with the URL of the download, the required and the available space."""
+
+        IOError.__init__(self, "Not enough free space for " + repr(url) + ": " + str(required) + " bytes required, " + \
+            str(available) + " bytes available.")
+
+        self.url = url
+        self.required = required
+        self.available = available
+
+class HTTPConnectionPool:
+    """
+    Keep HTTP connections alive and reuse them for subsequent requests to the same host.
+
+    Connections are pooled per (scheme, host, port). Idle connections are closed after `idle_timeout` seconds,
+    and no more than `max_per_host` connections are opened to the same host. Requests for a host whose connections
+    are all in use wait until a connection is released. The pool may be shared between threads.
+
+    Attributes:
+        max_per_host (int): Maximum number of open connections per host.
+        idle_timeout (float): Time in seconds after which an idle connection is closed.
+        timeout (float): Socket timeout in seconds for new connections.
+        connections_opened (int): Number of connections that have been opened.
+        connections_reused (int): Number of requests that have been sent over an already open connection.
+        connections_evicted (int): Number of idle connections that have been closed after `idle_timeout`.
+    """
+
+    # Redirects are followed up to this depth.
+    max_redirects = 10
+
+    # Bodies of responses that are closed before they are read completely are drained up to this size to keep the connection alive.
+    max_drain_size = 64 * 1024
+
+    def __init__(self, max_per_host = 8, idle_timeout = 30.0, timeout = 60.0):
+        """
+        Initialize an empty connection pool.
+
+        Args:
+            max_per_host (int): Maximum number of open connections per host.
+            idle_timeout (float): Time in seconds after which an idle connection is closed.
+            timeout (float): Socket timeout in seconds for new connections.
+
+        Example:
+            pool = HTTPConnectionPool(max_per_host = 4)
+
+        Raises:
+            ValueError: If `max_per_host` is smaller than 1.
+        """
+
+        import threading
+
+        if max_per_host < 1:
+            raise ValueError("The number of connections per host must be at least 1, got " + repr(max_per_host) + ".")
+
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.connections_evicted = 0
+
+        # Idle connections per host as a list of (connection, time of release) pairs, the most recently released last.
+        self.idle = {}
+
+        # Number of open connections per host, both idle and in use.
+        self.open = {}
+
+        self.condition = threading.Condition()
+
+        # The SSL context is created on first use, so that plain HTTP downloads do not have to load the ssl module.
+        self.context = None
+
+    def __str__(self):
+        """Return a one-line summary of the connection counters."""
+        return "Connections: " + str(self.connections_opened) + " opened, " + str(self.connections_reused) + " reused."
+
+    def urlopen(self, url, headers = None, method = "GET"):
+        """
+        Send a request for `url` and follow redirects.
+
+        Args:
+            url (str): HTTP or HTTPS URL of the resource.
+            headers (dict): Additional request headers.
+            method (str): HTTP method of the request.
+
+        Returns:
+            PooledResponse: The response of the final request. Its connection is returned to the pool when the response is closed.
+
+        Raises:
+            IOError: If the connection fails or there are too many redirects.
+        """
+
+        try:
+            from urlparse import urljoin
+        except ImportError:
+            from urllib.parse import urljoin
+
+        # Connection times of all requests, including redirects.
+        dns_time = connect_time = None
+
+        for _ in range(self.max_redirects + 1):
+            response = self.request(method, url, headers)
+
+            if response.dns_time is not None:
+                dns_time = (dns_time or 0) + response.dns_time
+                connect_time = (connect_time or 0) + response.connect_time
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("location"):
+                response.close()
+                url = urljoin(url, response.getheader("location"))
+                continue
+
+            response.dns_time = dns_time
+            response.connect_time = connect_time
+
+            return response
+
+        raise IOError("Too many redirects for " + repr(url) + ".")
+
+    def request(self, method, url, headers = None):
+        """
+        Send a single request for `url` over a pooled connection.
+
+        If a reused connection turns out to be closed by the server, the request is sent once more over a new connection.
+
+        Args:
+            method (str): HTTP method of the request.
+            url (str): HTTP or HTTPS URL of the resource.
+            headers (dict): Additional request headers.
+
+        Returns:
+            PooledResponse: The response. Its connection is returned to the pool when the response is closed.
+
+        Raises:
+            IOError: If the URL is not a valid HTTP(S) URL, the request cannot be sent or the connection fails.
+        """
+
+        import socket
+
+        try:
+            import httplib as http_client
+        except ImportError:
+            import http.client as http_client
+
+        try:
+            from urlparse import urlsplit
+        except ImportError:
+            from urllib.parse import urlsplit
+
+        # Malformed URLs, for example with a port that is not a number, fail like unreachable hosts.
+        try:
+            parts = urlsplit(url)
+            port = parts.port
+        except ValueError as e:
+            raise IOError("Invalid URL " + repr(url) + ": " + str(e))
+
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise IOError("Unsupported URL " + repr(url) + ".")
+
+        key = (parts.scheme, parts.hostname, port or (443 if parts.scheme == "https" else 80))
+        path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+
+        request_headers = {"User-Agent": "BatchJPEGDownloader"}
+        request_headers.update(headers or {})
+
+        while True:
+            connection, reused = self.acquire(key)
+            dns_time = connect_time = None
+
+            try:
+                if not reused:
+                    dns_time, connect_time = self.connect(key, connection)
+
+                connection.request(method, path, headers = request_headers)
+                response = connection.getresponse()
+            except (http_client.HTTPException, socket.error) as e:
+                self.discard(key, connection)
+
+                # The server may have closed an idle connection in the meantime. Retry once on a new connection.
+                if reused:
+                    continue
+
+                if isinstance(e, IOError):
+                    raise
+
+                raise IOError("Request for " + repr(url) + " failed: " + repr(e))
+            except (ValueError, UnicodeError) as e:
+                # http.client rejects paths and headers that cannot be sent, for example paths with non-ASCII characters.
+                self.discard(key, connection)
+
+                raise IOError("Invalid request for " + repr(url) + ": " + str(e))
+            except BaseException:
+                self.discard(key, connection)
+                raise
+
+            pooled_response = PooledResponse(self, key, connection, response, url)
+            pooled_response.dns_time = dns_time
+            pooled_response.connect_time = connect_time
+
+            # The Content-Length of a response to a HEAD request describes the resource, the response itself has no body.
+            if method == "HEAD":
+                pooled_response.length = 0
+
+            return pooled_response
+
+    def connect(self, key, connection):
+        """
+        Resolve the host of `key` and connect `connection` to it, measuring both steps separately.
+
+        The connection of http.client would do the same on its first request, but without telling how long each step took.
+
+        Returns:
+            tuple: Time in seconds for the name resolution and for establishing the connection, including the TLS handshake.
+
+        Raises:
+            socket.error: If the host cannot be resolved or no connection can be established.
+        """
+
+        import socket
+        import time
+
+        scheme, host, port = key
+
+        start = time.time()
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        resolved = time.time()
+
+        error = None
+
+        # Try all addresses of the host, like socket.create_connection does.
+        for family, socket_type, protocol, _, address in addresses:
+            sock = socket.socket(family, socket_type, protocol)
+
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(address)
+                break
+            except socket.error as e:
+                sock.close()
+                error = e
+        else:
+            raise error or socket.error("Cannot resolve " + repr(host) + ".")
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if scheme == "https":
+            sock = self.ssl_context().wrap_socket(sock, server_hostname = host)
+
+        connection.sock = sock
+
+        return resolved - start, time.time() - resolved
+
+    def ssl_context(self):
+        """Return the SSL context for HTTPS connections, which is created on first use."""
+
+        with self.condition:
+            if self.context is None:
+                import ssl
+
+                self.context = ssl.create_default_context()
+
+            return self.context
+
+    def acquire(self, key):
+        """
+        Take an idle connection for `key` from the pool or open a new one.
+
+        Waits if `max_per_host` connections to the host are already in use.
+
+        Returns:
+            tuple: The connection and a flag that is True if the connection has been used before.
+        """
+
+        try:
+            import httplib as http_client
+        except ImportError:
+            import http.client as http_client
+
+        with self.condition:
+            while True:
+                self.evict(key)
+
+                idle = self.idle.get(key)
+
+                if idle:
+                    connection, _ = idle.pop()
+                    self.connections_reused += 1
+                    return connection, True
+
+                if self.open.get(key, 0) < self.max_per_host:
+                    self.open[key] = self.open.get(key, 0) + 1
+                    self.connections_opened += 1
+                    break
+
+                self.condition.wait()
+
+        scheme, host, port = key
+
+        if scheme == "https":
+            connection = http_client.HTTPSConnection(host, port, timeout = self.timeout)
+        else:
+            connection = http_client.HTTPConnection(host, port, timeout = self.timeout)
+
+        return connection, False
+
+    def release(self, key, connection):
+        """Return a connection whose response has been read completely to the pool of idle connections."""
+
+        import time
+
+        with self.condition:
+            self.idle.setdefault(key, []).append((connection, time.time()))
+            self.condition.notify()
+
+    def discard(self, key, connection):
+        """Close a connection that cannot be reused and allow a new connection to the host."""
+
+        connection.close()
+
+        with self.condition:
+            self.open[key] -= 1
+            self.condition.notify()
+
+    def evict(self, key):
+        """Close the idle connections for `key` that have not been used for `idle_timeout` seconds. The caller must hold the condition."""
+
+        import time
+
+        idle = self.idle.get(key)
+
+        if not idle:
+            return
+
+        deadline = time.time() - self.idle_timeout
+
+        # The oldest connections are at the front of the list.
+        while idle and idle[0][1] < deadline:
+            connection, _ = idle.pop(0)
+            connection.close()
+            self.open[key] -= 1
+            self.connections_evicted += 1
+
+    def close(self):
+        """Close all idle connections."""
+
+        with self.condition:
+            for key, idle in self.idle.items():
+                for connection, _ in idle:
+                    connection.close()
+                    self.open[key] -= 1
+
+            self.idle = {}
+            self.condition.notify_all()
+
+class PooledResponse:
+    """
+    Response of a request sent by HTTPConnectionPool.
+
+    The response must be closed after use, so that its connection can be reused. It may be used in a with statement.
+
+    Attributes:
+        url (str): URL of the request.
+        status (int): HTTP status code.
+        reason (str): Reason phrase.
+        dns_time (float): Time in seconds for resolving the host name, None if the connection has been reused.
+        connect_time (float): Time in seconds for establishing the connection, None if the connection has been reused.
+    """
+
+    def __init__(self, pool, key, connection, response, url):
+        """Wrap the response of `connection`, which belongs to `pool` under `key`."""
+
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.bytes_read = 0
+        self.dns_time = None
+        self.connect_time = None
+
+        # Expected length of the body, if the server announced it.
+        length = response.getheader("content-length")
+        self.length = int(length) if length is not None and length.strip().isdigit() else None
+
+    def getheader(self, name, default = None):
+        """Return the value of the response header `name` or `default` if it is missing."""
+        return self.response.getheader(name, default)
+
+    @property
+    def headers(self):
+        """Response headers as a dictionary with lower-case names."""
+        return dict((name.lower(), value) for name, value in self.response.getheaders())
+
+    def read(self, size = None):
+        """
+        Read at most `size` bytes of the response body, or the remaining body if `size` is None.
+
+        Raises:
+            IOError: If the connection is closed before the end of the body.
+        """
+
+        try:
+            import httplib as http_client
+        except ImportError:
+            import http.client as http_client
+
+        try:
+            if size is None:
+                data = self.response.read()
+            else:
+                data = self.response.read(size)
+        except http_client.HTTPException as e:
+            raise IOError("Failed to read the response body of " + repr(self.url) + ": " + repr(e))
+
+        self.bytes_read += len(data)
+
+        # http.client does not report a connection that is closed before the end of the body, so check the length here.
+        if (not data or size is None) and self.length is not None and self.bytes_read < self.length:
+            raise IOError("Connection closed after " + str(self.bytes_read) + " of " + str(self.length) + \
+                " bytes of " + repr(self.url) + ".")
+
+        return data
+
+    def close(self):
+        """Return the connection to the pool if the response has been read completely, and close it otherwise."""
+
+        if self.connection is None:
+            return
+
+        connection = self.connection
+        self.connection = None
+
+        try:
+            # Read the rest of short bodies, such as redirects or error pages, to keep the connection alive.
+            if not self.response.isclosed():
+                if self.length is not None and self.length <= self.pool.max_drain_size:
+                    self.response.read()
+
+            reusable = self.response.isclosed() and not self.response.will_close
+        except Exception:
+            reusable = False
+
+        if reusable:
+            self.pool.release(self.key, connection)
+        else:
+            self.pool.discard(self.key, connection)
+
+    def __enter__(self):
+        """Return the response itself."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the response when leaving the with statement."""
+        self.close()
+
+class URLLibResponse:
+    """
+    Response for a URL that is not an HTTP(S) URL, for example a file or FTP URL, opened with urllib.
+
+    It has the interface of PooledResponse, so that both kinds of URLs are downloaded in the same way. As such URLs know
+    neither status codes nor Range and conditional requests, the status is always 200 and the body is always the whole file.
+
+    Attributes:
+        url (str): URL of the request.
+        status (int): Always 200.
+        reason (str): Always "OK".
+        headers (dict): Headers that urllib reports for the URL, such as the Content-Type and the Content-Length, with lower-case names.
+        dns_time (float): Always None, the connection times are not measured.
+        connect_time (float): Always None.
+    """
+
+    def __init__(self, url):
+        """
+        Open `url` with urllib.
+
+        Raises:
+            IOError: If the URL cannot be opened.
+        """
+
+        # Load the urllib module.
+        # For compatibility, try both urllib2 (Python 2) and urllib.request (Python 3)
+
+        try:
+            from urllib2 import urlopen
+        except ImportError:
+            from urllib.request import urlopen
+
+        self.url = url
+        self.response = urlopen(url)
+        self.status = 200
+        self.reason = "OK"
+        self.headers = dict((name.lower(), value) for name, value in self.response.info().items())
+        self.bytes_read = 0
+        self.dns_time = None
+        self.connect_time = None
+
+    def read(self, size = None):
+        """Read at most `size` bytes of the body, or the remaining body if `size` is None."""
+
+        data = self.response.read() if size is None else self.response.read(size)
+        self.bytes_read += len(data)
+
+        return data
+
+    def close(self):
+        """Close the underlying urllib response."""
+        self.response.close()
+
+    def __enter__(self):
+        """Return the response itself."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the response when leaving the with statement."""
+        self.close()
+
+class AtomicFile:
+    """
+    Write a file under a temporary name and rename it to its final name once it is complete.
+
+    The temporary file is created in the same directory as the final file, so that the rename is atomic.
+    When used in a with statement, the file is renamed if the block succeeds and removed if it raises an exception.
+    Thus, a failed or interrupted download never leaves a truncated file under the final name.
+
+    A partial file has a fixed temporary name instead of a random one. It is kept if the download is aborted
+    after some data has been written, and new data is appended to it, so that an interrupted download can be resumed later.
+
+    Attributes:
+        filename (str): Final name of the file.
+        temporary_filename (str): Name of the file while it is being written.
+        partial (bool): If True, the temporary file is kept when the download is aborted, unless it is empty.
+        size (int): Current size of the temporary file.
+    """
+
+    def __init__(self, filename, partial = False):
+        """
+        Create a new temporary file for `filename` or open the existing partial file.
+
+        Args:
+            filename (str): Final name of the file.
+            partial (bool): If True, open the partial file of `filename` for appending.
+
+        Raises:
+            IOError: If the temporary file cannot be created.
+        """
+
+        import binascii
+        import os
+
+        self.filename = filename
+        self.partial = partial
+
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+
+        if partial:
+            self.temporary_filename = AtomicFile.partial_filename(filename)
+            flags |= os.O_APPEND
+        else:
+            directory, basename = os.path.split(filename)
+
+            # The random part of the name allows several writers for the same file.
+            # Leading dots hide the temporary files on Unix systems.
+            self.temporary_filename = os.path.join(directory, "." + basename + "." + \
+                binascii.hexlify(os.urandom(6)).decode("ascii") + ".part")
+            flags |= os.O_EXCL
+
+        # Unlike tempfile.mkstemp, os.open applies the umask of the user, so the final file gets the usual permissions.
+        descriptor = os.open(self.temporary_filename, flags, 0o666)
+        self.file = os.fdopen(descriptor, "ab" if partial else "wb")
+        self.size = os.fstat(descriptor).st_size
+
+    @staticmethod
+    def partial_filename(filename):
+        """Return the name of the partial file of `filename`."""
+
+        import os
+
+        directory, basename = os.path.split(filename)
+
+        return os.path.join(directory, "." + basename + ".part")
+
+    def truncate(self):
+        """Discard the contents of the temporary file."""
+
+        self.file.seek(0)
+        self.file.truncate()
+        self.size = 0
+
+    def write(self, data):
+        """Append `data` to the temporary file."""
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self, filename = None):
+        """
+        Close the temporary file and atomically rename it to the final name, replacing an existing file.
+
+        Args:
+            filename (str): Name to use instead of the final name, which must be on the same file system.
+        """
+
+        self.file.close()
+        self.rename(self.temporary_filename, filename or self.filename)
+
+    @staticmethod
+    def rename(source, destination):
+        """Atomically rename `source` to `destination`, replacing an existing file."""
+
+        import os
+
+        # os.replace is available from Python 3.3 and also replaces existing files on Windows.
+        try:
+            os.replace(source, destination)
+        except AttributeError:
+            os.rename(source, destination)
+
+    def abort(self):
+        """Close the temporary file and remove it, unless it is a partial file with data to resume from."""
+
+        self.file.close()
+
+        # An empty partial file cannot be resumed from and would only be left behind.
+        if not self.partial or self.size == 0:
+            self.discard()
+
+    def discard(self):
+        """Close and remove the temporary file, even if it is a partial file."""
+
+        import os
+
+        self.file.close()
+
+        try:
+            os.remove(self.temporary_filename)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        """Return the file itself."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Commit the file if the with statement succeeded and abort it otherwise."""
+
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+class DownloadJournal:
+    """
+    Append-only record of the downloads into a directory.
+
+    Each line of the journal file is a JSON object with the URL, the local path, the number of bytes written, 
+    the ETag and Last-Modified validators of the response and the status of the download, 
+    which is one of "started", "partial", "invalid" or "completed". The last line for a URL determines its state.
+    The journal may be shared between threads.
+
+    Attributes:
+        filename (str): Name of the journal file.
+        records (dict): The last record for every URL in the journal.
+    """
+
+    # Name of the journal file in the download directory.
+    default_filename = ".batchjpegdownloader.journal"
+
+    def __init__(self, filename):
+        """
+        Load the existing records of the journal file `filename` and open it for appending.
+
+        Lines that cannot be parsed, such as a line that was cut off by a crash, are ignored.
+
+        Args:
+            filename (str): Name of the journal file. It is created if it does not exist.
+
+        Raises:
+            IOError: If the journal file cannot be opened.
+        """
+
+        import json
+        import threading
+
+        self.filename = filename
+        self.records = {}
+        self.lock = threading.Lock()
+
+        terminated = True
+
+        try:
+            with open(filename, "r") as journal_file:
+                for line in journal_file:
+                    terminated = line.endswith("\n")
+
+                    try:
+                        record = json.loads(line)
+                        self.records[record["url"]] = record
+                    except (ValueError, KeyError, TypeError):
+                        pass
+        except (IOError, OSError):
+            # The journal does not exist yet.
+            pass
+
+        self.file = open(filename, "a")
+
+        # Terminate a line that was cut off, so that the next record starts on a new line.
+        if not terminated:
+            self.file.write("\n")
+
+    def get(self, url):
+        """Return the last record for `url` or None if the URL is not in the journal."""
+        return self.records.get(url)
+
+    def is_completed(self, url):
+        """Return True if the download of `url` has been completed according to the journal."""
+
+        record = self.records.get(url)
+
+        return record is not None and record["status"] == "completed"
+
+    def record(self, url, path, status, size = 0, etag = None, last_modified = None):
+        """
+        Append a record to the journal and flush it to disk.
+
+        Args:
+            url (str): URL of the download.
+            path (str): Local path of the file.
+            status (str): One of "started", "partial", "invalid" or "completed".
+            size (int): Number of bytes written so far.
+            etag (str): ETag header of the response.
+            last_modified (str): Last-Modified header of the response.
+        """
+
+        import json
+
+        record = {"url": url, "path": path, "bytes": size, "etag": etag, "last_modified": last_modified, "status": status}
+        line = json.dumps(record, sort_keys = True) + "\n"
+
+        with self.lock:
+            self.records[url] = record
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        """Close the journal file."""
+        self.file.close()
+
+class DeduplicationIndex:
+    """
+    On-disk index from the SHA-256 digest of a file's content to the first file in the download directory with this content.
+
+    Files whose content is already in the index are not stored again, but hardlinked to the existing file, 
+    or reflinked if the file system does not support hardlinks. The index is an append-only file with one JSON object 
+    per line and may be shared between threads.
+
+    The size and the modification time of a canonical file are recorded with its digest, so that a file that has been 
+    rewritten in the meantime, for example by a forced download or another program, is never linked to. When the downloader
+    rewrites a canonical file itself, the old digest of the path is dropped from the index right away.
+
+    Attributes:
+        filename (str): Name of the index file.
+        directory (str): Directory to which the paths in the index are relative.
+        digests (dict): Relative path of the canonical file for every digest.
+        paths (dict): Digest of every canonical file by its relative path.
+        stamps (dict): Size and modification time of the canonical file for every digest, None for entries of older indexes.
+        files_linked (int): Number of files that have been linked to an existing file.
+        bytes_saved (int): Disk space in bytes that has been saved by linking.
+    """
+
+    # Name of the index file in the download directory.
+    default_filename = ".batchjpegdownloader.digests"
+
+    def __init__(self, filename, directory):
+        """
+        Load the existing index file `filename` and open it for appending.
+
+        Args:
+            filename (str): Name of the index file. It is created if it does not exist.
+            directory (str): Directory to which the paths in the index are relative.
+
+        Raises:
+            IOError: If the index file cannot be opened.
+        """
+
+        import json
+        import threading
+
+        self.filename = filename
+        self.directory = directory
+        self.digests = {}
+        self.paths = {}
+        self.stamps = {}
+        self.files_linked = 0
+        self.bytes_saved = 0
+        self.lock = threading.Lock()
+
+        # Later lines override earlier ones, and a line without a path removes the path of its digest.
+        try:
+            with open(filename, "r") as index_file:
+                for line in index_file:
+                    try:
+                        entry = json.loads(line)
+                        digest = entry["digest"]
+
+                        if entry["path"] is None:
+                            self.remove(digest)
+                        else:
+                            self.remove(digest)
+                            self.remove(self.paths.get(entry["path"]))
+                            self.digests[digest] = entry["path"]
+                            self.paths[entry["path"]] = digest
+                            self.stamps[digest] = (entry["size"], entry["mtime"]) if "mtime" in entry else None
+                    except (ValueError, KeyError, TypeError):
+                        pass
+        except (IOError, OSError):
+            # The index does not exist yet.
+            pass
+
+        self.file = open(filename, "a")
+
+    def __str__(self):
+        """Return a one-line summary of the savings."""
+        return "Deduplicated " + str(self.files_linked) + " files, saved " + str(self.bytes_saved) + " bytes."
+
+    def lookup(self, digest, size):
+        """
+        Return the path of the canonical file with the given digest, or None if there is no such file.
+
+        Entries whose file has been removed or has changed its size or its modification time are dropped.
+        """
+
+        import os
+
+        with self.lock:
+            path = self.digests.get(digest)
+            stamp = self.stamps.get(digest)
+
+        if path is None:
+            return None
+
+        filename = os.path.join(self.directory, path)
+
+        try:
+            stat = os.stat(filename)
+
+            if stat.st_size == size and (stamp is None or stamp == (stat.st_size, stat.st_mtime)):
+                return filename
+        except OSError:
+            pass
+
+        with self.lock:
+            if self.digests.get(digest) == path:
+                self.remove(digest)
+
+        return None
+
+    def add(self, digest, filename):
+        """Register the committed file `filename` as the canonical file for `digest`, replacing the old digest of its path."""
+
+        import json
+        import os
+
+        path = os.path.relpath(filename, self.directory)
+        stat = os.stat(filename)
+        line = json.dumps({"digest": digest, "path": path, "size": stat.st_size, "mtime": stat.st_mtime}, sort_keys = True) + "\n"
+
+        with self.lock:
+            self.remove(digest)
+            self.remove(self.paths.get(path))
+            self.digests[digest] = path
+            self.paths[path] = digest
+            self.stamps[digest] = (stat.st_size, stat.st_mtime)
+            self.file.write(line)
+            self.file.flush()
+
+    def forget(self, filename):
+        """Drop the digest of `filename` from the index, because the file has been replaced with other content."""
+
+        import json
+        import os
+
+        path = os.path.relpath(filename, self.directory)
+
+        with self.lock:
+            digest = self.paths.get(path)
+
+            if digest is None:
+                return
+
+            self.remove(digest)
+            self.file.write(json.dumps({"digest": digest, "path": None}, sort_keys = True) + "\n")
+            self.file.flush()
+
+    def remove(self, digest):
+        """Remove `digest` and its path from the dictionaries of the index. The caller must hold the lock."""
+
+        path = self.digests.pop(digest, None)
+        self.stamps.pop(digest, None)
+
+        if path is not None and self.paths.get(path) == digest:
+            del self.paths[path]
+
+    def link(self, source, destination, size):
+        """
+        Atomically replace `destination` with a hardlink or a reflink to `source`.
+
+        Args:
+            source (str): The canonical file.
+            destination (str): The duplicate file.
+            size (int): Size of the file, counted as saved disk space on success.
+
+        Returns:
+            bool: True if the link has been created, False if neither hardlinks nor reflinks are supported.
+        """
+
+        import binascii
+        import os
+
+        directory, basename = os.path.split(destination)
+        temporary_filename = os.path.join(directory, "." + basename + "." + binascii.hexlify(os.urandom(6)).decode("ascii") + ".link")
+
+        try:
+            os.link(source, temporary_filename)
+        except (OSError, AttributeError):
+            if not DeduplicationIndex.reflink(source, temporary_filename):
+                return False
+
+        try:
+            AtomicFile.rename(temporary_filename, destination)
+        except OSError:
+            os.remove(temporary_filename)
+            return False
+
+        with self.lock:
+            self.files_linked += 1
+            self.bytes_saved += size
+
+        return True
+
+    @staticmethod
+    def reflink(source, destination):
+        """
+        Create `destination` as a copy-on-write clone of `source`.
+
+        Reflinks are supported on Linux by file systems like Btrfs and XFS.
+
+        Returns:
+            bool: True if the clone has been created.
+        """
+
+        import os
+
+        try:
+            import fcntl
+        except ImportError:
+            return False
+
+        # ioctl request code of FICLONE on Linux
+        FICLONE = 0x40049409
+
+        try:
+            with open(source, "rb") as source_file:
+                with open(destination, "wb") as destination_file:
+                    fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except (IOError, OSError):
+            try:
+                os.remove(destination)
+            except OSError:
+                pass
+
+            return False
+
+        return True
+
+    def close(self):
+        """Close the index file."""
+        self.file.close()
+
+class JPEGValidator:
+    """
+    Check a downloaded file for the signs of a complete JPEG image while it is being streamed.
+
+    The Content-Type header must be a JPEG type if it is present, the file must start with the start of image marker
+    and end with the end of image marker, and its size must match the Content-Length header. Only the first and the
+    last two bytes of the body are kept, so the check costs constant time per block and never reads the file again.
+
+    Attributes:
+        error (str): Description of the first problem that has been found, None if the file is valid so far.
+        expected_size (int): Size of the complete file according to the Content-Length header, or None.
+    """
+
+    # Media types of JPEG files. Other types, such as 'text/html' for error pages, are rejected.
+    content_types = ("image/jpeg", "image/jpg", "image/pjpeg")
+
+    # Start of image and end of image markers.
+    start_marker = b"\xff\xd8"
+    end_marker = b"\xff\xd9"
+
+    def __init__(self, headers, offset = 0, head = b""):
+        """
+        Start the validation of a response.
+
+        Args:
+            headers (dict): Response headers with lower-case names.
+            offset (int): Number of bytes of the file that have been downloaded in an earlier run.
+            head (bytes): The first bytes of the partial file from an earlier run.
+        """
+
+        self.error = None
+
+        content_type = headers.get("content-type", "").split(";")[0].strip().lower()
+
+        if content_type and content_type not in self.content_types:
+            self.error = "Content-Type " + repr(content_type) + " is not a JPEG type."
+
+        length = headers.get("content-length", "").strip()
+        self.expected_size = offset + int(length) if length.isdigit() else None
+
+        self.head = head[:2]
+        self.tail = head[-2:]
+
+    def update(self, block):
+        """Keep the first and the last two bytes of the file up to date after `block` has been written."""
+
+        if len(self.head) < 2:
+            self.head = (self.head + block[:2])[:2]
+
+        self.tail = (self.tail + block[-2:])[-2:]
+
+    def check(self, size):
+        """
+        Finish the validation of a file of `size` bytes.
+
+        Returns:
+            str: Description of the first problem, or None if the file is valid.
+        """
+
+        if self.error is not None:
+            return self.error
+
+        if self.expected_size is not None and size != self.expected_size:
+            return "Received " + str(size) + " of " + str(self.expected_size) + " bytes."
+
+        if self.head != self.start_marker:
+            return "File does not start with a JPEG start of image marker."
+
+        if self.tail != self.end_marker:
+            return "File does not end with a JPEG end of image marker."
+
+        return None
+
+class FileTransfer:
+    """
+    State of the download of a single file, shared by the download engines.
+
+    The engine sends a request for `url` with the headers in `request_headers`, passes the status and the headers of the response
+    to start(), every block of the body to write() if start() returns True, and finally calls finish(), or abort() if anything fails.
+    With admission control, the engine calls admit() before the request and waits for the returned delays until it returns None.
+    In resume mode, the transfer continues a partial file from an earlier run with a Range request.
+    In refresh mode, an existing file is requested with the validators from the journal and kept if the server answers 304.
+    With deduplication or a manifest, the content is hashed while it is written. 
+    With deduplication, a duplicate of an existing file is replaced by a link.
+    With validation, files that are not valid JPEG files are deleted or moved to the quarantine directory instead of being stored.
+
+    Attributes:
+        url (str): URL to the source.
+        filename (str): Local path where the file is stored.
+        request_headers (dict): Additional headers for the request.
+        offset (int): Number of bytes that are already in the partial file and have been requested with a Range header.
+        conditional (bool): True if the request contains If-None-Match or If-Modified-Since headers.
+        output_file (AtomicFile): The file that is being written, None before start() and for unmodified files.
+        hash (object): SHA-256 hash of the content written so far, None if no digest is required.
+        digest (str): Hexadecimal SHA-256 digest of the stored file after finish(), None if no digest is required.
+        size (int): Size of the stored file after finish(), None before.
+        validator (JPEGValidator): Validator of the content written so far, None if validation is disabled.
+        content (list): Blocks of the content that are kept in memory for the thumbnails, None if they are not kept.
+        thumbnail_bytes (int): Memory in bytes that the thumbnail generator has reserved for `content`. It is handed
+            over to the generator together with the content after finish() and released by abort().
+        admitted (bool): True while the transfer holds a slot of the admission control.
+        admission_time (float): Time in seconds the transfer has waited for admission, None without admission control.
+        reserved_space (int): Space in bytes on the output volume that the admission control has reserved for the file 
+            and that has not been written yet. It shrinks with every block written, and the rest is released at the end.
+    """
+
+    def __init__(self, downloader, url, filename):
+        """
+        Prepare the download of `url` to `filename` for `downloader`.
+
+        Args:
+            downloader (BatchDownloader): The downloader that owns the transfer.
+            url (str): URL to the source.
+            filename (str): Local path where the file is stored.
+        """
+
+        import os
+
+        self.downloader = downloader
+        self.url = url
+        self.filename = filename
+        self.request_headers = {}
+        self.offset = 0
+        self.output_file = None
+        self.etag = None
+        self.last_modified = None
+        self.conditional = False
+        self.hash = None
+        self.digest = None
+        self.size = None
+        self.validator = None
+        self.content = None
+        self.admitted = False
+        self.admission_time = None
+        self.waiting_since = None
+        self.thumbnail_bytes = 0
+        self.reserved_space = 0
+
+        journal = downloader.journal
+        record = journal.get(url) if journal is not None else None
+
+        if record is not None and record["status"] == "completed":
+            # Ask the server to send the file only if it has changed since the last download.
+            if downloader.refresh and not downloader.default_overwrite and os.path.isfile(filename):
+                self.etag = record.get("etag")
+                self.last_modified = record.get("last_modified")
+
+                if self.etag:
+                    self.request_headers["If-None-Match"] = self.etag
+
+                if self.last_modified:
+                    self.request_headers["If-Modified-Since"] = self.last_modified
+
+                self.conditional = bool(self.etag or self.last_modified)
+        elif record is not None and downloader.resume:
+            # Resume only if the server can tell us whether the file has changed in the meantime.
+            # Weak ETags must not be used in an If-Range header.
+            etag = record.get("etag")
+
+            if etag and not etag.startswith("W/"):
+                validator = etag
+            else:
+                validator = record.get("last_modified")
+
+            try:
+                size = os.path.getsize(AtomicFile.partial_filename(filename))
+            except OSError:
+                size = 0
+
+            if validator and size > 0:
+                self.offset = size
+                self.request_headers["Range"] = "bytes=" + str(size) + "-"
+                self.request_headers["If-Range"] = validator
+
+    def admit(self):
+        """
+        Ask the admission control of the downloader for an open file slot before the request is sent.
+
+        Returns:
+            float: None if the request may be sent, or the time in seconds to wait before calling admit() again.
+
+        Raises:
+            DiskSpaceError: If the transfer has waited for free space for longer than the admission control allows.
+        """
+
+        import time
+
+        admission = self.downloader.admission
+
+        if admission is None or self.admitted:
+            return None
+
+        now = time.time()
+        delay = admission.acquire(self.url, self.waiting_since)
+
+        if delay is None:
+            self.admitted = True
+            self.admission_time = now - self.waiting_since if self.waiting_since is not None else 0.0
+        elif self.waiting_since is None:
+            self.waiting_since = now
+
+        return delay
+
+    def start(self, status, reason, headers):
+        """
+        Check the response status and open the output file.
+
+        Args:
+            status (int): HTTP status code of the response.
+            reason (str): Reason phrase of the response.
+            headers (dict): Response headers with lower-case names.
+
+        Returns:
+            bool: True if the response body has to be written, False if the file has not been modified.
+
+        Raises:
+            HTTPStatusError: If the status code is neither 200, nor 206 for a Range request, nor 304 for a conditional request.
+            InvalidFileError: If invalid files are deleted and the Content-Type is not a JPEG type.
+            IOError: If a partial response does not continue the partial file or the output file cannot be created.
+            DiskSpaceError: If the file does not fit into the free space of the download directory.
+        """
+
+        import os
+
+        journal = self.downloader.journal
+
+        if status == 304 and self.conditional:
+            return False
+
+        if status == 206 and self.offset > 0:
+            if not headers.get("content-range", "").startswith("bytes " + str(self.offset) + "-"):
+                raise IOError("Unexpected Content-Range " + repr(headers.get("content-range")) + " for " + repr(self.url) + ".")
+        elif status == 200:
+            # The server sends the whole file, either because it ignores Range requests or because the file has changed.
+            self.offset = 0
+        else:
+            if status == 416 and self.offset > 0:
+                # The partial file does not match the file on the server, start from scratch next time.
+                try:
+                    os.remove(AtomicFile.partial_filename(self.filename))
+                except OSError:
+                    pass
+
+            raise HTTPStatusError(self.url, status, reason, RetryPolicy.parse_retry_after(headers.get("retry-after")))
+
+        self.etag = headers.get("etag")
+        self.last_modified = headers.get("last-modified")
+
+        if self.downloader.validate is not None:
+            self.validator = JPEGValidator(headers, self.offset)
+
+            # There is no need to download a file that will be deleted anyway.
+            if self.validator.error is not None and self.downloader.validate == "delete":
+                raise InvalidFileError(self.url, self.validator.error)
+
+        length = headers.get("content-length", "").strip()
+
+        # Reserve the space for the body, so that a file that does not fit fails before anything is written.
+        if self.admitted:
+            size = int(length) if length.isdigit() else 0
+            self.downloader.admission.reserve(self.url, size)
+            self.reserved_space = size
+
+        self.output_file = AtomicFile(self.filename, partial = self.downloader.resume)
+
+        if self.offset == 0:
+            self.output_file.truncate()
+        elif self.output_file.size != self.offset:
+            raise IOError("Partial file of " + repr(self.filename) + " has changed during the download.")
+
+        # The validator needs the start of the file, which is in the partial file from the earlier run.
+        if self.validator is not None and self.offset > 0:
+            with open(self.output_file.temporary_filename, "rb") as partial_file:
+                self.validator.update(partial_file.read(2))
+
+        if self.downloader.deduplication_index is not None or self.downloader.manifest is not None:
+            import hashlib
+
+            self.hash = hashlib.sha256()
+
+            # The digest covers the whole file, so the part from an earlier run has to be hashed once.
+            if self.offset > 0:
+                with open(self.output_file.temporary_filename, "rb") as partial_file:
+                    for block in iter(lambda: partial_file.read(self.downloader.buffer_size), b""):
+                        self.hash.update(block)
+
+        # Keep the content in memory for the thumbnails if its size is known and the memory limit allows it.
+        thumbnails = self.downloader.thumbnails
+
+        if thumbnails is not None and self.offset == 0 and length.isdigit() and thumbnails.reserve(int(length)):
+            self.content = []
+            self.thumbnail_bytes = int(length)
+
+        if journal is not None:
+            journal.record(self.url, self.filename, "started", self.offset, self.etag, self.last_modified)
+
+        return True
+
+    def write(self, block):
+        """Write a block of the response body to the output file."""
+        self.output_file.write(block)
+
+        if self.hash is not None:
+            self.hash.update(block)
+
+        if self.validator is not None:
+            self.validator.update(block)
+
+        if self.content is not None:
+            self.content.append(block)
+
+        if self.admitted:
+            reserved = min(len(block), self.reserved_space)
+            self.reserved_space -= reserved
+            self.downloader.admission.consume(len(block), reserved)
+
+    def finish(self):
+        """
+        Rename the output file to its final name.
+
+        With deduplication, a file whose content is already in the download directory is linked to the existing file instead.
+
+        Returns:
+            str: "downloaded", or "not_modified" if the server answered a conditional request with 304.
+
+        Raises:
+            InvalidFileError: If the file is not a valid JPEG file.
+        """
+
+        # The body has been written completely, so the slot and the rest of the reservation are not needed any more.
+        self.release_admission()
+
+        if self.output_file is None:
+            return "not_modified"
+
+        if self.validator is not None:
+            problem = self.validator.check(self.output_file.size)
+
+            if problem is not None:
+                self.reject(problem)
+
+        index = self.downloader.deduplication_index
+        self.size = self.output_file.size
+
+        if self.hash is not None:
+            self.digest = self.hash.hexdigest()
+
+        if index is None:
+            self.output_file.commit()
+        else:
+            digest = self.digest
+            canonical = index.lookup(digest, self.output_file.size)
+
+            if canonical is not None and canonical != self.filename and index.link(canonical, self.filename, self.output_file.size):
+                self.output_file.discard()
+
+                # The path may have been the canonical file of its previous content, which it no longer has.
+                index.forget(self.filename)
+            else:
+                self.output_file.commit()
+                index.add(digest, self.filename)
+
+        journal = self.downloader.journal
+
+        if journal is not None:
+            journal.record(self.url, self.filename, "completed", self.output_file.size, self.etag, self.last_modified)
+
+        thumbnails = self.downloader.thumbnails
+
+        if thumbnails is not None:
+            # The memory that has been reserved for the content is handed over to the thumbnail generator.
+            thumbnails.submit(self.filename, b"".join(self.content) if self.content is not None else None)
+            self.content = None
+            self.thumbnail_bytes = 0
+
+        return "downloaded"
+
+    def reject(self, problem):
+        """
+        Delete an invalid file or move it to the quarantine directory, depending on the validation mode of the downloader.
+
+        In the quarantine directory, the first eight hexadecimal digits of the SHA-1 hash of the URL are appended to the
+        name of the file, such as 'image-3fa2b41c.jpg'.
+
+        Raises:
+            InvalidFileError: Always, with `problem` as the description.
+        """
+
+        import hashlib
+        import os
+
+        output_file = self.output_file
+
+        # The file is done with, so a later abort() must neither keep it as a partial file nor record it as partial.
+        self.output_file = None
+
+        if self.downloader.validate == "quarantine":
+            directory = self.downloader.quarantine_directory
+
+            if not os.path.isdir(directory):
+                try:
+                    os.mkdir(directory)
+                except OSError:
+                    # Another worker may have created the directory in the meantime.
+                    if not os.path.isdir(directory):
+                        raise
+
+            # Files with the same name from different hosts or shards must not overwrite each other in the quarantine.
+            stem, extension = os.path.splitext(os.path.basename(self.filename))
+            output_file.commit(os.path.join(directory, stem + "-" + hashlib.sha1(self.url.encode("utf-8")).hexdigest()[:8] + extension))
+        else:
+            output_file.discard()
+
+        journal = self.downloader.journal
+
+        if journal is not None:
+            journal.record(self.url, self.filename, "invalid", output_file.size, self.etag, self.last_modified)
+
+        raise InvalidFileError(self.url, problem)
+
+    def abort(self):
+        """Close the output file after a failure. A partial file with data is kept, and the transfer is recorded as partial in the journal."""
+
+        self.release_admission()
+
+        if self.thumbnail_bytes > 0:
+            self.downloader.thumbnails.release(self.thumbnail_bytes)
+            self.content = None
+            self.thumbnail_bytes = 0
+
+        if self.output_file is None:
+            return
+
+        self.output_file.abort()
+
+        journal = self.downloader.journal
+
+        if journal is not None:
+            journal.record(self.url, self.filename, "partial", self.output_file.size, self.etag, self.last_modified)
+
+    def release_admission(self):
+        """Release the slot of the admission control and the space that has been reserved but not written, if the transfer holds a slot."""
+
+        if not self.admitted:
+            return
+
+        self.downloader.admission.release(self.reserved_space)
+        self.admitted = False
+        self.reserved_space = 0
+
+class DownloadStatistics:
+    """
+    Aggregated results of a batch download.
+
+    The counters are updated by the download workers and may be shared between threads.
+
+    Attributes:
+        downloaded (int): Number of files that have been downloaded.
+        skipped (int): Number of files that have been skipped because they already existed.
+        not_modified (int): Number of files that have been checked in refresh mode and have not changed on the server.
+        duplicate (int): Number of repeated URLs that have been dropped by deduplication.
+        failed (int): Number of files that could not be downloaded.
+    """
+
+    def __init__(self):
+        """Initialize all counters with zero."""
+
+        import threading
+
+        self.downloaded = 0
+        self.skipped = 0
+        self.not_modified = 0
+        self.duplicate = 0
+        self.failed = 0
+
+        # The lock protects the counters when they are updated by concurrent workers.
+        self.lock = threading.Lock()
+
+    def add(self, status):
+        """
+        Count the result of a single file download.
+
+        Args:
+            status (str): Either "downloaded", "skipped", "not_modified", "duplicate" or "failed".
+        """
+
+        with self.lock:
+            setattr(self, status, getattr(self, status) + 1)
+
+    def merge(self, other):
+        """Add the counters of `other`, for example the statistics of another shard."""
+
+        with self.lock:
+            for status in ("downloaded", "skipped", "not_modified", "duplicate", "failed"):
+                setattr(self, status, getattr(self, status) + getattr(other, status))
+
+    def __getstate__(self):
+        """Return the counters without the lock, so that statistics can be sent between processes."""
+
+        state = self.__dict__.copy()
+        del state["lock"]
+
+        return state
+
+    def __setstate__(self, state):
+        """Restore the counters and create a new lock."""
+
+        import threading
+
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        """Return a one-line summary of the counters."""
+        summary = "Downloaded " + str(self.downloaded) + " files, skipped " + str(self.skipped) + " files, "
+
+        if self.not_modified > 0:
+            summary += str(self.not_modified) + " not modified, "
+
+        if self.duplicate > 0:
+            summary += str(self.duplicate) + " duplicate URLs, "
+
+        return summary + str(self.failed) + " failed."
+
+class DownloadResult:
+    """
+    Result and timing of a single file download, which is passed to the hooks of a downloader.
+
+    Times are measured in seconds. Phases that did not take place, for example the name resolution and the connection 
+    setup on a reused keep-alive connection, are None.
+
+    Attributes:
+        url (str): URL to the source.
+        filename (str): Local path where the file is stored, None for dropped duplicate URLs.
+        status (str): Either "downloaded", "skipped", "not_modified", "duplicate" or "failed".
+        size (int): Number of bytes of the response body that have been received.
+        file_size (int): Size of the stored file, which includes the part of a resumed file from an earlier run. 
+            None unless the file has been downloaded.
+        sha256 (str): Hexadecimal SHA-256 digest of the stored file if it has been computed, None otherwise.
+        error (str): Error message of a failed download, None otherwise.
+        attempts (int): Number of requests that have been made for the file.
+        started (float): Time stamp of the start of the download.
+        admission_time (float): Time waiting for free space and an open file slot, None without admission control.
+        dns_time (float): Time for resolving the host name.
+        connect_time (float): Time for establishing the connection, including the TLS handshake.
+        first_byte_time (float): Time from sending the request to receiving the response header.
+        transfer_time (float): Time for receiving and storing the response body.
+        duration (float): Total time of the download.
+    """
+
+    def __init__(self, url, filename = None, status = None):
+        """
+        Start the measurement of a download.
+
+        Args:
+            url (str): URL to the source.
+            filename (str): Local path where the file is stored.
+            status (str): Result of the download, if it is already known.
+        """
+
+        import time
+
+        self.url = url
+        self.filename = filename
+        self.status = status
+        self.size = 0
+        self.file_size = None
+        self.sha256 = None
+        self.error = None
+        self.attempts = 0
+        self.started = time.time()
+        self.admission_time = None
+        self.dns_time = None
+        self.connect_time = None
+        self.first_byte_time = None
+        self.transfer_time = None
+        self.duration = None
+
+    def as_dict(self):
+        """Return the attributes as a dictionary, for example for a JSON log."""
+
+        return {"url": self.url, "filename": self.filename, "status": self.status, "size": self.size, \
+            "file_size": self.file_size, "sha256": self.sha256, "error": self.error, \
+            "attempts": self.attempts, "started": self.started, "admission_time": self.admission_time, \
+            "dns_time": self.dns_time, "connect_time": self.connect_time, \
+            "first_byte_time": self.first_byte_time, "transfer_time": self.transfer_time, "duration": self.duration}
+
+class DownloadSummary:
+    """
+    Summary of a batch download, which is available from DownloadResults once all results have been taken.
+
+    Attributes:
+        statistics (DownloadStatistics): Number of downloaded, skipped and failed files.
+        metrics (DownloadMetrics): Aggregated counters and timing histograms of the downloader.
+        duration (float): Time of the download in seconds.
+        message (str): The summary line that download() prints.
+        error (Exception): The error that stopped the download because `keep_going` was not set, None otherwise.
+    """
+
+    def __init__(self, statistics, metrics, duration, message, error = None):
+        """
+        Initialize the summary.
+
+        Args:
+            statistics (DownloadStatistics): Number of downloaded, skipped and failed files.
+            metrics (DownloadMetrics): Aggregated counters and timing histograms of the downloader.
+            duration (float): Time of the download in seconds.
+            message (str): The summary line that download() prints.
+            error (Exception): The error that stopped the download, if any.
+        """
+
+        self.statistics = statistics
+        self.metrics = metrics
+        self.duration = duration
+        self.message = message
+        self.error = error
+
+    def __str__(self):
+        """Return the summary line."""
+        return self.message
+
+    def as_dict(self):
+        """Return the counters, the duration, the error message and the metrics as a dictionary, for example for a JSON report."""
+
+        return {"downloaded": self.statistics.downloaded, "skipped": self.statistics.skipped, \
+            "not_modified": self.statistics.not_modified, "duplicate": self.statistics.duplicate, \
+            "failed": self.statistics.failed, "duration": self.duration, \
+            "error": str(self.error) if self.error is not None else None, "metrics": self.metrics.as_dict()}
+
+class DownloadResults:
+    """
+    Iterator over the results of a batch download that runs in a background thread, as returned by BatchDownloader.results().
+
+    The download starts with the first call of next(). The hooks of the downloader pass every DownloadResult through 
+    a bounded queue, so the downloads wait while the caller does not take further results. If the download stops 
+    because of a failed file, the error is raised after the results of all files in progress. 
+    close(), which is also called at the end of a with statement, stops reading further URLs, 
+    waits until the files in progress have finished and drops their results.
+
+    Attributes:
+        downloader (BatchDownloader): The downloader, which may also be an AsyncBatchDownloader.
+        urls (iterable): The URLs.
+        close_downloader (bool): If True, the downloader is closed together with the iterator.
+        statistics (DownloadStatistics): Counters that are updated during the download.
+        summary (DownloadSummary): Summary of the download, None until all results have been taken or the iterator is closed.
+    """
+
+    # Marks the end of the download in the queue.
+    end = object()
+
+    def __init__(self, downloader, urls, close_downloader = False):
+        """
+        Prepare the download, which starts with the first result that is requested.
+
+        Args:
+            downloader (BatchDownloader): The downloader.
+            urls (iterable): The URLs.
+            close_downloader (bool): If True, the downloader is closed once the iterator is exhausted or closed.
+        """
+
+        import threading
+
+        # For compatibility, try both Queue (Python 2) and queue (Python 3)
+
+        try:
+            import Queue as queue
+        except ImportError:
+            import queue
+
+        self.downloader = downloader
+        self.urls = urls
+        self.close_downloader = close_downloader
+        self.statistics = DownloadStatistics()
+        self.summary = None
+
+        self.queue = queue.Queue(maxsize = downloader.queue_size)
+        self.cancelled = threading.Event()
+        self.thread = None
+        self.started = None
+        self.error = None
+
+    def __iter__(self):
+        """Return the iterator itself."""
+        return self
+
+    def __next__(self):
+        """
+        Wait for the next completed file.
+
+        Returns:
+            DownloadResult: The result of the file.
+
+        Raises:
+            StopIteration: If all files have been downloaded.
+            TypeError: if `urls` is not an iterable object or the entries of `urls` are not of type string.
+            IOError: If a file download has failed and `keep_going` is not set, after all other results.
+        """
+
+        if self.summary is not None:
+            raise StopIteration
+
+        if self.thread is None:
+            self.start()
+
+        result = self.queue.get()
+
+        if result is not DownloadResults.end:
+            return result
+
+        self.finish()
+
+        if self.error is not None:
+            raise self.error
+
+        raise StopIteration
+
+    # Python 2 calls next() instead of __next__().
+    next = __next__
+
+    def __enter__(self):
+        """Return the iterator itself."""
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        """Stop the download."""
+        self.close()
+
+    def start(self):
+        """Register the queue as a hook of the downloader and start the download thread."""
+
+        import threading
+        import time
+
+        self.started = time.time()
+        self.downloader.add_hook(self.queue.put)
+
+        # A daemon thread does not keep the program alive if the caller abandons the iterator.
+        self.thread = threading.Thread(target = self.download)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def download(self):
+        """Run the download in the background thread and mark its end in the queue."""
+
+        try:
+            self.downloader.run(self.urls, self.statistics, self.cancelled)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put(DownloadResults.end)
+
+    def finish(self):
+        """Wait for the download thread, remove the hook, create the summary and close the downloader if requested."""
+
+        import time
+
+        self.thread.join()
+        self.downloader.hooks.remove(self.queue.put)
+
+        self.summary = DownloadSummary(self.statistics, self.downloader.metrics, time.time() - self.started, \
+            self.downloader.summary(self.statistics), self.error)
+
+        if self.close_downloader:
+            self.downloader.close()
+
+    def close(self):
+        """Stop reading further URLs and wait until the files in progress have finished."""
+
+        if self.summary is not None:
+            return
+
+        if self.thread is None:
+            self.summary = DownloadSummary(self.statistics, self.downloader.metrics, 0.0, \
+                self.downloader.summary(self.statistics))
+
+            if self.close_downloader:
+                self.downloader.close()
+
+            return
+
+        self.cancelled.set()
+
+        # Drop the remaining results, so that no worker waits for a free place in the queue.
+        while self.queue.get() is not DownloadResults.end:
+            pass
+
+        self.finish()
+
+class Histogram:
+    """
+    Histogram of durations with logarithmic buckets.
+
+    Each bucket covers a factor of two, so a few dozen counters cover everything from microseconds to hours.
+    Percentiles are estimated by the upper bound of the bucket that contains them.
+
+    Attributes:
+        count (int): Number of values.
+        total (float): Sum of all values.
+        maximum (float): Largest value, None if the histogram is empty.
+        buckets (dict): Number of values per bucket, indexed by the binary exponent of the upper bucket bound.
+    """
+
+    def __init__(self):
+        """Create an empty histogram."""
+        self.count = 0
+        self.total = 0.0
+        self.maximum = None
+        self.buckets = {}
+
+    def add(self, value):
+        """Add a non-negative value to the histogram."""
+
+        import math
+
+        # Values in [2 ** (e - 1), 2 ** e) have the exponent e. Zero has its own bucket.
+        exponent = math.frexp(value)[1] if value > 0 else None
+
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+        self.count += 1
+        self.total += value
+
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def merge(self, other):
+        """Add all values of the histogram `other`."""
+
+        for exponent, count in other.buckets.items():
+            self.buckets[exponent] = self.buckets.get(exponent, 0) + count
+
+        self.count += other.count
+        self.total += other.total
+
+        if other.maximum is not None and (self.maximum is None or other.maximum > self.maximum):
+            self.maximum = other.maximum
+
+    def mean(self):
+        """Return the mean of all values, None if the histogram is empty."""
+        return self.total / self.count if self.count > 0 else None
+
+    def percentile(self, fraction):
+        """
+        Estimate a percentile of the values.
+
+        Args:
+            fraction (float): The percentile as a fraction between 0 and 1, for example 0.99.
+
+        Returns:
+            float: An upper bound of the percentile, None if the histogram is empty.
+        """
+
+        if self.count == 0:
+            return None
+
+        rank = fraction * self.count
+        seen = 0
+
+        for exponent in sorted(self.buckets, key = lambda exponent: -1e9 if exponent is None else exponent):
+            seen += self.buckets[exponent]
+
+            if seen >= rank:
+                return 0.0 if exponent is None else min(2.0 ** exponent, self.maximum)
+
+        return self.maximum
+
+    def as_dict(self):
+        """Return the count, mean, median, 99th percentile and maximum as a dictionary."""
+        return {"count": self.count, "mean": self.mean(), "p50": self.percentile(0.5), "p99": self.percentile(0.99), \
+            "max": self.maximum}
+
+class DownloadMetrics:
+    """
+    Aggregated counters and timing histograms of all downloads.
+
+    An instance is registered as a hook of every downloader and may be read at any time, also while a download is running.
+
+    Attributes:
+        files (dict): Number of files per status.
+        bytes (int): Number of bytes received.
+        retries (int): Number of requests that have been repeated after a failure.
+        histograms (dict): Histograms of the "admission", "dns", "connect", "first_byte", "transfer" and "duration" times 
+            in seconds. The "admission" times are the times that transfers have been held back by the admission control.
+        started (float): Time stamp of the start of the first download, or an earlier time set by the caller, 
+            for example the start of the program.
+        first_request (float): Time stamp of the first request, None until a request has been sent.
+    """
+
+    # Timing attributes of DownloadResult that are collected in histograms.
+    phases = ("admission", "dns", "connect", "first_byte", "transfer", "duration")
+
+    def __init__(self):
+        """Initialize all counters and histograms."""
+
+        import threading
+
+        self.files = {}
+        self.bytes = 0
+        self.retries = 0
+        self.histograms = dict((phase, Histogram()) for phase in self.phases)
+        self.started = None
+        self.first_request = None
+
+        # The lock protects the counters when they are updated by concurrent workers.
+        self.lock = threading.Lock()
+
+    def start(self, total = None):
+        """Record the start of the download, unless a start time has already been set."""
+
+        import time
+
+        if self.started is None:
+            self.started = time.time()
+
+    def record_request(self):
+        """Record the time of the first request. Later requests only cost a comparison."""
+
+        if self.first_request is not None:
+            return
+
+        import time
+
+        with self.lock:
+            if self.first_request is None:
+                self.first_request = time.time()
+
+    @property
+    def time_to_first_request(self):
+        """Time in seconds from `started` to the first request, or None if either is unknown."""
+
+        if self.started is None or self.first_request is None:
+            return None
+
+        return self.first_request - self.started
+
+    def __call__(self, result):
+        """Add a DownloadResult to the counters and histograms."""
+
+        with self.lock:
+            self.files[result.status] = self.files.get(result.status, 0) + 1
+            self.bytes += result.size
+            self.retries += max(result.attempts - 1, 0)
+
+            for phase in self.phases:
+                value = getattr(result, phase if phase == "duration" else phase + "_time")
+
+                if value is not None:
+                    self.histograms[phase].add(value)
+
+    def merge(self, other):
+        """Add the counters and histograms of `other`, for example the metrics of another shard."""
+
+        with self.lock:
+            for status, count in other.files.items():
+                self.files[status] = self.files.get(status, 0) + count
+
+            self.bytes += other.bytes
+            self.retries += other.retries
+
+            for phase in self.phases:
+                self.histograms[phase].merge(other.histograms[phase])
+
+            # The merged metrics start with the earliest start and the earliest request of all shards.
+            for name in ("started", "first_request"):
+                values = [value for value in (getattr(self, name), getattr(other, name)) if value is not None]
+                setattr(self, name, min(values) if values else None)
+
+    def __getstate__(self):
+        """Return the counters and histograms without the lock, so that metrics can be sent between processes."""
+
+        state = self.__dict__.copy()
+        del state["lock"]
+
+        return state
+
+    def __setstate__(self, state):
+        """Restore the counters and histograms and create a new lock."""
+
+        import threading
+
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def as_dict(self):
+        """Return a snapshot of the counters and histogram summaries as a dictionary."""
+
+        with self.lock:
+            return {"files": dict(self.files), "bytes": self.bytes, "retries": self.retries, \
+                "time_to_first_request": self.time_to_first_request, \
+                "times": dict((phase, histogram.as_dict()) for phase, histogram in self.histograms.items())}
+
+class ProgressReporter:
+    """
+    Hook that shows a single, continuously updated progress line with the download rate and the remaining time.
+
+    The line is redrawn at most every `interval` seconds, so the overhead per file is small even at high rates.
+    """
+
+    def __init__(self, stream = None, interval = 0.5):
+        """
+        Create a progress reporter.
+
+        Args:
+            stream (file): Output stream of the progress line. Defaults to the standard output.
+            interval (float): Minimum time in seconds between two updates of the line.
+        """
+
+        import threading
+
+        self.stream = stream
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self, total = None):
+        """
+        Reset the progress at the beginning of a download.
+
+        Args:
+            total (int): Number of URLs to download, if known. The remaining time is only shown if the total is known.
+        """
+
+        import time
+
+        self.total = total
+        self.files = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.last_update = self.started
+
+    def __call__(self, result):
+        """Count a finished file and redraw the progress line if the last update is older than the interval."""
+
+        import time
+
+        with self.lock:
+            self.files += 1
+            self.bytes += result.size
+
+            now = time.time()
+
+            if now - self.last_update >= self.interval:
+                self.last_update = now
+                self.update(now)
+
+    def update(self, now):
+        """Redraw the progress line."""
+
+        import sys
+
+        elapsed = max(now - self.started, 1e-9)
+        rate = self.files / elapsed
+
+        line = str(self.files) + (" of " + str(self.total) if self.total is not None else "") + " files, " + \
+            "%.1f files/s, %.2f MB/s" % (rate, self.bytes / elapsed / 1e6)
+
+        if self.total is not None and rate > 0:
+            remaining = int(max(self.total - self.files, 0) / rate)
+            line += ", ETA %d:%02d:%02d" % (remaining // 3600, remaining // 60 % 60, remaining % 60)
+
+        stream = self.stream or sys.stdout
+        stream.write("\r" + line + "   ")
+        stream.flush()
+
+    def finish(self):
+        """Draw the final state of the progress line and end it."""
+
+        import sys
+        import time
+
+        with self.lock:
+            self.update(time.time())
+            (self.stream or sys.stdout).write("\n")
+
+class JSONLinesLog:
+    """
+    Hook that writes every DownloadResult as a JSON object on a line of its own.
+
+    The log is appended to, so that several runs, for example in resume mode, end up in the same file.
+    """
+
+    def __init__(self, filename):
+        """
+        Open the log file.
+
+        Args:
+            filename (str): Name of the log file.
+
+        Raises:
+            IOError: If the log file cannot be opened.
+        """
+
+        import threading
+
+        self.filename = filename
+        self.file = open(filename, "a")
+        self.lock = threading.Lock()
+
+    def __call__(self, result):
+        """Append a DownloadResult to the log."""
+
+        import json
+
+        line = json.dumps(result.as_dict(), sort_keys = True) + "\n"
+
+        with self.lock:
+            self.file.write(line)
+
+    def finish(self):
+        """Write the buffered lines to the log file at the end of a download."""
+
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        """Close the log file."""
+        self.file.close()
+
+class FailureList:
+    """
+    Hook that appends the URL of every failed download to a list file.
+
+    The file has the format of the input list files, so that the failed URLs can be downloaded again in a later run.
+    """
+
+    def __init__(self, filename):
+        """
+        Open the failures list.
+
+        Args:
+            filename (str): Name of the list file.
+
+        Raises:
+            IOError: If the file cannot be opened.
+        """
+
+        import threading
+
+        self.filename = filename
+        self.file = open(filename, "a")
+        self.lock = threading.Lock()
+
+    def __call__(self, result):
+        """Append the URL of a failed DownloadResult to the list."""
+
+        if result.status != "failed":
+            return
+
+        with self.lock:
+            self.file.write(result.url + "\n")
+            self.file.flush()
+
+    def close(self):
+        """Close the list file."""
+        self.file.close()
+
+class DownloadManifest:
+    """
+    Hook that appends a record for every file of a download to a manifest, so that later jobs know what has changed 
+    without scanning and hashing the download directory.
+
+    A record holds the URL, the path relative to the download directory, the size, the SHA-256 digest, which is computed
+    while the file is streamed, the time stamp at which the file was done and the status of the file. Dropped duplicate 
+    URLs are not recorded. The manifest is either a CSV file with a header line or a JSON-lines file. It is appended to 
+    by every run and flushed at least every `flush_interval` seconds, so that other programs can follow it during a download.
+
+    If a previous manifest is given, every downloaded file is compared with the latest record of its path in the previous
+    manifest, and the change is recorded as "added", "changed" or "unchanged". In diff mode, only files that have been 
+    added or changed are recorded. The previous manifest may be the manifest itself, which then lists the changes since
+    its last records.
+
+    Attributes:
+        filename (str): Name of the manifest file.
+        directory (str): Download directory, to which the paths are relative.
+        format (str): Either "csv" or "jsonl".
+        previous (dict): Latest SHA-256 digest of every path of the previous manifest, None without a previous manifest.
+        diff (bool): If True, only added and changed files are recorded.
+        flush_interval (float): Maximum time in seconds that records stay in the buffer.
+        added (int): Number of downloaded files whose path is not in the previous manifest.
+        changed (int): Number of downloaded files whose digest differs from the previous manifest.
+    """
+
+    # Fields of a record, in the order of the CSV columns.
+    fields = ("url", "path", "size", "sha256", "timestamp", "status", "change")
+
+    def __init__(self, filename, directory, format = None, previous_filename = None, diff = False, flush_interval = 1.0):
+        """
+        Read the previous manifest and open the manifest file.
+
+        Args:
+            filename (str): Name of the manifest file.
+            directory (str): Download directory, to which the paths are relative.
+            format (str): "csv" or "jsonl". By default, files ending with '.csv' are CSV files and all others JSON-lines files.
+            previous_filename (str): Name of a previous manifest. A manifest that does not exist yet counts as empty,
+                so that the first of a series of runs does not need a special case.
+            diff (bool): If True, only files that have been added or changed since the previous manifest are recorded.
+            flush_interval (float): Maximum time in seconds that records stay in the buffer.
+
+        Raises:
+            IOError: If the previous manifest cannot be read or the manifest file cannot be opened.
+            ValueError: If the format is unknown.
+        """
+
+        import os
+        import threading
+        import time
+
+        if format is None:
+            format = DownloadManifest.guess_format(filename)
+
+        if format not in ("csv", "jsonl"):
+            raise ValueError("The manifest format must be 'csv' or 'jsonl', got " + repr(format) + ".")
+
+        self.filename = filename
+        self.directory = directory
+        self.format = format
+        self.diff = diff
+        self.flush_interval = flush_interval
+        self.added = 0
+        self.changed = 0
+
+        # The previous manifest is read before the manifest is opened, since both may be the same file.
+        if previous_filename is not None or diff:
+            self.previous = {}
+
+            if previous_filename is not None and os.path.exists(previous_filename):
+                for record in DownloadManifest.read(previous_filename):
+                    if record["status"] == "downloaded" and record["sha256"]:
+                        self.previous[record["path"]] = record["sha256"]
+        else:
+            self.previous = None
+
+        self.file = open(filename, "a")
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+
+        if format == "csv":
+            import csv
+
+            self.writer = csv.writer(self.file, lineterminator = "\n")
+
+            # A new manifest starts with the header line.
+            if self.file.tell() == 0:
+                self.writer.writerow(self.fields)
+
+    def __str__(self):
+        """Return a one-line summary of the changes, if there is a previous manifest."""
+        return "Manifest: " + str(self.added) + " added, " + str(self.changed) + " changed."
+
+    @staticmethod
+    def guess_format(filename):
+        """Return "csv" for file names ending with '.csv' and "jsonl" otherwise."""
+        return "csv" if filename.lower().endswith(".csv") else "jsonl"
+
+    @staticmethod
+    def read(filename, format = None):
+        """
+        Iterate over the records of a manifest.
+
+        Args:
+            filename (str): Name of the manifest file.
+            format (str): "csv" or "jsonl". By default, it is guessed from the file name.
+
+        Returns:
+            iterator: The records as dictionaries with the keys of `fields`. Sizes are integers and time stamps are floats.
+        """
+
+        import json
+
+        if format is None:
+            format = DownloadManifest.guess_format(filename)
+
+        with open(filename, "r") as manifest_file:
+            if format == "csv":
+                import csv
+
+                for row in csv.DictReader(manifest_file):
+                    record = dict((field, row.get(field) or None) for field in DownloadManifest.fields)
+                    record["size"] = int(record["size"]) if record["size"] is not None else None
+                    record["timestamp"] = float(record["timestamp"]) if record["timestamp"] is not None else None
+
+                    yield record
+            else:
+                for line in manifest_file:
+                    if line.strip():
+                        yield json.loads(line)
+
+    @staticmethod
+    def changes(previous_filename, filename):
+        """
+        Iterate over the records of the files that have been added or changed in a manifest since a previous manifest.
+
+        Only the latest record of every path counts, in both manifests.
+
+        Args:
+            previous_filename (str): Name of the previous manifest.
+            filename (str): Name of the current manifest.
+
+        Returns:
+            iterator: The latest records of the added or changed paths, with the change set to "added" or "changed".
+        """
+
+        previous = {}
+
+        for record in DownloadManifest.read(previous_filename):
+            if record["status"] == "downloaded":
+                previous[record["path"]] = record["sha256"]
+
+        latest = {}
+
+        for record in DownloadManifest.read(filename):
+            if record["status"] == "downloaded":
+                latest[record["path"]] = record
+
+        for path, record in latest.items():
+            if path not in previous:
+                record["change"] = "added"
+            elif previous[path] != record["sha256"]:
+                record["change"] = "changed"
+            else:
+                continue
+
+            yield record
+
+    @staticmethod
+    def file_digest(filename, buffer_size = 64 * 1024):
+        """Return the hexadecimal SHA-256 digest of a file."""
+
+        import hashlib
+
+        digest = hashlib.sha256()
+
+        with open(filename, "rb") as input_file:
+            for block in iter(lambda: input_file.read(buffer_size), b""):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+    def __call__(self, result):
+        """Append the record of a DownloadResult to the manifest."""
+
+        import json
+        import os
+        import time
+
+        if result.filename is None:
+            return
+
+        path = os.path.relpath(result.filename, self.directory).replace(os.sep, "/")
+        change = None
+
+        with self.lock:
+            if self.previous is not None and result.status == "downloaded":
+                previous_digest = self.previous.get(path)
+
+                if previous_digest is None:
+                    change = "added"
+                    self.added += 1
+                elif previous_digest != result.sha256:
+                    change = "changed"
+                    self.changed += 1
+                else:
+                    change = "unchanged"
+
+                self.previous[path] = result.sha256
+
+            if self.diff and change not in ("added", "changed"):
+                return
+
+            record = (result.url, path, result.file_size, result.sha256, result.started + (result.duration or 0.0), \
+                result.status, change)
+
+            if self.format == "csv":
+                self.writer.writerow(["" if value is None else value for value in record])
+            else:
+                self.file.write(json.dumps(dict(zip(self.fields, record)), sort_keys = True) + "\n")
+
+            now = time.time()
+
+            if now - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = now
+
+    def finish(self):
+        """Write the buffered records to the manifest at the end of a download."""
+
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        """Close the manifest file."""
+        self.file.close()
+
+class RetryPolicy:
+    """
+    Decide whether and when a failed download is attempted again.
+
+    Connection errors, incomplete responses and the HTTP status codes in `retry_statuses` are retried, 
+    other errors such as 404 are final. The delay before attempt n + 1 grows exponentially with n up to `max_backoff`.
+    With jitter, the delay is drawn uniformly between zero and this bound, so that workers that failed at the same time
+    do not retry at the same time. A Retry-After header of the server takes precedence over the computed delay.
+
+    Attributes:
+        attempts (int): Maximum number of attempts per file. A value of 1 disables retries.
+        backoff (float): Upper bound of the delay in seconds before the second attempt.
+        max_backoff (float): Upper bound of all delays in seconds, including those requested with Retry-After.
+        jitter (bool): If True, delays are randomized.
+        retry_statuses (frozenset): HTTP status codes that are retried.
+    """
+
+    def __init__(self, attempts = 1, backoff = 0.5, max_backoff = 60.0, jitter = True, \
+        retry_statuses = (408, 429, 500, 502, 503, 504)):
+        """
+        Create a retry policy.
+
+        Args:
+            attempts (int): Maximum number of attempts per file.
+            backoff (float): Upper bound of the delay in seconds before the second attempt.
+            max_backoff (float): Upper bound of all delays in seconds.
+            jitter (bool): If True, delays are randomized.
+            retry_statuses (iterable): HTTP status codes that are retried.
+
+        Raises:
+            ValueError: If the number of attempts is smaller than 1 or a delay is negative.
+        """
+
+        if attempts < 1:
+            raise ValueError("The number of attempts must be at least 1, got " + repr(attempts) + ".")
+
+        if backoff < 0 or max_backoff < 0:
+            raise ValueError("Backoff delays must not be negative, got " + repr((backoff, max_backoff)) + ".")
+
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = frozenset(retry_statuses)
+
+    def is_retryable(self, error):
+        """Return True if `error` may be caused by a temporary problem of the server or the network."""
+
+        if isinstance(error, (CircuitOpenError, InvalidFileError, DiskSpaceError)):
+            return False
+
+        if isinstance(error, HTTPStatusError):
+            return error.status in self.retry_statuses
+
+        return isinstance(error, (IOError, OSError))
+
+    def delay(self, attempt, error):
+        """
+        Return the time in seconds to wait before the next attempt, or None if the download must not be retried.
+
+        Args:
+            attempt (int): Number of attempts made so far.
+            error (Exception): The error of the last attempt.
+        """
+
+        import random
+
+        if attempt >= self.attempts or not self.is_retryable(error):
+            return None
+
+        retry_after = getattr(error, "retry_after", None)
+
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+
+        bound = min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+
+        return random.uniform(0, bound) if self.jitter else bound
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        Convert the value of a Retry-After header to seconds.
+
+        Args:
+            value (str): Either a number of seconds or an HTTP date. May be None.
+
+        Returns:
+            float: The delay in seconds, or None if the value is missing or invalid.
+        """
+
+        import email.utils
+        import time
+
+        if not value:
+            return None
+
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+
+        date = email.utils.parsedate_tz(value)
+
+        if date is None:
+            return None
+
+        return max(email.utils.mktime_tz(date) - time.time(), 0.0)
+
+class CircuitBreaker:
+    """
+    Stop sending requests to hosts that keep failing.
+
+    After `threshold` consecutive retryable failures, the circuit of a host opens and its downloads fail immediately 
+    with a CircuitOpenError, so that workers are not blocked by a host that is down. After `reset_timeout` seconds, 
+    a single request is let through: the circuit closes again if it succeeds and stays open for another period otherwise.
+
+    Attributes:
+        threshold (int): Number of consecutive failures that open the circuit of a host.
+        reset_timeout (float): Time in seconds until a trial request is sent to a host with an open circuit.
+    """
+
+    def __init__(self, threshold = 5, reset_timeout = 30.0):
+        """
+        Create a circuit breaker with all circuits closed.
+
+        Raises:
+            ValueError: If the threshold is smaller than 1.
+        """
+
+        import threading
+
+        if threshold < 1:
+            raise ValueError("The circuit breaker threshold must be at least 1, got " + repr(threshold) + ".")
+
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = {}
+        self.opened = {}
+
+        # The lock protects the state when it is updated by concurrent workers.
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def host(url):
+        """Return the host and port of `url`, which identify a circuit."""
+
+        try:
+            from urlparse import urlsplit
+        except ImportError:
+            from urllib.parse import urlsplit
+
+        return urlsplit(url).netloc
+
+    def allow(self, url):
+        """Return True if a request for `url` may be sent."""
+
+        import time
+
+        host = self.host(url)
+
+        with self.lock:
+            opened = self.opened.get(host)
+
+            if opened is None:
+                return True
+
+            # Let a single trial request through and keep the circuit open for the other requests.
+            if time.time() - opened >= self.reset_timeout:
+                self.opened[host] = time.time()
+                return True
+
+            return False
+
+    def record_success(self, url):
+        """Close the circuit of the host of `url`."""
+
+        host = self.host(url)
+
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+
+    def record_failure(self, url):
+        """Count a failure of the host of `url` and open its circuit if the threshold is reached."""
+
+        import time
+
+        host = self.host(url)
+
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+
+            if self.failures[host] >= self.threshold:
+                self.opened[host] = time.time()
+
+class TokenBucket:
+    """
+    Token bucket that paces a stream of events to an average rate.
+
+    Tokens are added continuously at `rate` per second up to `capacity`. Taking tokens never blocks: the bucket may run
+    into debt, and the caller has to wait until the debt is paid off. Concurrent callers therefore queue up behind each
+    other with evenly spaced delays instead of all waking up at the same time, which keeps the throughput smooth at the cap.
+
+    Attributes:
+        rate (float): Number of tokens added per second.
+        capacity (float): Maximum number of tokens, which is the largest burst above the rate.
+    """
+
+    def __init__(self, rate, capacity = None):
+        """
+        Create a full token bucket.
+
+        Args:
+            rate (float): Number of tokens added per second.
+            capacity (float): Maximum number of tokens. Defaults to a tenth of the rate, but at least one token.
+
+        Raises:
+            ValueError: If the rate is not positive.
+        """
+
+        import threading
+        import time
+
+        if rate <= 0:
+            raise ValueError("The rate must be positive, got " + repr(rate) + ".")
+
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(self.rate / 10.0, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+        # The lock protects the token count when it is updated by concurrent workers.
+        self.lock = threading.Lock()
+
+    def reserve(self, amount = 1):
+        """
+        Take `amount` tokens from the bucket.
+
+        Returns:
+            float: Time in seconds the caller has to wait before it may proceed.
+        """
+
+        import time
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate) - amount
+            self.updated = now
+
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class Throttle:
+    """
+    Limit the request rate and the bandwidth of the downloads, both in total and per host.
+
+    Before a request is sent, the download engine waits for the delay returned by request_delay(), and after each block
+    of the response body for the delay returned by transfer_delay(). The limits apply across all workers.
+
+    Attributes:
+        requests (TokenBucket): Bucket for the total number of requests per second, or None.
+        bandwidth (TokenBucket): Bucket for the total number of bytes per second, or None.
+        host_requests_per_second (float): Limit of the number of requests per second to each host, or None.
+        host_bytes_per_second (float): Limit of the number of bytes per second from each host, or None.
+    """
+
+    def __init__(self, requests_per_second = None, bytes_per_second = None, host_requests_per_second = None, \
+        host_bytes_per_second = None):
+        """
+        Create a throttle. Limits that are None are not enforced.
+
+        Args:
+            requests_per_second (float): Maximum total number of requests per second.
+            bytes_per_second (float): Maximum total bandwidth in bytes per second.
+            host_requests_per_second (float): Maximum number of requests per second to each host.
+            host_bytes_per_second (float): Maximum bandwidth in bytes per second from each host.
+
+        Example:
+            throttle = Throttle(bytes_per_second = 10 * 1024 * 1024, host_requests_per_second = 5)
+
+        Raises:
+            ValueError: If a limit is not positive.
+        """
+
+        import threading
+
+        self.requests = TokenBucket(requests_per_second) if requests_per_second is not None else None
+        self.bandwidth = TokenBucket(bytes_per_second) if bytes_per_second is not None else None
+
+        for limit in (host_requests_per_second, host_bytes_per_second):
+            if limit is not None and limit <= 0:
+                raise ValueError("The rate must be positive, got " + repr(limit) + ".")
+
+        self.host_requests_per_second = host_requests_per_second
+        self.host_bytes_per_second = host_bytes_per_second
+
+        # Buckets of the hosts, which are created on the first request to a host.
+        self.host_requests = {}
+        self.host_bandwidth = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def host(url):
+        """Return the host and port of `url`, which share the per-host limits."""
+        return CircuitBreaker.host(url)
+
+    def request_delay(self, host):
+        """Take the tokens for a request to `host` and return the time in seconds to wait before sending it."""
+        return self.delay(self.requests, self.host_requests, self.host_requests_per_second, host, 1)
+
+    def transfer_delay(self, host, size):
+        """Take the tokens for `size` bytes from `host` and return the time in seconds to wait before reading more."""
+        return self.delay(self.bandwidth, self.host_bandwidth, self.host_bytes_per_second, host, size)
+
+    def delay(self, bucket, host_buckets, host_rate, host, amount):
+        """Take `amount` tokens from the global bucket and the bucket of `host` and return the longer of both delays."""
+
+        delay = bucket.reserve(amount) if bucket is not None else 0.0
+
+        if host_rate is not None:
+            with self.lock:
+                host_bucket = host_buckets.get(host)
+
+                if host_bucket is None:
+                    host_bucket = host_buckets[host] = TokenBucket(host_rate)
+
+            delay = max(delay, host_bucket.reserve(amount))
+
+        return delay
+
+class AdmissionControl:
+    """
+    Admit new transfers only while the download directory has enough free space and fewer files than a limit are open.
+
+    Before a request is sent, the download engine takes an open file slot with acquire() and waits for the returned delay
+    as long as none is available. Threads wait with wait(), which returns as soon as release() has freed a slot, while the
+    asyncio engine, which must not block its event loop, sleeps for the delay. Once the response header has arrived, reserve() reserves the Content-Length of the file,
+    so that concurrent downloads cannot fill the volume together, and a file that does not fit fails before anything is
+    written instead of with an IOError in the middle of the download. The reservation shrinks while the file is written,
+    and the slot is released when the transfer is done.
+
+    The free space of the volume is sampled at most every `check_interval` seconds. In between, the bytes that have been
+    written since the last sample are subtracted. Once the space that is neither used nor reserved falls below `low_water`,
+    new transfers are paused until it rises above `high_water` again, for example because files have been moved away.
+    Transfers that are already running continue. Apart from wait(), the controller never blocks, so that both engines can use it.
+
+    Attributes:
+        directory (str): Directory on the volume that is watched.
+        low_water (int): Number of free bytes below which new transfers are paused.
+        high_water (int): Number of free bytes above which paused transfers are resumed.
+        max_open_files (int): Maximum number of transfers that hold a slot, None for no limit.
+        max_wait (float): Maximum time in seconds a transfer waits for free space before it fails, None to wait indefinitely.
+        open_files (int): Number of transfers that hold a slot.
+        reserved (int): Number of bytes that are reserved for files and have not been written yet.
+        paused (bool): True while new transfers are paused because of low free space.
+        pauses (int): Number of times new transfers have been paused.
+        waited (float): Total time in seconds that transfers have waited for admission.
+    """
+
+    # Time in seconds to wait before asking again for an open file slot, for engines that cannot wait for release().
+    slot_interval = 0.01
+
+    def __init__(self, directory, low_water = 0, high_water = None, max_open_files = None, max_wait = None, check_interval = 1.0):
+        """
+        Create an admission control for downloads to `directory`.
+
+        Args:
+            directory (str): Directory on the volume that is watched. It has to exist when the first transfer starts.
+            low_water (int): Number of free bytes below which new transfers are paused.
+            high_water (int): Number of free bytes above which paused transfers are resumed. Defaults to a quarter
+                more than `low_water`.
+            max_open_files (int): Maximum number of concurrent transfers with an open file. Defaults to half of the
+                limit of open file descriptors of the process, as each transfer needs a connection and a file,
+                or to no limit where the limit of the process is unknown.
+            max_wait (float): Maximum time in seconds a transfer waits for free space before it fails.
+                By default, transfers wait until the space is available.
+            check_interval (float): Minimum time in seconds between two samples of the free space.
+
+        Example:
+            admission = AdmissionControl("downloads", low_water = 1024 ** 3, max_open_files = 256)
+
+        Raises:
+            ValueError: If the low-water mark is negative, the high-water mark is below the low-water mark
+                or the limit of open files is smaller than 1.
+        """
+
+        import threading
+
+        if low_water < 0:
+            raise ValueError("The low-water mark must not be negative, got " + repr(low_water) + ".")
+
+        if high_water is None:
+            high_water = low_water + low_water // 4
+
+        if high_water < low_water:
+            raise ValueError("The high-water mark must not be below the low-water mark, got " + repr(high_water) + ".")
+
+        if max_open_files is None:
+            # The resource module is only available on Unix.
+            try:
+                import resource
+
+                limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+                # Leave some descriptors for the journal, the logs and the standard streams.
+                if limit != resource.RLIM_INFINITY:
+                    max_open_files = max((limit - 64) // 2, 1)
+            except ImportError:
+                pass
+        elif max_open_files < 1:
+            raise ValueError("The limit of open files must be at least 1, got " + repr(max_open_files) + ".")
+
+        self.directory = directory
+        self.low_water = int(low_water)
+        self.high_water = int(high_water)
+        self.max_open_files = max_open_files
+        self.max_wait = max_wait
+        self.check_interval = check_interval
+        self.open_files = 0
+        self.reserved = 0
+        self.paused = False
+        self.pauses = 0
+        self.waited = 0.0
+
+        # Free space at the last sample and the bytes written since then.
+        self.free = None
+        self.written = 0
+        self.sampled = None
+
+        # The condition protects the counters when they are updated by concurrent workers,
+        # and wakes up the workers that wait for an open file slot when release() frees one.
+        self.condition = threading.Condition()
+
+    def __str__(self):
+        """Return a one-line summary of the pauses and the waiting time."""
+
+        return "Paused " + str(self.pauses) + " times for free space, waited " + \
+            str(round(self.waited, 1)) + " seconds for admission."
+
+    @staticmethod
+    def free_space(directory):
+        """Return the number of bytes that may be written to the volume of `directory` by unprivileged users."""
+
+        import os
+
+        if hasattr(os, "statvfs"):
+            stat = os.statvfs(directory)
+
+            return stat.f_bavail * stat.f_frsize
+
+        # Python 3.3 or higher on systems without statvfs, such as Windows.
+        import shutil
+
+        return shutil.disk_usage(directory).free
+
+    def available(self, now):
+        """Return the number of free bytes that are not reserved. The caller must hold the condition."""
+
+        if self.sampled is None or now - self.sampled >= self.check_interval:
+            self.free = self.free_space(self.directory)
+            self.written = 0
+            self.sampled = now
+
+        return self.free - self.written - self.reserved
+
+    def update(self, available):
+        """Pause or resume new transfers depending on the `available` space. The caller must hold the condition."""
+
+        if self.paused and available >= self.high_water:
+            self.paused = False
+        elif not self.paused and available < self.low_water:
+            self.paused = True
+            self.pauses += 1
+
+    def acquire(self, url, since = None):
+        """
+        Take an open file slot for a transfer of `url`.
+
+        Args:
+            url (str): URL of the transfer.
+            since (float): Time stamp at which the transfer has started to wait, None on the first call.
+
+        Returns:
+            float: None if the transfer may send its request, or the time in seconds to wait before calling acquire() again.
+
+        Raises:
+            DiskSpaceError: If the transfer has waited for free space for longer than `max_wait`.
+        """
+
+        import time
+
+        with self.condition:
+            now = time.time()
+            available = self.available(now)
+            self.update(available)
+
+            if self.paused:
+                if self.max_wait is not None and since is not None and now - since >= self.max_wait:
+                    self.waited += now - since
+
+                    raise DiskSpaceError(url, self.low_water, available)
+
+                return self.check_interval
+
+            if self.max_open_files is not None and self.open_files >= self.max_open_files:
+                return self.slot_interval
+
+            self.open_files += 1
+
+            if since is not None:
+                self.waited += now - since
+
+            return None
+
+    def wait(self, delay):
+        """
+        Block the calling thread after acquire() has returned `delay`, until it is worth calling acquire() again.
+
+        While all slots are taken, the thread is woken up by the release() of a slot instead of polling, but it waits 
+        at least `delay` and at most `check_interval` seconds, so that a change of the free space is noticed as well.
+        If a slot has been released in the meantime, the method returns at once.
+
+        Args:
+            delay (float): The time in seconds that acquire() has returned.
+        """
+
+        with self.condition:
+            if self.paused or (self.max_open_files is not None and self.open_files >= self.max_open_files):
+                self.condition.wait(max(delay, self.check_interval))
+
+    def reserve(self, url, size):
+        """
+        Reserve `size` bytes for the file of `url`, after its transfer has taken a slot.
+
+        Raises:
+            DiskSpaceError: If the file does not fit into the free space that is not reserved by other transfers.
+        """
+
+        import time
+
+        with self.condition:
+            available = self.available(time.time())
+
+            if size > available:
+                raise DiskSpaceError(url, size, available)
+
+            self.reserved += size
+            self.update(available - size)
+
+    def consume(self, size, reserved):
+        """Account for `size` bytes that have been written, of which `reserved` bytes have been reserved."""
+
+        with self.condition:
+            self.written += size
+            self.reserved -= reserved
+
+    def release(self, reserved):
+        """Release the slot of a transfer and the `reserved` bytes that it has not written."""
+
+        with self.condition:
+            self.open_files -= 1
+            self.reserved -= reserved
+
+            # Every waiting worker checks again, so that none is left waiting if the woken one cannot take the slot.
+            self.condition.notify_all()
+
+def create_thumbnails(filename, data, sizes, quality):
+    """
+    Write scaled-down copies of a JPEG file next to it, one for each size.
+
+    This function runs in the processes of a ThumbnailGenerator. The thumbnail of 'image.jpg' for the size 128x96 is 
+    named 'image.128x96.jpg'. Thumbnails keep the aspect ratio of the image and are written under a temporary name first,
+    so that no incomplete thumbnail is left behind.
+
+    Args:
+        filename (str): Name of the downloaded file.
+        data (bytes): Content of the file, or None if the file has to be read from disk.
+        sizes (list): Maximum widths and heights of the thumbnails as pairs of integers.
+        quality (int): JPEG quality of the thumbnails.
+
+    Returns:
+        int: Number of thumbnails that have been written.
+    """
+
+    import io
+    import os
+
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data) if data is not None else filename)
+
+    # Let the JPEG decoder scale the image down while decoding, which is much faster than decoding it at full size.
+    image.draft("RGB", (max(width for width, _ in sizes), max(height for _, height in sizes)))
+    image = image.convert("RGB")
+
+    stem, extension = os.path.splitext(filename)
+
+    for width, height in sizes:
+        thumbnail = image.copy()
+        thumbnail.thumbnail((width, height))
+
+        thumbnail_filename = stem + "." + str(width) + "x" + str(height) + extension
+        temporary_filename = thumbnail_filename + ".part"
+
+        thumbnail.save(temporary_filename, "JPEG", quality = quality)
+        AtomicFile.rename(temporary_filename, thumbnail_filename)
+
+    return len(sizes)
+
+class ThumbnailGenerator:
+    """
+    Create thumbnails of the downloaded files in a pool of processes.
+
+    The downloader passes the content of each file, which it has kept in memory while writing it, to the pool, so that
+    the file does not have to be read again. The memory for the content of the files that are waiting for a process is
+    limited by `memory_limit`. Once the limit is reached, or if the size of a file is not known in advance, only the 
+    filename is passed and the process reads the file from disk. The memory use therefore stays bounded even if the 
+    thumbnails are created more slowly than the files are downloaded. The number of files that are waiting for the pool 
+    is bounded by `max_pending` as well; once it is reached, further files get no thumbnails and are counted as dropped, 
+    so that a slow pool never stalls the downloads.
+    If a process of the pool dies, for example because it runs out of memory, a warning is printed and thumbnails are 
+    disabled for the rest of the download, which itself continues.
+
+    The thumbnails are created with Pillow, which has to be installed with 'pip install pillow'.
+
+    Attributes:
+        sizes (list): Maximum widths and heights of the thumbnails as pairs of integers.
+        quality (int): JPEG quality of the thumbnails.
+        memory_limit (int): Maximum number of bytes of file contents that are waiting for the pool.
+        max_pending (int): Maximum number of files that are waiting for the pool.
+        broken (bool): True once the pool has failed and thumbnails are disabled.
+        created (int): Number of thumbnails that have been written.
+        failed (int): Number of files for which no thumbnails could be created.
+        dropped (int): Number of files that got no thumbnails because `max_pending` files were waiting for the pool.
+        from_memory (int): Number of files that have been passed to the pool in memory instead of as a filename.
+    """
+
+    def __init__(self, sizes, processes = None, memory_limit = 64 * 1024 * 1024, quality = 85, max_pending = None):
+        """
+        Start the pool of processes.
+
+        Args:
+            sizes (list): Maximum widths and heights of the thumbnails as pairs of integers, such as [(128, 128)].
+            processes (int): Number of processes. Defaults to the number of cores.
+            memory_limit (int): Maximum number of bytes of file contents that are waiting for the pool.
+            quality (int): JPEG quality of the thumbnails.
+            max_pending (int): Maximum number of files that are waiting for the pool. Defaults to 256 per process.
+
+        Example:
+            thumbnails = ThumbnailGenerator([(128, 128), (640, 480)], processes = 4)
+
+        Raises:
+            ImportError: If Pillow or the concurrent.futures module is not installed.
+            ValueError: If no size is given.
+        """
+
+        import threading
+
+        # Try importing Pillow and throw an exception in case importing fails.
+
+        try:
+            import PIL
+        except ImportError:
+            print("Error: Failed to load the Pillow package, which is required for thumbnails.")
+            print("Install the package via")
+            print("pip install pillow")
+            print("")
+            raise
+
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        if not sizes:
+            raise ValueError("At least one thumbnail size is required.")
+
+        self.sizes = sorted(tuple(size) for size in sizes)
+        self.quality = quality
+        self.memory_limit = memory_limit
+        self.max_pending = max_pending or 256 * (processes or multiprocessing.cpu_count())
+        self.queued = 0
+        self.broken = False
+        self.memory_used = 0
+        self.created = 0
+        self.failed = 0
+        self.dropped = 0
+        self.from_memory = 0
+        self.pending = set()
+
+        # The lock protects the counters and the memory budget, which are updated by the download workers and the pool.
+        self.lock = threading.Lock()
+        self.executor = ProcessPoolExecutor(max_workers = processes)
+
+    def __str__(self):
+        """Return a one-line summary of the thumbnail counters."""
+        summary = "Created " + str(self.created) + " thumbnails, " + str(self.failed) + " files failed."
+
+        if self.dropped > 0:
+            summary += " Dropped " + str(self.dropped) + " files while the thumbnail processes were busy."
+
+        return summary
+
+    @staticmethod
+    def parse_sizes(text):
+        """
+        Convert a comma-separated list of sizes such as '128x128,640x480' to a list of pairs of integers.
+
+        Raises:
+            ValueError: If a size is not formatted as WIDTHxHEIGHT with positive integers.
+        """
+
+        sizes = []
+
+        for size in text.split(","):
+            try:
+                width, height = [int(value) for value in size.lower().split("x")]
+            except ValueError:
+                raise ValueError("Invalid thumbnail size " + repr(size) + ", expected WIDTHxHEIGHT.")
+
+            if width < 1 or height < 1:
+                raise ValueError("Invalid thumbnail size " + repr(size) + ", expected WIDTHxHEIGHT.")
+
+            sizes.append((width, height))
+
+        return sizes
+
+    def reserve(self, size):
+        """
+        Reserve memory for the content of a file of `size` bytes.
+
+        Returns:
+            bool: True if the content may be kept in memory, False if only the filename is passed to the pool.
+        """
+
+        with self.lock:
+            if self.memory_used + size > self.memory_limit:
+                return False
+
+            self.memory_used += size
+
+            return True
+
+    def release(self, size):
+        """Release memory that has been reserved for the content of a file of `size` bytes."""
+
+        with self.lock:
+            self.memory_used -= size
+
+    def submit(self, filename, data = None):
+        """
+        Create the thumbnails of `filename` in the pool, without waiting for them.
+
+        The call never waits: if `max_pending` files are waiting for the pool, the file is counted as dropped, 
+        and after the pool has failed, it is counted as failed right away.
+
+        Args:
+            filename (str): Name of the downloaded file.
+            data (bytes): Content of the file, for which memory has been reserved, or None.
+        """
+
+        from concurrent.futures.process import BrokenProcessPool
+
+        size = len(data) if data is not None else 0
+
+        # The place in the queue is taken before the file is submitted, so that concurrent workers cannot exceed the limit.
+        with self.lock:
+            if self.broken:
+                self.failed += 1
+                accepted = False
+            elif self.queued >= self.max_pending:
+                self.dropped += 1
+                accepted = False
+            else:
+                self.queued += 1
+                accepted = True
+
+        future = None
+
+        if accepted:
+            try:
+                future = self.executor.submit(create_thumbnails, filename, data, self.sizes, self.quality)
+            except BrokenProcessPool:
+                self.disable()
+
+                with self.lock:
+                    self.failed += 1
+                    self.queued -= 1
+
+        if future is None:
+            if size > 0:
+                self.release(size)
+
+            return
+
+        with self.lock:
+            self.pending.add(future)
+
+            if data is not None:
+                self.from_memory += 1
+
+        def done(future):
+            error = future.exception()
+
+            with self.lock:
+                self.pending.discard(future)
+                self.queued -= 1
+
+                if error is None:
+                    self.created += future.result()
+                else:
+                    self.failed += 1
+
+            if isinstance(error, BrokenProcessPool):
+                self.disable()
+
+            # The content is not needed any more once the thumbnails have been written.
+            if size > 0:
+                self.release(size)
+
+        future.add_done_callback(done)
+
+    def disable(self):
+        """Disable thumbnails after the pool has failed, with a single warning."""
+
+        with self.lock:
+            if self.broken:
+                return
+
+            self.broken = True
+
+        print("Warning: A thumbnail process has stopped unexpectedly, no further thumbnails are created.")
+
+    def wait(self):
+        """Wait until the thumbnails of all submitted files have been created."""
+
+        from concurrent.futures import wait
+
+        with self.lock:
+            pending = list(self.pending)
+
+        wait(pending)
+
+    def close(self):
+        """Wait for the pending thumbnails and stop the pool."""
+        self.executor.shutdown(wait = True)
+
+class BatchDownloader:
+    """
+    Download files from a list of URLs.
+
+    Download a list of files defined in an iterable object. Users must provide a download directory and may provide flags to
+    create new directories, overwrite existing files and activate an interactive mode.
+    Files may be downloaded one after another or concurrently by a pool of worker threads.
+
+    The result and timing of every file is passed as a DownloadResult to the hooks of the downloader. 
+    The built-in hook `metrics` aggregates counters and timing histograms, further hooks may be added with add_hook().
+    """
+
+    def __init__(self, download_directory, default_overwrite = False, default_create_directory = False, \
+        workers = 1, queue_size = None, host_limit = None, connection_pool = None, buffer_size = 64 * 1024, \
+        resume = False, journal_filename = None, refresh = False, deduplicate = False, progress = False, log_filename = None, \
+        retry_policy = None, circuit_breaker = None, keep_going = False, failures_filename = None, throttle = None, \
+        validate = None, layout = "flat", index_existing = False, rename_collisions = False, shard_name = None, \
+        thumbnails = None, manifest = None, admission = None):
+        """
+        Initialize a batch downloader for a list of files. 
+
+        You may specify a download directory and a set of flags for error handling. 
+        If it does not exist yet, the download directory will be created upon request.
+
+        Args:
+            download_directory (str): Target directory for the downloaded files.
+            default_overwrite (bool): If True, already existing files will be overwritten.
+            default_create_directory (bool): If True, the directory will be created if it does not exist already.
+            workers (int): Number of files that are downloaded concurrently. A value of 1 downloads files one after another.
+            queue_size (int): Maximum number of URLs that are read ahead from the iterable while the workers are busy.
+                Defaults to twice the number of workers.
+            host_limit (int): Maximum number of concurrent downloads from the same host. Defaults to the number of workers.
+            connection_pool (HTTPConnectionPool): Pool of keep-alive connections for HTTP(S) downloads.
+                By default, a new pool with `host_limit` connections per host is created.
+            buffer_size (int): Size in bytes of the blocks in which files are downloaded and written to disk.
+                Each download holds at most one block in memory, regardless of the file size.
+            resume (bool): If True, keep a journal of all downloads, skip the URLs that the journal lists as completed 
+                and resume interrupted downloads with Range requests.
+            journal_filename (str): Name of the journal file. Defaults to a hidden file in the download directory.
+            refresh (bool): If True, existing files are requested again with the ETag and Last-Modified validators 
+                from the journal and only rewritten if they have changed. The journal is kept as in resume mode.
+            deduplicate (bool): If True, repeated URLs are downloaded only once, and files with the same content as an 
+                earlier download are stored as links to the earlier file. An index of the content digests is kept 
+                in the download directory.
+            progress (bool): If True, a single progress line with the download rate and the remaining time is shown
+                instead of a message per file.
+            log_filename (str): Name of a file to which the result and timing of every download is appended as a JSON line.
+            retry_policy (RetryPolicy): Decides whether and when failed downloads are attempted again.
+                By default, every file is attempted once.
+            circuit_breaker (CircuitBreaker): If given, downloads from hosts that keep failing fail immediately.
+            keep_going (bool): If True, failed downloads are counted and the download continues with the next file.
+                Otherwise, the first failed download stops the download.
+            failures_filename (str): Name of a list file to which the URLs of failed downloads are appended.
+            throttle (Throttle): If given, limits the request rate and the bandwidth of all workers.
+            validate (str): If "delete" or "quarantine", all downloads are checked for a JPEG Content-Type, the JPEG start
+                and end markers and the Content-Length while they are streamed. Invalid files fail the download and are 
+                deleted or moved to the quarantine directory, a hidden subdirectory of the download directory.
+            layout (str): "flat" stores all files in the download directory. "sharded" stores them in two levels of
+                subdirectories named after a hash of the filename, such as 'downloads/3f/a2/image.jpg', so that no 
+                directory grows too large.
+            index_existing (bool): If True, the download directory is scanned once and the skip check for existing files 
+                looks up the filename in memory instead of asking the file system.
+            rename_collisions (bool): If True, a hash of the URL is appended to every filename, so that different URLs 
+                with the same filename do not overwrite or skip each other, in any order of the list.
+                In resume and refresh mode, a URL keeps the filename recorded in the journal.
+            shard_name (str): Name of the shard of the URL list that is downloaded, such as '3-of-8'. It is appended
+                to the names of the journal and the digest index, so that shards which share a download directory 
+                keep separate files.
+            thumbnails (ThumbnailGenerator): If given, thumbnails of all downloaded files are created in a pool of processes.
+            manifest (DownloadManifest): If given, a record with the SHA-256 digest of every file is appended to the manifest.
+            admission (AdmissionControl): If given, transfers reserve their Content-Length in the free space of the
+                download directory, new transfers are paused while the free space is low, and the number of open files is limited.
+
+        Example:
+            downloader = BatchDownloader(download_directory = "downloads", default_create_directory = True, workers = 8)
+
+        Raises:
+            ValueError: If the number of workers, the queue size, the host limit or the buffer size is smaller than 1,
+                or the validation mode or the layout is unknown.
+        """
+
+        self.download_directory = download_directory
+        self.default_overwrite = default_overwrite
+        self.default_create_directory = default_create_directory
+
+        if workers < 1:
+            raise ValueError("The number of workers must be at least 1, got " + repr(workers) + ".")
+
+        self.workers = workers
+
+        if queue_size is None:
+            queue_size = 2 * workers
+
+        if queue_size < 1:
+            raise ValueError("The queue size must be at least 1, got " + repr(queue_size) + ".")
+
+        self.queue_size = queue_size
+
+        if host_limit is not None and host_limit < 1:
+            raise ValueError("The host limit must be at least 1, got " + repr(host_limit) + ".")
+
+        self.host_limit = host_limit
+
+        if connection_pool is None:
+            connection_pool = HTTPConnectionPool(max_per_host = host_limit or workers)
+
+        self.connection_pool = connection_pool
+
+        if buffer_size < 1:
+            raise ValueError("The buffer size must be at least 1, got " + repr(buffer_size) + ".")
+
+        self.buffer_size = buffer_size
+
+        # Create the download directory if it does not exist yet
+        self.create_download_directory()
+
+        self.resume = resume
+        self.refresh = refresh
+
+        # Shards that share a download directory keep their own journal and digest index.
+        suffix = "." + shard_name if shard_name is not None else ""
+
+        # The journal is stored in the download directory, so it has to be opened after the directory has been created.
+        if resume or refresh:
+            import os
+
+            self.journal = DownloadJournal(journal_filename or \
+                os.path.join(download_directory, DownloadJournal.default_filename + suffix))
+        else:
+            self.journal = None
+
+        if deduplicate:
+            import os
+
+            self.deduplication_index = DeduplicationIndex( \
+                os.path.join(download_directory, DeduplicationIndex.default_filename + suffix), download_directory)
+        else:
+            self.deduplication_index = None
+
+        # Messages per file are replaced by the progress line.
+        self.verbose = not progress
+
+        self.metrics = DownloadMetrics()
+        self.hooks = [self.metrics]
+
+        if progress:
+            self.add_hook(ProgressReporter())
+
+        if log_filename is not None:
+            self.add_hook(JSONLinesLog(log_filename))
+
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+
+        self.retry_policy = retry_policy
+        self.circuit_breaker = circuit_breaker
+        self.keep_going = keep_going
+
+        if failures_filename is not None:
+            self.add_hook(FailureList(failures_filename))
+
+        self.throttle = throttle
+
+        if validate not in (None, "delete", "quarantine"):
+            raise ValueError("The validation mode must be 'delete' or 'quarantine', got " + repr(validate) + ".")
+
+        import os
+
+        self.validate = validate
+        self.quarantine_directory = os.path.join(download_directory, ".quarantine")
+
+        if layout not in ("flat", "sharded"):
+            raise ValueError("The layout must be 'flat' or 'sharded', got " + repr(layout) + ".")
+
+        self.layout = layout
+        self.rename_collisions = rename_collisions
+
+        # Subdirectories of the sharded layout that are known to exist.
+        self.created_directories = set()
+
+        import threading
+
+        # Concurrent downloads hold a lock per filename, so that duplicate URLs are processed one after another. Each entry
+        # is a pair of the lock and the number of downloads that hold or wait for it, and is removed once that drops to zero,
+        # so the dictionary only contains the files in progress.
+        self.filename_locks = {}
+        self.filename_locks_guard = threading.Lock()
+
+        if index_existing:
+            self.existing_files = self.scan_download_directory()
+        else:
+            self.existing_files = None
+
+        self.thumbnails = thumbnails
+        self.manifest = manifest
+
+        if manifest is not None:
+            self.add_hook(manifest)
+
+        self.admission = admission
+
+    def add_hook(self, hook):
+        """
+        Register a callable that is called with a DownloadResult for every file, including skipped and failed files.
+
+        Hooks may be called concurrently by several workers. A hook may define the optional methods start(total), 
+        which is called at the beginning of download() with the number of URLs or None if it is unknown, 
+        finish(), which is called at its end, and close(), which is called by close() of the downloader.
+
+        Args:
+            hook (callable): The hook.
+
+        Example:
+            downloader.add_hook(lambda result: print(result.url, result.duration))
+        """
+
+        self.hooks.append(hook)
+
+    def notify(self, result):
+        """Pass a DownloadResult to all hooks."""
+
+        for hook in self.hooks:
+            hook(result)
+
+    def start_hooks(self, urls):
+        """Call the start() method of all hooks with the number of `urls`, if it can be determined without reading them."""
+
+        # Instances of old-style classes raise an AttributeError instead of a TypeError on Python 2.
+        try:
+            total = len(urls)
+        except (TypeError, AttributeError):
+            total = getattr(urls, "url_count", None)
+
+        for hook in self.hooks:
+            if hasattr(hook, "start"):
+                hook.start(total)
+
+    def finish_hooks(self):
+        """Call the finish() method of all hooks."""
+
+        for hook in self.hooks:
+            if hasattr(hook, "finish"):
+                hook.finish()
+
+    def close(self):
+        """
+        Close the journal, the digest index, the hooks with a close() method, such as the log, the failures list and 
+        the manifest, the idle connections and the thumbnail pool, after waiting for the pending thumbnails.
+
+        The downloader must not be used any more afterwards. close() is also called at the end of a with statement.
+        """
+
+        if self.thumbnails is not None:
+            self.thumbnails.close()
+
+        for hook in self.hooks:
+            if hasattr(hook, "close"):
+                hook.close()
+
+        if self.journal is not None:
+            self.journal.close()
+
+        if self.deduplication_index is not None:
+            self.deduplication_index.close()
+
+        self.connection_pool.close()
+
+    def __enter__(self):
+        """Return the downloader itself."""
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        """Close the downloader."""
+        self.close()
 
     def create_download_directory(self):
         """
         Create download directory if required. 
 
-        If the directory does not exist and permission is given, 
-        the directory will be created. Otherwise, it will raise 
-        a ValueError exception.
+        If the directory does not exist and permission is given, 
+        the directory will be created. Otherwise, it will raise 
+        a ValueError exception.
+
+        Raises:
+            ValueError: If the output directory does not exist and permission to create it has not been given.
+        """
+
+        # We need the OS module to check if the path exists.
+        import os
+
+        # For python 3 compatibility, bind input to raw_input in python 2
+
+        try:
+           get_input = raw_input
+        except NameError:
+           get_input = input
+
+        # Check if the directory exists already
+
+        if not os.path.isdir(self.download_directory):
+            if (self.default_create_directory):                
+                try:
+                    # Create the directory.
+                    os.mkdir(self.download_directory)
+                except OSError:
+                    # Ignore OS errors if the directory already exists. This may be caused by a race condition.
+                    if not os.path.isdir(self.download_directory):
+                        raise
+            else:
+                raise ValueError("Output directory " + repr(self.download_directory) + " does not exist.")
+
+    def local_filename(self, url):
+        """
+        Derive the local filename of a URL inside the download directory.
+
+        In the sharded layout, the filename is placed in two levels of subdirectories named after a hash of the filename.
+        If collisions are renamed, a hash of the URL is appended to the filename, so that different URLs never share a file.
+
+        Args:
+            url (str): URL to the source
+
+        Returns:
+            str: The last path component of the URL joined with the download directory.
+
+        Raises:
+            TypeError: If `url` is not of type string.
+        """
+
+        # Get the filename without its path by splitting the URL at the last '/' and taking the right substring
+        # If the rsplit method is not found, throw a Type Error as the URL does not appear to be a string.
+
+        try:
+            filename_without_path = url.rsplit('/', 1)[-1]
+        except AttributeError:
+            raise TypeError("Error: " + repr(url) + " object is not of type string.")
+
+        if self.rename_collisions:
+            return self.unique_filename(url, filename_without_path)
+
+        return self.place_filename(filename_without_path)
+
+    def place_filename(self, name):
+        """Return the path of a file `name` in the download directory, depending on the layout."""
+
+        # We need the OS module for portable joining of paths     
+        import os
+
+        if self.layout == "sharded":
+            import hashlib
+
+            digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+
+            return os.path.join(self.download_directory, digest[0:2], digest[2:4], name)
+
+        # Combine the filename with the download directory to get the local filename
+        return os.path.join(self.download_directory, name)
+
+    def unique_filename(self, url, name):
+        """
+        Return a filename for `url` that no other URL uses.
+
+        The filename is the name with the first eight hexadecimal digits of the SHA-1 hash of the URL appended, such as
+        'image-3fa2b41c.jpg'. It depends only on the URL, so a URL gets the same filename in every run and in every
+        order of the list, and no state has to be kept about the filenames that are in use.
+
+        Args:
+            url (str): URL to the source
+            name (str): The last path component of the URL.
+        """
+
+        import hashlib
+        import os
+
+        # A URL that has been downloaded before keeps the filename of the journal.
+        record = self.journal.get(url) if self.journal is not None else None
+
+        if record is not None and record.get("path"):
+            return record["path"]
+
+        stem, extension = os.path.splitext(name)
 
-        Raises:
-            ValueError: If the output directory does not exist and permission to create it has not been given.
+        return self.place_filename(stem + "-" + hashlib.sha1(url.encode("utf-8")).hexdigest()[:8] + extension)
+
+    def scan_download_directory(self):
+        """
+        Return the set of the filenames of all files in the download directory and its subdirectories.
+
+        Hidden files, such as partial files and the journal, and hidden directories, such as the quarantine, are not included.
         """
 
-        # We need the OS module to check if the path exists.
         import os
 
-        # For python 3 compatibility, bind input to raw_input in python 2
+        filenames = set()
+
+        for directory, subdirectories, files in os.walk(self.download_directory):
+            subdirectories[:] = [name for name in subdirectories if not name.startswith(".")]
+            filenames.update(os.path.join(directory, name) for name in files if not name.startswith("."))
+
+        return filenames
+
+    def create_parent_directory(self, filename):
+        """Create the subdirectory of `filename` in the sharded layout, unless it is known to exist."""
+
+        import os
+
+        directory = os.path.dirname(filename)
+
+        if self.layout == "flat" or directory in self.created_directories:
+            return
 
         try:
-           get_input = raw_input
-        except NameError:
-           get_input = input
+            os.makedirs(directory)
+        except OSError:
+            # The directory may exist from an earlier run or may have been created by another worker.
+            if not os.path.isdir(directory):
+                raise
 
-        # Check if the directory exists already
+        self.created_directories.add(directory)
 
-        if not os.path.isdir(self.download_directory):
-            if (self.default_create_directory):                
-                try:
-                    # Create the directory.
-                    os.mkdir(self.download_directory)
-                except OSError:
-                    # Ignore OS errors if the directory already exists. This may be caused by a race condition.
-                    if not os.path.isdir(self.download_directory):
-                        raise
-            else:
-                raise ValueError("Output directory " + repr(self.download_directory) + " does not exist.")
+    def file_exists(self, filename):
+        """Return True if `filename` exists, looking it up in the index of existing files if there is one."""
+
+        import os
+
+        if self.existing_files is not None:
+            return filename in self.existing_files
+
+        return os.path.isfile(filename)
 
     def download_file(self, url, filename):
         """
@@ -290,65 +4930,332 @@ class BatchDownloader:
 
         Args:
             url (str): URL to the source 
-            filename (str): If True, already existing files will be overwritten.
+            filename (str): Local path where the file is stored.
+
+        Returns:
+            str: "downloaded" if the file has been downloaded, "skipped" if it already existed 
+                or "not_modified" if it has not changed on the server in refresh mode.
 
         Raises:
             IOError: If the file download fails (for example when the URL does not point to a file).
         """
 
-        # We need the OS module for file output
-        import os
+        import time
+
+        result = DownloadResult(url, filename)
+
+        if self.skip(url, filename):
+            result.status = "skipped"
+            result.duration = time.time() - result.started
+            self.notify(result)
+            return "skipped"
 
-        # Bind get_input to raw_input (Python 2) or input (Python 3)
+        # Print a status message for each download (without newline).
+        # Concurrent workers report each file in a single write once it is done, so that lines do not interleave.
+        from sys import stdout
+
+        if self.verbose and self.workers == 1:
+            stdout.write("Downloading " + repr(url) + " to " + repr(filename) + "...")
+            
+        # Download the file. If an IO Error occurs, forward the exception.
 
         try:
-           get_input = raw_input
-        except NameError:
-           get_input = input
+            self.create_parent_directory(filename)
+            result.status = self.fetch_with_retries(url, filename, result)
+
+            if self.existing_files is not None:
+                self.existing_files.add(filename)
+        except Exception as e:
+            result.status = "failed"
+            result.error = str(e)
+            raise
+        finally:
+            result.duration = time.time() - result.started
+
+            if self.verbose:
+                if self.workers == 1:
+                    print(self.result_message(result))
+                else:
+                    stdout.write(self.describe(result) + "\n")
+
+            self.notify(result)
+
+        return result.status
+
+    def describe(self, result):
+        """
+        Return the message that is printed for the result of a file, or None for results that are not reported.
+
+        Example:
+            "Downloading 'http://example.com/image.jpg' to 'downloads/image.jpg'...done."
+        """
+
+        if result.status == "skipped":
+            return "Skipping already existing file " + repr(result.filename) + "."
+
+        if result.status == "duplicate":
+            return None
+
+        return "Downloading " + repr(result.url) + " to " + repr(result.filename) + "..." + self.result_message(result)
+
+    def result_message(self, result):
+        """Return the message that is printed after the download of a file, for example 'done.' or 'failed after 3 attempts.'"""
+
+        message = {"downloaded": "done", "not_modified": "not modified"}.get(result.status, "failed")
+
+        if result.attempts > 1:
+            message += " after " + str(result.attempts) + " attempts"
+
+        return message + "."
 
-        # If the file already exists, check if it may be overwritten.
+    def fetch_with_retries(self, url, filename, result):
+        """
+        Download `url` to `filename` and repeat the download after temporary failures as defined by the retry policy.
+
+        Args:
+            url (str): URL to the source
+            filename (str): Local path where the file is stored.
+            result (DownloadResult): Receives the number of attempts, the size and the timing of the last attempt.
+
+        Returns:
+            str: "downloaded", or "not_modified" if the file has not changed since the last download in refresh mode.
+
+        Raises:
+            IOError: If the last attempt fails, the error is not retryable or the circuit of the host is open.
+        """
+
+        import time
+
+        while True:
+            self.check_circuit(url)
+            result.attempts += 1
+
+            try:
+                status = self.fetch(url, filename, result)
+            except IOError as e:
+                self.record_attempt(url, e)
+                delay = self.retry_policy.delay(result.attempts, e)
+
+                if delay is None:
+                    raise
+
+                time.sleep(delay)
+            else:
+                self.record_attempt(url, None)
+
+                return status
+
+    def check_circuit(self, url):
+        """
+        Check if a request for `url` may be sent.
+
+        Raises:
+            CircuitOpenError: If the circuit breaker has stopped requests to the host of `url`.
+        """
+
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow(url):
+            raise CircuitOpenError(url)
+
+    def record_attempt(self, url, error):
+        """Update the circuit breaker with the outcome of a request for `url`, where `error` is None for a success."""
+
+        if self.circuit_breaker is None or isinstance(error, CircuitOpenError):
+            return
+
+        # Errors that are not retryable, such as 404, show that the host is up.
+        if error is not None and self.retry_policy.is_retryable(error):
+            self.circuit_breaker.record_failure(url)
+        else:
+            self.circuit_breaker.record_success(url)
+
+    def skip(self, url, filename):
+        """
+        Check if the download of a file may be skipped.
+
+        Without permission to overwrite files, a file is skipped if the journal lists it as completed, 
+        which does not require access to the file system, or if the file already exists, 
+        which is looked up in the index of existing files if there is one. 
+        In refresh mode, no file is skipped, as existing files are checked for changes on the server.
+
+        Args:
+            url (str): URL to the source 
+            filename (str): Local path where the file is stored.
+
+        Returns:
+            bool: True if the download is skipped.
+        """
 
-        if os.path.isfile(filename):
-            # Skip the file if overwriting is not allowed.
+        if self.default_overwrite or self.refresh:
+            return False
 
-            if not self.default_overwrite:
+        if self.resume and self.journal.is_completed(url):
+            return True
+
+        # If the file already exists, skip it with a warning.
+
+        if self.file_exists(filename):
+            if self.verbose:
                 print("Skipping already existing file " + repr(filename) +".")
-                return
+            return True
 
-        # Print a status message for each download (without newline)
-        from sys import stdout
-        stdout.write("Downloading " + repr(url) + " to " + repr(filename) + "...")
-            
-        # Load the urllib module.
-        # For compatibility, try both urllib (Python 2) and urllib.request (Python 3)
+        return False
 
-        try:
-            from urllib import urlretrieve
-        except ImportError: 
-            from urllib.request import urlretrieve
-    
-        # Download the file. If an IO Error occurs, forward the exception.
+    def fetch(self, url, filename, result = None):
+        """
+        Download `url` and write the response body to `filename`.
+
+        HTTP(S) URLs are requested over the keep-alive connections of the connection pool.
+        Other URLs, for example file or FTP URLs, are opened with urllib, but written, validated and journaled in the same way.
+        The body is streamed in blocks of `buffer_size` bytes into a temporary file, 
+        which is renamed to `filename` only after the download has succeeded.
+        With admission control, the URL is requested only once the transfer has been admitted.
+
+        Args:
+            url (str): URL to the source
+            filename (str): Local path where the file is stored.
+            result (DownloadResult): Receives the size and the timing of the download, if given.
+
+        Returns:
+            str: "downloaded", or "not_modified" if the file has not changed since the last download in refresh mode.
+
+        Raises:
+            IOError: If the file download fails or the server answers with an error status.
+        """
+
+        import time
+
+        if result is None:
+            result = DownloadResult(url, filename)
+
+        throttle = self.throttle
+
+        if throttle is not None:
+            host = throttle.host(url)
+            time.sleep(throttle.request_delay(host))
+
+        self.metrics.record_request()
+
+        transfer = FileTransfer(self, url, filename)
 
         try:
-            urlretrieve(url, filename)
-            print("done.")
-        except IOError as e:
-            print("failed.")
+            # Wait until the admission control lets the transfer open a file.
+            delay = transfer.admit()
+
+            while delay is not None:
+                self.admission.wait(delay)
+                delay = transfer.admit()
+
+            result.admission_time = transfer.admission_time
+            requested = time.time()
+
+            # Other URLs cannot use the connection pool, but they are validated, journaled and deduplicated in the same way.
+            if url.startswith("http://") or url.startswith("https://"):
+                response = self.connection_pool.urlopen(url, transfer.request_headers)
+            else:
+                response = URLLibResponse(url)
+
+            with response:
+                # The connection times are measured by the pool, the remaining time is spent waiting for the response.
+                received = time.time()
+                result.dns_time = response.dns_time
+                result.connect_time = response.connect_time
+                result.first_byte_time = received - requested - (response.dns_time or 0.0) - (response.connect_time or 0.0)
+
+                if transfer.start(response.status, response.reason, response.headers):
+                    while True:
+                        block = response.read(self.buffer_size)
+
+                        if not block:
+                            break
+
+                        transfer.write(block)
+
+                        if throttle is not None:
+                            delay = throttle.transfer_delay(host, len(block))
+
+                            if delay > 0:
+                                time.sleep(delay)
+
+                result.size = response.bytes_read
+
+            status = transfer.finish()
+            result.transfer_time = time.time() - received
+            result.file_size = transfer.size
+            result.sha256 = transfer.digest
+
+            return status
+        except BaseException:
+            transfer.abort()
             raise
 
     def download(self, urls):
         """
         Download a set of files from the given URLs to the local folder defined in the download_directory attribute.   
 
+        If more than one worker is configured, the URLs are read lazily from `urls` into a bounded queue
+        and downloaded concurrently. Unless `keep_going` is set, the first failed download stops reading further URLs 
+        and is raised once the files that are already in progress have finished. A summary is printed at the end.
+
         Args:
             urls (iterable): an iterable list of URLs that will be downloaded to the folder specified in the download_directory attribute.
 
+        Returns:
+            DownloadStatistics: Number of downloaded, skipped and failed files.
+
         Raises:
             TypeError: if `urls` is not an iterable object or the entries of `urls` are not of type string.
+            IOError: If a file download fails and `keep_going` is not set.
         """
 
-        # We need the OS module for portable joining of paths     
-        import os
+        statistics = self.run(urls)
+
+        print(self.summary(statistics))
+
+        return statistics
+
+    def results(self, urls, close = False):
+        """
+        Download a set of files in the background and return an iterator over their results as they are completed.
+
+        Unlike download(), nothing is printed apart from the messages per file of a verbose downloader. 
+        The downloads wait while the caller has not yet taken `queue_size` results, so the results of a batch 
+        are never buffered as a whole. The `summary` attribute of the iterator is available once it is exhausted.
+
+        Args:
+            urls (iterable): an iterable list of URLs that will be downloaded to the folder specified in the download_directory attribute.
+            close (bool): If True, the downloader is closed once the iterator is exhausted or closed.
+
+        Returns:
+            DownloadResults: An iterator over a DownloadResult for every URL.
+
+        Example:
+            results = downloader.results(urls)
+
+            for result in results:
+                print(result.url, result.status, result.filename, result.size, result.duration, result.error)
+
+            print(results.summary.statistics.failed)
+        """
+
+        return DownloadResults(self, urls, close)
+
+    def run(self, urls, statistics = None, cancelled = None):
+        """
+        Download a set of files from the given URLs without printing a summary.
+
+        Args:
+            urls (iterable): an iterable list of URLs that will be downloaded to the folder specified in the download_directory attribute.
+            statistics (DownloadStatistics): Counters that are updated during the download. By default, new counters are created.
+            cancelled (threading.Event): If given and set, no further URLs are read and the download stops 
+                once the files in progress have finished.
+
+        Returns:
+            DownloadStatistics: Number of downloaded, skipped and failed files.
+
+        Raises:
+            TypeError: if `urls` is not an iterable object or the entries of `urls` are not of type string.
+            IOError: If a file download fails and `keep_going` is not set.
+        """
 
         # Check if the urls list is an iterable and throw a Type Error otherwise.
 
@@ -358,23 +5265,283 @@ class BatchDownloader:
             print("Error: " + repr(urls) + " object is not iterable.")
             raise
 
-        # Iterate over the list of URLS and download them to the download directory
-        for url in urls:
-            # Get the filename without its path by splitting the URL at the last '/' and taking the right substring
-            # If the rsplit method is not found, throw a Type Error as the URL does not appear to be a string.
+        if statistics is None:
+            statistics = DownloadStatistics()
+
+        # Drop repeated URLs before any request is sent.
+        if self.deduplication_index is not None:
+            iterator = self.unique_urls(iterator, statistics)
+
+        self.start_hooks(urls)
+
+        try:
+            if self.workers == 1:
+                # Iterate over the list of URLS and download them to the download directory
+                for url in iterator:
+                    if cancelled is not None and cancelled.is_set():
+                        break
+
+                    filename = self.local_filename(url)
+
+                    # Download the file from the URL and save it with the given filename
+                    try:
+                        statistics.add(self.download_file(url, filename))
+                    except Exception as e:
+                        statistics.add("failed")
+
+                        if not self.keep_going or not isinstance(e, IOError):
+                            raise
+            else:
+                self.download_concurrently(iterator, statistics, cancelled)
+        finally:
+            self.finish_hooks()
+
+            if self.thumbnails is not None:
+                self.thumbnails.wait()
+
+        return statistics
+
+    def unique_urls(self, iterator, statistics):
+        """
+        Yield the URLs of `iterator` that have not occurred before and count the repeated URLs as duplicates.
+
+        Args:
+            iterator (iterator): an iterator over URLs.
+            statistics (DownloadStatistics): Counters for the repeated URLs.
+        """
+
+        seen = set()
+
+        for url in iterator:
+            if url in seen:
+                statistics.add("duplicate")
+                self.notify(DownloadResult(url, status = "duplicate"))
+                continue
+
+            seen.add(url)
+
+            yield url
+
+    def summary(self, statistics):
+        """Return the summary line that is printed at the end of a download."""
+
+        summary = "Done. " + str(statistics)
+
+        # Both engines count their connections in the connection pool. Without any request, there is nothing to report.
+        if self.connection_pool.connections_opened > 0:
+            summary += " " + str(self.connection_pool)
+
+        if self.deduplication_index is not None:
+            summary += " " + str(self.deduplication_index)
+
+        if self.thumbnails is not None:
+            summary += " " + str(self.thumbnails)
+
+        if self.manifest is not None and self.manifest.previous is not None:
+            summary += " " + str(self.manifest)
+
+        if self.admission is not None and (self.admission.pauses > 0 or self.admission.waited > 0):
+            summary += " " + str(self.admission)
+
+        return summary
+
+    def download_concurrently(self, iterator, statistics, cancelled = None):
+        """
+        Download the URLs of an iterator with a pool of worker threads.
+
+        The iterator is consumed lazily: at most `queue_size` URLs are waiting for a free worker at any time.
+        Files with the same local filename are never written by two workers at once.
+
+        Args:
+            iterator (iterator): an iterator over URLs.
+            statistics (DownloadStatistics): Counters that are updated by the workers.
+            cancelled (threading.Event): If given and set, no further URLs are read.
+
+        Raises:
+            TypeError: if the entries of `iterator` are not of type string.
+            IOError: If a file download fails and `keep_going` is not set.
+            Exception: Any other error of a worker, which stops the download once the files in progress have finished.
+        """
+
+        import threading
+
+        # For compatibility, try both Queue (Python 2) and queue (Python 3)
+
+        try:
+            import Queue as queue
+        except ImportError:
+            import queue
+
+        tasks = queue.Queue(maxsize = self.queue_size)
+        errors = []
+        stop = threading.Event()
+
+        def worker():
+            while True:
+                task = tasks.get()
+
+                # A None task signals the end of the URL list.
+                if task is None:
+                    return
+
+                # After a failure, drain the queue without downloading anything else.
+                if stop.is_set():
+                    continue
+
+                url, filename = task
+
+                # Workers hold a lock per filename while downloading, so duplicate URLs in the list are processed one after another.
+                with self.filename_locks_guard:
+                    entry = self.filename_locks.setdefault(filename, [threading.Lock(), 0])
+                    entry[1] += 1
+
+                # Any error is caught, so that the worker keeps draining the queue and the producer never blocks on a full queue.
+                # Errors other than IOError are unexpected and stop the download even if `keep_going` is set.
+                try:
+                    with entry[0]:
+                        statistics.add(self.download_file(url, filename))
+                except Exception as e:
+                    statistics.add("failed")
+
+                    if not self.keep_going or not isinstance(e, IOError):
+                        errors.append(e)
+                        stop.set()
+                finally:
+                    # The lock of a file is dropped with its last download, so that the locks do not grow with the list.
+                    with self.filename_locks_guard:
+                        entry[1] -= 1
+
+                        if entry[1] == 0:
+                            del self.filename_locks[filename]
+
+        threads = [threading.Thread(target = worker) for _ in range(self.workers)]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for url in iterator:
+                if stop.is_set() or (cancelled is not None and cancelled.is_set()):
+                    break
+
+                # Blocks while the queue is full, so the iterator is never read far ahead of the workers.
+                tasks.put((url, self.local_filename(url)))
+        finally:
+            # Send one stop signal per worker and wait until all files in progress are done.
+            for _ in threads:
+                tasks.put(None)
+
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+class ShardCoordinator:
+    """
+    Download the shards of a list file in separate processes and merge their results.
+
+    Each process downloads one shard with its own downloader, so TLS handshakes and file writes are spread over
+    several cores. If the configuration itself selects a shard, for example one shard per machine, this shard is split
+    further, so that the shards of all machines and processes never overlap.
+
+    Attributes:
+        config (ArgumentParser): The configuration, or any other object with the same properties that can be pickled.
+        processes (int): Number of processes.
+        statistics (DownloadStatistics): Merged statistics of the shards that have finished.
+        metrics (DownloadMetrics): Merged metrics of the shards that have finished.
+    """
+
+    def __init__(self, config, processes):
+        """
+        Prepare a sharded download.
+
+        Args:
+            config (ArgumentParser): The configuration, including the shard index and the shard count of this machine.
+            processes (int): Number of processes.
+
+        Raises:
+            ValueError: If the number of processes is smaller than 1.
+        """
+
+        if processes < 1:
+            raise ValueError("The number of processes must be at least 1, got " + repr(processes) + ".")
+
+        self.config = config
+        self.processes = processes
+        self.statistics = DownloadStatistics()
+        self.metrics = DownloadMetrics()
+
+    def shards(self):
+        """Return the indices of the shards of this machine and the total number of shards."""
+
+        shard_count = self.config.shard_count * self.processes
+        first = self.config.shard_index * self.processes
+
+        return list(range(first, first + self.processes)), shard_count
+
+    def run(self):
+        """
+        Download all shards and print a summary for each shard and for all shards.
+
+        Returns:
+            DownloadStatistics: The merged statistics of all shards.
+
+        Raises:
+            IOError: If a shard has failed, after all other shards have finished.
+        """
+
+        shard_indices, shard_count = self.shards()
+        tasks = [(self.config, shard_index, shard_count, self.processes) for shard_index in shard_indices]
+        errors = []
+
+        for shard_index, statistics, metrics, error in self.map(tasks):
+            if statistics is not None:
+                self.statistics.merge(statistics)
+
+            if metrics is not None:
+                self.metrics.merge(metrics)
+
+            if error is not None:
+                print("Shard " + str(shard_index) + " of " + str(shard_count) + " failed: " + error)
+                errors.append(error)
+
+        print("Done with " + str(len(shard_indices)) + " shards. " + str(self.statistics) + " " + \
+            str(self.metrics.bytes) + " bytes received.")
+
+        if errors:
+            raise IOError(errors[0])
+
+        return self.statistics
+
+    def map(self, tasks):
+        """Run run_shard_process() for every task in a pool of processes and yield the results as they arrive."""
+
+        # Unlike the processes of multiprocessing.Pool, the processes of the executor may start processes of their own,
+        # for example to create thumbnails. Without the concurrent.futures module (Python 2), thumbnails are not 
+        # available anyway, so multiprocessing.Pool is used instead.
+        try:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+        except ImportError:
+            import multiprocessing
+
+            pool = multiprocessing.Pool(self.processes)
 
             try:
-                filename_without_path = url.rsplit('/', 1)[-1]
-            except AttributeError:
-                raise TypeError("Error: " + repr(url) + " object in " + repr(urls) + " is not of type string.")
+                for result in pool.imap_unordered(run_shard_process, tasks):
+                    yield result
+            finally:
+                pool.close()
+                pool.join()
 
-            # Combine the filename with the download directory to get the local filename
-            filename = os.path.join(self.download_directory, filename_without_path)
-            
-            # Download the file from the URL and save it with the given filename
-            self.download_file(url, filename)
+            return
+
+        with ProcessPoolExecutor(max_workers = self.processes) as executor:
+            futures = [executor.submit(run_shard_process, task) for task in tasks]
 
-        print("Done.")
+            for future in as_completed(futures):
+                yield future.result()
 
 # If this is the main document, call the main function to read in program arguments.
 if __name__ == "__main__":
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+
+"""
+BatchJPEGDownloader, Copyright (c) 2016 Oliver Meister (o.meister@gmx.net)
+
+Throughput benchmark for BatchDownloader.download() against the local mock image server.
+
+For every combination of list size, file size distribution and number of workers, the benchmark downloads 
+a list of synthetic JPEG files into a new temporary directory and measures files per second, megabytes per second, 
+the 50th and 99th percentile of the time per file and the peak resident set size of the downloading process. 
+Each case runs in a separate process, so that the peak memory of one case does not affect the next one. 
+The mock server runs in a separate process as well. The results are printed as one JSON object per line.
+
+Usage:
+   $ python benchmarks/bench_download.py --files 100,1000 --distributions fixed,lognormal --workers 1,16 --latency 0.01
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(BENCHMARK_DIRECTORY, ".."))
+
+# File size distributions with their parameters, in bytes.
+DISTRIBUTIONS = {
+    # All files have the same small size, like thumbnails.
+    "fixed": lambda generator: 16 * 1024,
+    # Most files are about 100 kB, with a long tail of larger files, like photos.
+    "lognormal": lambda generator: int(min(generator.lognormvariate(11.5, 1.0), 20 * 1024 * 1024)),
+    # Most files are small, but a few are very large, like a catalog with some panoramas.
+    "pareto": lambda generator: int(min(8 * 1024 * generator.paretovariate(1.2), 50 * 1024 * 1024)),
+}
+
+def file_sizes(distribution, files, seed = 1):
+    """Return the sizes of `files` files drawn from `distribution` with a fixed random seed."""
+
+    generator = random.Random(seed)
+
+    return [DISTRIBUTIONS[distribution](generator) for _ in range(files)]
+
+def peak_rss_kilobytes():
+    """Return the peak resident set size of the current process in kilobytes."""
+
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is given in bytes on macOS and in kilobytes on Linux.
+    if sys.platform == "darwin":
+        peak //= 1024
+
+    return peak
+
+def percentile(values, fraction):
+    """Return the value at `fraction` of the sorted `values`."""
+
+    if not values:
+        return None
+
+    values = sorted(values)
+
+    return values[int(round(fraction * (len(values) - 1)))]
+
+def run_case(case):
+    """
+    Download the files of a single case and return its results.
+
+    This function runs in a separate process for every case.
+    """
+
+    from batchjpegdownloader import BatchDownloader
+
+    durations = []
+
+    if case["engine"] == "async":
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        class MeasuringDownloader(AsyncBatchDownloader):
+            """Record the time of every file and count failed files instead of stopping the batch."""
+
+            async def download_file_async(self, url, filename):
+                start = time.time()
+
+                try:
+                    return await AsyncBatchDownloader.download_file_async(self, url, filename)
+                except IOError:
+                    return "failed"
+                finally:
+                    durations.append(time.time() - start)
+    else:
+        class MeasuringDownloader(BatchDownloader):
+            """Record the time of every file and count failed files instead of stopping the batch."""
+
+            def download_file(self, url, filename):
+                start = time.time()
+
+                try:
+                    return BatchDownloader.download_file(self, url, filename)
+                except IOError:
+                    return "failed"
+                finally:
+                    durations.append(time.time() - start)
+
+    sizes = file_sizes(case["distribution"], case["files"])
+    urls = [case["url_prefix"] + str(size) + "/image" + str(i) + ".jpg" for i, size in enumerate(sizes)]
+
+    directory = tempfile.mkdtemp()
+    stdout = sys.stdout
+
+    try:
+        downloader = MeasuringDownloader(directory, workers = case["workers"])
+
+        # Discard the progress messages of the downloader.
+        with open(os.devnull, "w") as devnull:
+            sys.stdout = devnull
+
+            try:
+                start = time.time()
+                statistics = downloader.download(urls)
+                elapsed = time.time() - start
+            finally:
+                sys.stdout = stdout
+
+        downloaded_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    finally:
+        shutil.rmtree(directory)
+
+    result = dict(case)
+    del result["url_prefix"]
+
+    result.update({
+        "benchmark": "download",
+        "downloaded": statistics.downloaded,
+        "failed": statistics.failed,
+        "bytes": downloaded_bytes,
+        "seconds": round(elapsed, 4),
+        "files_per_second": round(case["files"] / elapsed, 2),
+        "megabytes_per_second": round(downloaded_bytes / elapsed / 1e6, 3),
+        "p50_milliseconds": round(1000 * percentile(durations, 0.5), 3),
+        "p99_milliseconds": round(1000 * percentile(durations, 0.99), 3),
+        "peak_rss_kilobytes": peak_rss_kilobytes(),
+    })
+
+    return result
+
+def start_server(arguments):
+    """Start the mock server in a separate process and return the process and the URL prefix of its files."""
+
+    command = [sys.executable, os.path.join(BENCHMARK_DIRECTORY, "mockserver.py"), "--latency", str(arguments.latency), \
+        "--error-rate", str(arguments.error_rate)]
+
+    if arguments.bandwidth:
+        command += ["--bandwidth", str(arguments.bandwidth)]
+
+    process = subprocess.Popen(command, stdout = subprocess.PIPE)
+    url_prefix = process.stdout.readline().decode("ascii").strip()
+
+    return process, url_prefix
+
+def integer_list(text):
+    """Parse a comma-separated list of integers."""
+    return [int(value) for value in text.split(",")]
+
+def main():
+    """Parse the arguments, run every case in a separate process and print the results."""
+
+    parser = argparse.ArgumentParser(description = "Measure the throughput of BatchDownloader against a local mock image server.")
+    parser.add_argument("--files", type = integer_list, default = [100, 1000], help = "Comma-separated list sizes (default: 100,1000).")
+    parser.add_argument("--distributions", type = lambda text: text.split(","), default = ["fixed", "lognormal"], \
+        help = "Comma-separated file size distributions out of " + ", ".join(sorted(DISTRIBUTIONS)) + " (default: fixed,lognormal).")
+    parser.add_argument("--workers", type = integer_list, default = [1, 16], help = "Comma-separated numbers of workers (default: 1,16).")
+    parser.add_argument("--engine", choices = ["thread", "async"], default = "thread", help = "Download engine (default: thread).")
+    parser.add_argument("--latency", type = float, default = 0.005, help = "Latency of the server in seconds (default: 0.005).")
+    parser.add_argument("--bandwidth", type = int, default = None, help = "Bytes per second per connection (default: unlimited).")
+    parser.add_argument("--error-rate", type = float, default = 0.0, help = "Fraction of files answered with HTTP 500 (default: 0).")
+    parser.add_argument("--output", type = str, default = None, help = "Append the results to this file instead of printing them.")
+    parser.add_argument("--case", type = str, default = None, help = argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    # Run a single case in this process and print its result for the parent process.
+    if arguments.case is not None:
+        print(json.dumps(run_case(json.loads(arguments.case)), sort_keys = True))
+        return
+
+    server, url_prefix = start_server(arguments)
+    output = open(arguments.output, "a") if arguments.output else sys.stdout
+
+    try:
+        for distribution in arguments.distributions:
+            for files in arguments.files:
+                for workers in arguments.workers:
+                    case = {"files": files, "distribution": distribution, "workers": workers, "engine": arguments.engine, \
+                        "latency": arguments.latency, "bandwidth": arguments.bandwidth, "error_rate": arguments.error_rate, \
+                        "url_prefix": url_prefix}
+
+                    result = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--case", json.dumps(case)])
+
+                    output.write(result.decode("utf-8"))
+                    output.flush()
+    finally:
+        server.terminate()
+        server.wait()
+
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+
+"""
+BatchJPEGDownloader, Copyright (c) 2016 Oliver Meister (o.meister@gmx.net)
+
+Benchmark for reading large list files with the ListFileURLGenerator class.
+
+The benchmark writes a synthetic list file and measures the time until the first URL is generated and the number 
+of lines per second that are read until the last URL has been generated, for the original two-pass algorithm, 
+the default mode and the lazy mode. The results are printed as one JSON object per line.
+Note that the validation pass of the baseline and the default mode is skipped if the validators package is not installed.
+
+Usage:
+   $ python benchmarks/bench_listfile.py --lines 1000000
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from batchjpegdownloader import ListFileURLGenerator
+
+def baseline(filename, pattern):
+    """
+    Generate the URLs of a list file with the algorithm that ListFileURLGenerator used before the lazy mode was added:
+    a validation pass over the whole file, followed by a second pass that calls fnmatch and prints a warning for every ignored line.
+    """
+
+    try:
+        import validators
+    except ImportError:
+        validators = None
+
+    with open(filename, "r") as list_file:
+        for url in list_file:
+            url = url.strip()
+
+            if url and validators is not None and not validators.url(url):
+                raise ValueError("Invalid URL: " + repr(url))
+
+    with open(filename, "r") as list_file:
+        for url in list_file:
+            url = url.strip()
+
+            if url != "":
+                if fnmatch.fnmatch(url, pattern):
+                    yield url
+                else:
+                    print("Warning: Ignoring file " + repr(url) + ", as it does not appear to be of type " + repr(pattern) + ".")
+
+def write_list(filename, lines, mismatch_ratio):
+    """Write a list file with `lines` URLs, of which a fraction of `mismatch_ratio` does not end with '.jpg'."""
+
+    mismatch_every = int(1 / mismatch_ratio) if mismatch_ratio > 0 else 0
+
+    with open(filename, "w") as list_file:
+        for i in range(lines):
+            extension = ".png" if mismatch_every and i % mismatch_every == 0 else ".jpg"
+            list_file.write("https://cdn" + str(i % 4) + ".example.com/images/" + str(i // 1000) + "/image" + str(i) + extension + "\n")
+
+def measure(name, lines, generate):
+    """Run `generate` with the standard output discarded and return the result record of the benchmark."""
+
+    stdout = sys.stdout
+
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+
+        try:
+            start = time.time()
+            iterator = iter(generate())
+            next(iterator)
+            first = time.time() - start
+            count = 1 + sum(1 for _ in iterator)
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = stdout
+
+    return {"benchmark": "listfile", "mode": name, "lines": lines, "urls": count, "seconds": round(elapsed, 4), \
+        "first_url_seconds": round(first, 6), "lines_per_second": round(lines / elapsed)}
+
+def main():
+    """Parse the arguments, run all modes and print their results."""
+
+    parser = argparse.ArgumentParser(description = "Measure the throughput of ListFileURLGenerator on a synthetic list file.")
+    parser.add_argument("--lines", type = int, default = 1000000, help = "Number of lines of the list file (default: 1000000).")
+    parser.add_argument("--mismatch-ratio", type = float, default = 0.01, \
+        help = "Fraction of lines that do not match the pattern (default: 0.01).")
+    arguments = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        filename = os.path.join(directory, "images.list")
+        write_list(filename, arguments.lines, arguments.mismatch_ratio)
+
+        results = [
+            measure("baseline", arguments.lines, lambda: baseline(filename, "*.jpg")),
+            measure("default", arguments.lines, lambda: ListFileURLGenerator(filename, "*.jpg")),
+            measure("lazy", arguments.lines, lambda: ListFileURLGenerator(filename, "*.jpg", lazy = True)),
+        ]
+    finally:
+        shutil.rmtree(directory)
+
+    for result in results:
+        print(json.dumps(result, sort_keys = True))
+
+if __name__ == "__main__":
+    main()
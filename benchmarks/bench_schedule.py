@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+"""
+BatchJPEGDownloader, Copyright (c) 2016 Oliver Meister (o.meister@gmx.net)
+
+Makespan benchmark for the policies of the DownloadScheduler against the local mock image server.
+
+For every file size distribution and policy, the benchmark downloads the same list of synthetic JPEG files with
+a pool of workers from a server with a limited bandwidth per connection, so that the time of a file grows with its size.
+It measures the makespan (the time until the last file is done) and the mean completion time of the files.
+With skewed distributions, a few large files near the end of the list keep single workers busy long after the others
+have finished; the largest-first policy starts them early. Sizes are either taken from size annotations or probed
+with HEAD requests. The results are printed as one JSON object per line.
+
+Usage:
+   $ python benchmarks/bench_schedule.py --files 200 --distributions lognormal,pareto --workers 8 --bandwidth 1000000
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bench_download import DISTRIBUTIONS, file_sizes, integer_list, start_server
+from batchjpegdownloader import AnnotatedURL, BatchDownloader, DownloadScheduler
+
+# Policies of the benchmark: the name of the case, the policy of the scheduler and whether sizes are probed.
+CASES = [("order", "order", False), ("largest", "largest", False), ("largest-probed", "largest", True), \
+    ("shortest", "shortest", False)]
+
+def list_urls(url_prefix, sizes, placement, annotated):
+    """
+    Return the URLs of files with the given sizes, with size annotations if `annotated` is set.
+
+    With the placement "tail", the largest tenth of the files is moved to the end of the list.
+    """
+
+    names = [(size, "image" + str(i)) for i, size in enumerate(sizes)]
+
+    if placement == "tail":
+        threshold = sorted(sizes)[int(0.9 * len(sizes))]
+        names = [name for name in names if name[0] < threshold] + [name for name in names if name[0] >= threshold]
+
+    urls = [url_prefix + str(size) + "/" + name + ".jpg" for size, name in names]
+
+    if annotated:
+        return [AnnotatedURL(url, size = size) for url, (size, _) in zip(urls, names)]
+
+    return urls
+
+def run_case(name, policy, probe, urls, workers, window):
+    """Download `urls` in the order of a scheduler and return the makespan and the completion times of the files."""
+
+    directory = tempfile.mkdtemp()
+    stdout = sys.stdout
+
+    try:
+        downloader = BatchDownloader(directory, workers = workers, keep_going = True)
+        completions = []
+        downloader.add_hook(lambda result: completions.append(time.time()))
+
+        # Discard the messages of the downloader.
+        with open(os.devnull, "w") as devnull:
+            sys.stdout = devnull
+
+            try:
+                start = time.time()
+                scheduler = DownloadScheduler(urls, policy = policy, window = window, probe = probe, \
+                    connection_pool = downloader.connection_pool)
+                statistics = downloader.download(scheduler)
+                makespan = time.time() - start
+            finally:
+                sys.stdout = stdout
+    finally:
+        shutil.rmtree(directory)
+
+    return {
+        "benchmark": "schedule",
+        "policy": name,
+        "downloaded": statistics.downloaded,
+        "failed": statistics.failed,
+        "probed": scheduler.probed,
+        "makespan_seconds": round(makespan, 3),
+        "mean_completion_seconds": round(sum(completion - start for completion in completions) / len(completions), 3),
+    }
+
+def main():
+    """Parse the arguments, start the mock server and print the results of every distribution and policy."""
+
+    parser = argparse.ArgumentParser(description = "Measure the makespan of the DownloadScheduler policies against a local mock image server.")
+    parser.add_argument("--files", type = int, default = 200, help = "Number of files (default: 200).")
+    parser.add_argument("--distributions", type = lambda text: text.split(","), default = ["lognormal", "pareto"], \
+        help = "Comma-separated file size distributions out of " + ", ".join(sorted(DISTRIBUTIONS)) + " (default: lognormal,pareto).")
+    parser.add_argument("--workers", type = integer_list, default = [8], help = "Comma-separated numbers of workers (default: 8).")
+    parser.add_argument("--window", type = int, default = 1000, help = "Lookahead window of the scheduler (default: 1000).")
+    parser.add_argument("--placement", choices = ["random", "tail"], default = "tail", \
+        help = "Order of the list: random, or with the largest tenth of the files at the end (default: tail).")
+    parser.add_argument("--latency", type = float, default = 0.005, help = "Latency of the server in seconds (default: 0.005).")
+    parser.add_argument("--bandwidth", type = int, default = 1000000, help = "Bytes per second per connection (default: 1000000).")
+    parser.add_argument("--seed", type = int, default = 1, help = "Random seed of the file sizes (default: 1).")
+    arguments = parser.parse_args()
+    arguments.error_rate = 0.0
+
+    server, url_prefix = start_server(arguments)
+
+    try:
+        for distribution in arguments.distributions:
+            sizes = file_sizes(distribution, arguments.files, arguments.seed)
+
+            for workers in arguments.workers:
+                for name, policy, probe in CASES:
+                    urls = list_urls(url_prefix, sizes, arguments.placement, annotated = not probe)
+                    result = run_case(name, policy, probe, urls, workers, arguments.window)
+
+                    result.update({"files": arguments.files, "distribution": distribution, "workers": workers, \
+                        "placement": arguments.placement, "megabytes": round(sum(sizes) / 1e6, 3), \
+                        "bandwidth": arguments.bandwidth, "latency": arguments.latency})
+
+                    print(json.dumps(result, sort_keys = True))
+                    sys.stdout.flush()
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
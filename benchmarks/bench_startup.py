@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+"""
+BatchJPEGDownloader, Copyright (c) 2016 Oliver Meister (o.meister@gmx.net)
+
+Startup benchmark for the command line tool against the local mock image server.
+
+For small incremental lists, the time until the first request is sent dominates the run time of the tool.
+The benchmark starts the tool repeatedly with a small list file in the default mode, the lazy mode and without URL checks
+and measures the time from starting the process to the first request, which is taken from the JSON log of the tool,
+and the total run time of the process. The results are printed as one JSON object per line.
+
+Usage:
+   $ python benchmarks/bench_startup.py --files 10 --runs 20
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, BENCHMARK_DIRECTORY)
+
+from bench_download import percentile, start_server
+
+# Modes of the benchmark with their command line arguments.
+MODES = [("default", []), ("lazy", ["--lazy"]), ("no-url-check", ["--no-url-check"])]
+
+def run_tool(arguments, list_filename, directory):
+    """Run the tool once and return the seconds until the first request and until the process has finished."""
+
+    log_filename = os.path.join(directory, "log.jsonl")
+    output_directory = os.path.join(directory, "output")
+    command = [sys.executable, os.path.join(BENCHMARK_DIRECTORY, "..", "batchjpegdownloader.py"), "-o", output_directory, \
+        "-c", "True", "-f", "True", "--log-json", log_filename] + arguments + [list_filename]
+
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        subprocess.check_call(command, stdout = devnull)
+        elapsed = time.time() - start
+
+    with open(log_filename) as log_file:
+        first_request = min(json.loads(line)["started"] for line in log_file) - start
+
+    os.remove(log_filename)
+
+    return first_request, elapsed
+
+def main():
+    """Parse the arguments, start the mock server and print the results of every mode."""
+
+    parser = argparse.ArgumentParser(description = "Measure the time to the first request of the command line tool.")
+    parser.add_argument("--files", type = int, default = 10, help = "Number of URLs in the list file (default: 10).")
+    parser.add_argument("--runs", type = int, default = 20, help = "Number of runs per mode (default: 20).")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "Latency of the server in seconds (default: 0).")
+    arguments = parser.parse_args()
+    arguments.bandwidth = None
+    arguments.error_rate = 0.0
+
+    server, url_prefix = start_server(arguments)
+    directory = tempfile.mkdtemp()
+
+    try:
+        list_filename = os.path.join(directory, "list.txt")
+
+        with open(list_filename, "w") as list_file:
+            for i in range(arguments.files):
+                list_file.write(url_prefix + "16384/image" + str(i) + ".jpg\n")
+
+        for mode, mode_arguments in MODES:
+            measurements = [run_tool(mode_arguments, list_filename, directory) for _ in range(arguments.runs)]
+            first_requests = [first_request for first_request, _ in measurements]
+            totals = [total for _, total in measurements]
+
+            print(json.dumps({"benchmark": "startup", "mode": mode, "files": arguments.files, "runs": arguments.runs, \
+                "p50_first_request_milliseconds": round(1000 * percentile(first_requests, 0.5), 2), \
+                "p90_first_request_milliseconds": round(1000 * percentile(first_requests, 0.9), 2), \
+                "p50_total_milliseconds": round(1000 * percentile(totals, 0.5), 2)}, sort_keys = True))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+        server.terminate()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+
+"""
+BatchJPEGDownloader, Copyright (c) 2016 Oliver Meister (o.meister@gmx.net)
+
+Local mock image server for the benchmarks of BatchJPEGDownloader.
+
+The server answers every request for '/<size>/<name>.jpg' with a synthetic JPEG file of exactly <size> bytes,
+after an artificial latency and at a limited bandwidth per connection. A configurable fraction of the paths
+is answered with a server error. Errors are derived from a hash of the path, so they are the same in every run.
+HEAD requests are answered with the headers of the file, for example to probe its size. Connections are kept alive.
+
+It may be started from the terminal using
+
+   $ python benchmarks/mockserver.py --port 8000 --latency 0.02 --bandwidth 1000000 --error-rate 0.01
+
+and prints the URL prefix of its files on the first line of its output.
+"""
+
+import argparse
+import sys
+import threading
+import time
+import zlib
+
+# For compatibility, try both the Python 2 and the Python 3 module names of the HTTP server.
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+# Size of the blocks in which the body is sent.
+BLOCK_SIZE = 64 * 1024
+
+# Filler data for the body of the synthetic JPEG files.
+FILLER = b"\x00" * BLOCK_SIZE
+
+class MockImageRequestHandler(BaseHTTPRequestHandler):
+    """Answer requests for synthetic JPEG files as configured in the server."""
+
+    protocol_version = "HTTP/1.1"
+
+    # Send small writes such as the end of image marker immediately instead of waiting for the acknowledgement of the previous write.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        """Send a synthetic JPEG file, a server error or a 404 error if the path is malformed."""
+        self.send_file(True)
+
+    def do_HEAD(self):
+        """Send the headers of a synthetic JPEG file, a server error or a 404 error if the path is malformed."""
+        self.send_file(False)
+
+    def send_file(self, with_body):
+        """Answer a request for a synthetic JPEG file after the latency of the server, with or without the body."""
+
+        time.sleep(self.server.latency)
+
+        parts = self.path.split("/")
+
+        try:
+            size = int(parts[1])
+        except (IndexError, ValueError):
+            self.send_error(404)
+            return
+
+        # Choose the failing paths by a hash of the path, so that they are the same in every run.
+        if self.server.error_rate > 0 and (zlib.crc32(self.path.encode("utf-8")) & 0xffffffff) / 4294967296.0 < self.server.error_rate:
+            self.send_error(500)
+            return
+
+        size = max(size, 4)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(size))
+        self.send_header("ETag", '"' + str(size) + '"')
+        self.end_headers()
+
+        if not with_body:
+            return
+
+        # Start of image marker, filler data and end of image marker.
+        self.send_body(b"\xff\xd8", 2)
+        self.send_body(None, size - 4)
+        self.send_body(b"\xff\xd9", 2)
+
+    def send_body(self, data, size):
+        """Send `data`, or `size` bytes of filler data if `data` is None, at the bandwidth of the server."""
+
+        bandwidth = self.server.bandwidth
+
+        while size > 0:
+            block = data if data is not None else FILLER[:size]
+            start = time.time()
+            self.wfile.write(block)
+            size -= len(block)
+
+            # Sleep for the rest of the time that the block takes at the configured bandwidth.
+            if bandwidth:
+                remaining = len(block) / float(bandwidth) - (time.time() - start)
+
+                if remaining > 0:
+                    time.sleep(remaining)
+
+    def log_message(self, format, *args):
+        """Do not log requests, as logging would dominate the run time of the server."""
+        pass
+
+class MockImageServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server for synthetic JPEG files.
+
+    Attributes:
+        latency (float): Time in seconds the server waits before answering a request.
+        bandwidth (int): Maximum number of bytes per second sent over each connection. None means unlimited.
+        error_rate (float): Fraction of the paths that are answered with a server error.
+    """
+
+    daemon_threads = True
+
+    # Accept many concurrent connections without dropping any of them.
+    request_queue_size = 1024
+
+    def __init__(self, host = "127.0.0.1", port = 0, latency = 0.0, bandwidth = None, error_rate = 0.0):
+        """Create the server. It starts answering requests when serve_forever() or start() is called."""
+
+        HTTPServer.__init__(self, (host, port), MockImageRequestHandler)
+
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+
+    @property
+    def url_prefix(self):
+        """URL prefix of the files of this server."""
+        return "http://" + self.server_address[0] + ":" + str(self.server_address[1]) + "/"
+
+    def url(self, size, name):
+        """Return the URL of a synthetic JPEG file with `size` bytes."""
+        return self.url_prefix + str(size) + "/" + name + ".jpg"
+
+    def start(self):
+        """Answer requests in a background thread."""
+
+        thread = threading.Thread(target = self.serve_forever, kwargs = {"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Shut down the server and release its port."""
+
+        self.shutdown()
+        self.server_close()
+
+def main():
+    """Parse the arguments and run the server until it is interrupted."""
+
+    parser = argparse.ArgumentParser(description = "Serve synthetic JPEG files for the benchmarks of BatchJPEGDownloader.")
+    parser.add_argument("--host", type = str, default = "127.0.0.1", help = "Address to listen on (default: 127.0.0.1).")
+    parser.add_argument("--port", type = int, default = 0, help = "Port to listen on (default: a free port).")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "Latency in seconds before each response (default: 0).")
+    parser.add_argument("--bandwidth", type = int, default = None, help = "Bytes per second per connection (default: unlimited).")
+    parser.add_argument("--error-rate", type = float, default = 0.0, help = "Fraction of paths answered with HTTP 500 (default: 0).")
+    arguments = parser.parse_args()
+
+    server = MockImageServer(arguments.host, arguments.port, arguments.latency, arguments.bandwidth, arguments.error_rate)
+
+    print(server.url_prefix)
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -6,8 +6,254 @@ This file contains a set of unit tests for the ListFileURLGenerator class and th
 batchjpegdownloader.py
 """
 
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from batchjpegdownloader import ListFileURLGenerator, BatchDownloader
+from batchjpegdownloader import ListFileURLGenerator, BatchDownloader, HTTPConnectionPool, HTTPStatusError, RetryPolicy, CircuitBreaker, \
+    Throttle, InvalidFileError
+
+# For compatibility, try both the Python 2 and the Python 3 module names of the HTTP server.
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+# Minimal JPEG payload: start of image marker, some data and end of image marker.
+JPEG_DATA = b"\xff\xd8\xff\xe0" + b"\x00" * 1024 + b"\xff\xd9"
+
+# Repeating pattern for the body of large files, so that every byte depends on its position.
+PATTERN = bytes(bytearray(i % 251 for i in range(251)))
+
+def large_data(start, end):
+    """Return the bytes from position `start` to `end` of a large file served by the local server."""
+    return (PATTERN * ((end - start) // len(PATTERN) + 2))[start % len(PATTERN):start % len(PATTERN) + end - start]
+
+def quarantine_name(url):
+    """Return the name of the file of `url` in the quarantine directory, with the hash of the URL appended."""
+    import hashlib
+
+    stem, extension = os.path.splitext(url.rsplit("/", 1)[1])
+
+    return stem + "-" + hashlib.sha1(url.encode("utf-8")).hexdigest()[:8] + extension
+
+class LocalImageRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve a JPEG file for every path ending with '.jpg' after an artificial latency and a 404 error otherwise.
+
+    This is a stand-in for a remote image server, so that downloads can be tested without network access.
+    Paths starting with '/redirect' are redirected to the rest of the path. Connections are kept alive.
+    Other files ending with '.jpg' have the ETag of the server and are answered with 304 if it matches If-None-Match.
+    Paths starting with '/large/<size>' are answered with a body of <size> bytes, which supports Range requests,
+    and paths starting with '/truncated' with a body that is shorter than its Content-Length.
+    Paths starting with '/status/<code>' are always answered with the status <code>, and the first <n> requests for
+    a path starting with '/flaky/<n>' with 503 and the Retry-After header of the server.
+    Paths starting with '/html' are answered with an HTML page, as many servers do instead of a 404 error,
+    and paths starting with '/photo' with the photo of the server. HEAD requests are answered for large and JPEG files.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        """Answer a GET request after waiting for the latency of the server."""
+        with self.server.lock:
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+
+        with self.server.lock:
+            self.server.counts[self.path] = self.server.counts.get(self.path, 0) + 1
+            self.server.times.append(time.time())
+            count = self.server.counts[self.path]
+
+        try:
+            time.sleep(self.server.latency)
+
+            if self.path.startswith("/status/"):
+                self.send_error(int(self.path.split("/")[2]))
+            elif self.path.startswith("/flaky/") and count <= int(self.path.split("/")[2]):
+                self.send_response(503)
+                self.send_header("Retry-After", self.server.retry_after)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            elif self.path.startswith("/photo"):
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(self.server.photo)))
+                self.end_headers()
+                self.wfile.write(self.server.photo)
+            elif self.path.startswith("/html"):
+                body = b"<html><body>Not found</body></html>"
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            elif self.path.startswith("/redirect/"):
+                self.send_response(302)
+                self.send_header("Location", self.path[len("/redirect"):])
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            elif self.path.startswith("/large/"):
+                self.send_large_file(int(self.path.split("/")[2]))
+            elif self.path.startswith("/truncated"):
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(2 * len(JPEG_DATA)))
+                self.end_headers()
+                self.wfile.write(JPEG_DATA)
+                self.close_connection = True
+            elif self.path.endswith(".jpg") and self.headers.get("If-None-Match") == self.server.etag:
+                self.send_response(304)
+                self.send_header("ETag", self.server.etag)
+                self.end_headers()
+            elif self.path.endswith(".jpg"):
+                self.send_response(200)
+                self.send_header("ETag", self.server.etag)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(JPEG_DATA)))
+                self.end_headers()
+                self.wfile.write(JPEG_DATA)
+            else:
+                self.send_error(404)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def do_HEAD(self):
+        """Answer a HEAD request with the Content-Length of a large file or a JPEG file."""
+        with self.server.lock:
+            self.server.counts["HEAD " + self.path] = self.server.counts.get("HEAD " + self.path, 0) + 1
+
+        if self.path.startswith("/large/"):
+            size = int(self.path.split("/")[2])
+        elif self.path.endswith(".jpg") and not self.path.startswith("/status/"):
+            size = len(JPEG_DATA)
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+
+    def send_large_file(self, size):
+        """
+        Send a large file of `size` bytes in blocks, so that the server does not hold the whole file in memory.
+
+        Range requests are answered with the rest of the file, unless an If-Range header does not match the ETag.
+        If the `fail_after` attribute of the server is set, the connection is closed after this number of bytes of the body.
+        """
+        etag = '"large-' + str(size) + '"'
+        start = 0
+
+        range_header = self.headers.get("Range")
+        self.server.ranges.append(range_header)
+
+        if range_header is not None and self.headers.get("If-Range", etag) == etag:
+            start = int(range_header.split("=")[1].split("-")[0])
+
+        if start > 0:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes " + str(start) + "-" + str(size - 1) + "/" + str(size))
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(size - start))
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+        end = size
+
+        if self.server.fail_after is not None:
+            end = min(size, start + self.server.fail_after)
+            self.close_connection = True
+
+        for position in range(start, end, 65536):
+            self.wfile.write(large_data(position, min(position + 65536, end)))
+
+    def log_message(self, format, *args):
+        """Do not log requests to keep the test output readable."""
+        pass
+
+class LocalImageServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server on a free local port that runs in a background thread.
+
+    Attributes:
+        latency (float): Time in seconds the server waits before answering a request.
+        active (int): Number of requests that are currently being answered.
+        max_active (int): Maximum number of requests that have been answered at the same time.
+        ranges (list): Range headers of all requests for large files.
+        fail_after (int): If set, transfers of large files are cut off after this number of bytes.
+        etag (str): ETag of all small JPEG files.
+        counts (dict): Number of requests per path.
+        times (list): Arrival times of all requests.
+        retry_after (str): Retry-After header of the responses for flaky paths.
+        photo (bytes): A decodable JPEG image.
+    """
+
+    daemon_threads = True
+
+    # Accept many concurrent connections without dropping any of them.
+    request_queue_size = 64
+
+    def __init__(self, latency = 0.0):
+        """Start the server on a free port of the local host."""
+        HTTPServer.__init__(self, ("127.0.0.1", 0), LocalImageRequestHandler)
+        self.latency = latency
+        self.active = 0
+        self.max_active = 0
+        self.ranges = []
+        self.fail_after = None
+        self.etag = '"jpeg-1"'
+        self.counts = {}
+        self.times = []
+        self.retry_after = "0"
+        self.photo = JPEG_DATA
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target = self.serve_forever, kwargs = {"poll_interval": 0.01})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        """Return the URL of `path` on this server."""
+        return "http://127.0.0.1:" + str(self.server_address[1]) + "/" + path
+
+    def stop(self):
+        """Shut down the server and release its port."""
+        self.shutdown()
+        self.server_close()
+
+class LocalServerTestCase(unittest.TestCase):
+    """
+    Base class for test cases with a local image server and a temporary directory for list files and downloads.
+
+    Attributes:
+        server (object): A local image server, created with the keyword arguments `server_options`.
+        directory (str): A temporary directory.
+    """
+
+    # Keyword arguments of the local image server, such as its latency.
+    server_options = {}
+
+    def setUp(self):
+        """Start a local server and create a temporary directory."""
+        self.server = LocalImageServer(**self.server_options)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Stop the server and remove the temporary directory."""
+        self.server.stop()
+        shutil.rmtree(self.directory)
 
 class TestListFileURLGenerator(unittest.TestCase):
     """
@@ -73,6 +319,74 @@ class TestListFileURLGenerator(unittest.TestCase):
         url_iterator = ListFileURLGenerator("examples/test_invalid_extension.list", "*.jpg")
         assert len([_ for _ in url_iterator]) == 2, repr([_ for _ in url_iterator])
 
+    def test_lazy_valid(self):
+        """Test a valid case in lazy mode."""
+        url_iterator = ListFileURLGenerator("examples/test_valid.list", "*.jpg", lazy = True)
+        assert len([_ for _ in url_iterator]) == 3, repr([_ for _ in url_iterator])
+
+    def test_lazy_invalid_link(self):
+        """Test an invalid link in lazy mode. The code should throw an exception during the iteration, after the valid URLs before it."""
+        url_iterator = ListFileURLGenerator("examples/test_invalid_link.list", "*.jpg", lazy = True)
+        urls = []
+
+        try:
+            for url in url_iterator:
+                urls.append(url)
+
+            # We should not be able to reach this code line
+            assert False
+        except ValueError:
+            # This example should fail with a Value Error
+            assert len(urls) == 1, repr(urls)
+
+    def test_gzip(self):
+        """Test a gzip-compressed list file."""
+        import gzip
+
+        directory = tempfile.mkdtemp()
+
+        try:
+            filename = os.path.join(directory, "test_valid.list.gz")
+
+            with open("examples/test_valid.list", "rb") as list_file:
+                with gzip.open(filename, "wb") as compressed_file:
+                    compressed_file.write(list_file.read())
+
+            url_iterator = ListFileURLGenerator(filename, "*.jpg", lazy = True)
+            assert [_ for _ in url_iterator] == [_ for _ in ListFileURLGenerator("examples/test_valid.list", "*.jpg")]
+        finally:
+            shutil.rmtree(directory)
+
+    def test_aggregated_warnings(self):
+        """Test that only the first warnings about ignored URLs are printed and the rest are summarized in a single line."""
+        directory = tempfile.mkdtemp()
+        stdout = sys.stdout
+
+        try:
+            filename = os.path.join(directory, "images.list")
+
+            with open(filename, "w") as list_file:
+                for i in range(100):
+                    list_file.write("https://example.com/image" + str(i) + ".png\n")
+
+            # Capture the standard output. For compatibility, try both the Python 2 and the Python 3 module name.
+            try:
+                from StringIO import StringIO
+            except ImportError:
+                from io import StringIO
+
+            sys.stdout = StringIO()
+
+            assert [_ for _ in ListFileURLGenerator(filename, "*.jpg", lazy = True)] == []
+
+            lines = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+            shutil.rmtree(directory)
+
+        assert len(lines) == ListFileURLGenerator.max_warnings + 1, repr(lines)
+        assert lines[-1].startswith("Warning: Ignored 90 more files"), repr(lines)
+
 class TestBatchDownloader(unittest.TestCase):    
     """
     Test class for the BatchDownloader class.
@@ -150,6 +464,2020 @@ class TestBatchDownloader(unittest.TestCase):
 
         assert True
 
+class TestConcurrentDownload(LocalServerTestCase):
+    """
+    Test class for concurrent downloads with a pool of workers.
+
+    All files are served by a local server with an artificial latency, so that the speedup of concurrent downloads can be measured.
+
+    Attributes:
+        server (object): A local image server that answers each request after 0.1 seconds.
+        directory (str): A temporary download directory.
+    """
+
+    server_options = {"latency": 0.1}
+
+    def download_time(self, workers, urls):
+        """Return the time it takes to download `urls` with the given number of workers into a new directory."""
+        directory = tempfile.mkdtemp(dir = self.directory)
+        downloader = BatchDownloader(directory, workers = workers)
+
+        start = time.time()
+        statistics = downloader.download(urls)
+        elapsed = time.time() - start
+
+        assert statistics.downloaded == len(urls), str(statistics)
+        assert sorted(os.listdir(directory)) == sorted(url.rsplit('/', 1)[-1] for url in urls)
+
+        return elapsed
+
+    def test_speedup(self):
+        """Test that eight workers download eight files considerably faster than a single worker."""
+        urls = [self.server.url("image" + str(i) + ".jpg") for i in range(8)]
+
+        serial_time = self.download_time(1, urls)
+        concurrent_time = self.download_time(8, urls)
+
+        assert concurrent_time < serial_time / 3, repr((serial_time, concurrent_time))
+
+    def test_skip_existing(self):
+        """Test that existing files are skipped and duplicate URLs are counted once as downloaded."""
+        with open(os.path.join(self.directory, "existing.jpg"), "wb") as existing_file:
+            existing_file.write(b"old")
+
+        downloader = BatchDownloader(self.directory, workers = 4)
+        statistics = downloader.download([self.server.url("existing.jpg"), \
+            self.server.url("new.jpg"), self.server.url("new.jpg")])
+
+        assert (statistics.downloaded, statistics.skipped) == (1, 2), str(statistics)
+
+        with open(os.path.join(self.directory, "existing.jpg"), "rb") as existing_file:
+            assert existing_file.read() == b"old"
+
+    def test_filename_locks(self):
+        """Test that the lock of a filename is held by duplicate URLs in turn and dropped after its last download."""
+        downloader = BatchDownloader(self.directory, workers = 4)
+        sizes = []
+        downloader.add_hook(lambda result: sizes.append(len(downloader.filename_locks)))
+
+        statistics = downloader.download([self.server.url("image" + str(i % 3) + ".jpg") for i in range(9)])
+
+        assert (statistics.downloaded, statistics.skipped) == (3, 6), str(statistics)
+        assert max(sizes) <= 3 and downloader.filename_locks == {}, repr(sizes)
+
+    def test_failed_download(self):
+        """Test that a failed download is forwarded as an IO Error."""
+        downloader = BatchDownloader(self.directory, workers = 4)
+
+        try:
+            downloader.download([self.server.url("image.jpg"), self.server.url("missing.png")])
+
+            # We should not be able to reach this code line
+            assert False
+        except IOError:
+            # This example should fail with an IO Error
+            assert True
+
+    def test_invalid_list(self):
+        """Test an invalid list. The code should throw an exception in this case."""
+        downloader = BatchDownloader(self.directory, workers = 4)
+
+        try:
+            downloader.download([None])
+
+            # We should not be able to reach this code line
+            assert False
+        except TypeError:
+            # This example should fail with a Type Error
+            assert True
+
+    def test_malformed_urls(self):
+        """Test that malformed URLs count as failed files with `keep_going`, in the pool and one after another."""
+        urls = ["http://127.0.0.1:abc/port.jpg", self.server.url(u"caf\u00e9.jpg"), self.server.url("image.jpg")]
+
+        for workers in (1, 2):
+            directory = tempfile.mkdtemp(dir = self.directory)
+            downloader = BatchDownloader(directory, workers = workers, keep_going = True)
+            statistics = downloader.download(urls)
+
+            assert (statistics.downloaded, statistics.failed) == (1, 2), str(statistics)
+
+    def test_unexpected_error(self):
+        """Test that an error other than an IO Error stops the pool and is raised instead of blocking the download."""
+        downloader = BatchDownloader(self.directory, workers = 2, queue_size = 1, keep_going = True)
+
+        def hook(result):
+            raise RuntimeError("Hook failed.")
+
+        downloader.add_hook(hook)
+
+        with self.assertRaises(RuntimeError):
+            downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(8)])
+
+    def test_invalid_workers(self):
+        """Test an invalid number of workers. The code should throw an exception in this case."""
+        try:
+            BatchDownloader(self.directory, workers = 0)
+
+            # We should not be able to reach this code line
+            assert False
+        except ValueError:
+            # This example should fail with a Value Error
+            assert True
+
+class TestHTTPConnectionPool(LocalServerTestCase):
+    """
+    Test class for the HTTPConnectionPool class.
+
+    Checks that connections to a local server are kept alive, reused, evicted and limited per host.
+
+    Attributes:
+        server (object): A local image server without latency.
+        directory (str): A temporary download directory.
+    """
+
+    def test_reuse(self):
+        """Test that a serial download of several files from the same host opens a single connection."""
+        downloader = BatchDownloader(self.directory)
+        statistics = downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(5)])
+
+        assert statistics.downloaded == 5, str(statistics)
+        assert (downloader.connection_pool.connections_opened, downloader.connection_pool.connections_reused) == (1, 4), \
+            str(downloader.connection_pool)
+
+    def test_redirect(self):
+        """Test that redirects are followed over the same connection."""
+        pool = HTTPConnectionPool()
+
+        with pool.urlopen(self.server.url("redirect/image.jpg")) as response:
+            assert response.status == 200
+            assert response.read() == JPEG_DATA
+
+        assert (pool.connections_opened, pool.connections_reused) == (1, 1), str(pool)
+
+    def test_max_per_host(self):
+        """Test that no more than `max_per_host` connections are opened to the same host."""
+        self.server.latency = 0.05
+        downloader = BatchDownloader(self.directory, workers = 8, connection_pool = HTTPConnectionPool(max_per_host = 2))
+        statistics = downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(8)])
+
+        assert statistics.downloaded == 8, str(statistics)
+        assert downloader.connection_pool.connections_opened == 2, str(downloader.connection_pool)
+        assert self.server.max_active <= 2, repr(self.server.max_active)
+
+    def test_idle_eviction(self):
+        """Test that idle connections are closed after the idle timeout."""
+        pool = HTTPConnectionPool(idle_timeout = 0.05)
+
+        with pool.urlopen(self.server.url("image.jpg")) as response:
+            response.read()
+
+        time.sleep(0.1)
+
+        with pool.urlopen(self.server.url("image.jpg")) as response:
+            response.read()
+
+        assert (pool.connections_opened, pool.connections_reused, pool.connections_evicted) == (2, 0, 1), \
+            repr((pool.connections_opened, pool.connections_reused, pool.connections_evicted))
+
+    def test_error_status(self):
+        """Test that an error status is forwarded as an IO Error."""
+        downloader = BatchDownloader(self.directory)
+
+        try:
+            downloader.download([self.server.url("missing.png")])
+
+            # We should not be able to reach this code line
+            assert False
+        except IOError:
+            # This example should fail with an IO Error
+            assert True
+
+class TestStreamingDownload(LocalServerTestCase):
+    """
+    Test class for streaming downloads into temporary files.
+
+    Attributes:
+        server (object): A local image server without latency.
+        directory (str): A temporary download directory.
+    """
+
+    def test_truncated(self):
+        """Test that a truncated transfer raises an IO Error and leaves neither the final nor a temporary file."""
+        downloader = BatchDownloader(self.directory)
+
+        try:
+            downloader.download([self.server.url("truncated/image.jpg")])
+
+            # We should not be able to reach this code line
+            assert False
+        except IOError:
+            # This example should fail with an IO Error
+            assert True
+
+        assert os.listdir(self.directory) == [], repr(os.listdir(self.directory))
+
+    def test_overwrite(self):
+        """Test that an existing file is replaced only after the new file has been downloaded completely."""
+        with open(os.path.join(self.directory, "image.jpg"), "wb") as existing_file:
+            existing_file.write(b"old")
+
+        downloader = BatchDownloader(self.directory, default_overwrite = True)
+        downloader.download([self.server.url("image.jpg")])
+
+        with open(os.path.join(self.directory, "image.jpg"), "rb") as image_file:
+            assert image_file.read() == JPEG_DATA
+
+        assert os.listdir(self.directory) == ["image.jpg"], repr(os.listdir(self.directory))
+
+    @unittest.skipIf(sys.version_info < (3, 4), "tracemalloc requires Python 3.4 or higher.")
+    def test_bounded_memory(self):
+        """Test that the memory used for downloading a large file does not grow with the file size."""
+        import tracemalloc
+
+        downloader = BatchDownloader(self.directory, buffer_size = 16 * 1024)
+
+        tracemalloc.start()
+
+        try:
+            downloader.download([self.server.url("large/" + str(32 * 1024 * 1024) + "/image.jpg")])
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert os.path.getsize(os.path.join(self.directory, "image.jpg")) == 32 * 1024 * 1024
+        assert peak < 2 * 1024 * 1024, repr(peak)
+
+class TestResumableDownload(LocalServerTestCase):
+    """
+    Test class for resumable downloads with a journal.
+
+    Attributes:
+        server (object): A local image server without latency.
+        directory (str): A temporary download directory.
+    """
+
+    def download(self, downloader, urls):
+        """Download `urls` and return True if the download succeeded and False if it raised an IO Error."""
+        try:
+            downloader.download(urls)
+            return True
+        except IOError:
+            return False
+
+    def test_resume_partial(self):
+        """Test that an interrupted download is continued with a Range request from the end of the partial file."""
+        url = self.server.url("large/300000/image.jpg")
+
+        self.server.fail_after = 100000
+        assert not self.download(BatchDownloader(self.directory, resume = True), [url])
+        assert not os.path.exists(os.path.join(self.directory, "image.jpg"))
+
+        self.server.fail_after = None
+        assert self.download(BatchDownloader(self.directory, resume = True), [url])
+
+        assert self.server.ranges == [None, "bytes=100000-"], repr(self.server.ranges)
+
+        with open(os.path.join(self.directory, "image.jpg"), "rb") as image_file:
+            assert image_file.read() == large_data(0, 300000)
+
+    def test_empty_partial(self):
+        """Test that no empty partial file is left behind if a download fails before any data has been received."""
+        url = self.server.url("large/300000/image.jpg")
+
+        self.server.fail_after = 0
+        assert not self.download(BatchDownloader(self.directory, resume = True), [url])
+        assert not os.path.exists(os.path.join(self.directory, ".image.jpg.part"))
+
+        self.server.fail_after = None
+        assert self.download(BatchDownloader(self.directory, resume = True), [url])
+        assert self.server.ranges == [None, None], repr(self.server.ranges)
+
+    def test_skip_completed(self):
+        """Test that files listed as completed in the journal are skipped without checking the file system."""
+        urls = [self.server.url("image" + str(i) + ".jpg") for i in range(3)]
+
+        statistics = BatchDownloader(self.directory, resume = True).download(urls)
+        assert statistics.downloaded == 3, str(statistics)
+
+        # Remove a file. It is not downloaded again, as the journal lists it as completed.
+        os.remove(os.path.join(self.directory, "image0.jpg"))
+
+        statistics = BatchDownloader(self.directory, resume = True).download(urls + [self.server.url("image3.jpg")])
+        assert (statistics.downloaded, statistics.skipped) == (1, 3), str(statistics)
+
+    def test_damaged_journal(self):
+        """Test that a journal with a line that was cut off by a crash is still read."""
+        url = self.server.url("image.jpg")
+
+        BatchDownloader(self.directory, resume = True).download([url])
+
+        journal_filename = os.path.join(self.directory, ".batchjpegdownloader.journal")
+
+        with open(journal_filename, "a") as journal_file:
+            journal_file.write('{"url": "http://')
+
+        statistics = BatchDownloader(self.directory, resume = True).download([url])
+        assert statistics.skipped == 1, str(statistics)
+
+class TestRefreshDownload(LocalServerTestCase):
+    """
+    Test class for conditional requests in refresh mode.
+
+    Attributes:
+        server (object): A local image server without latency.
+        directory (str): A temporary download directory.
+        urls (list): URLs of three JPEG files on the server.
+    """
+
+    def setUp(self):
+        """Start a local server, create a temporary download directory and download three files in refresh mode."""
+        LocalServerTestCase.setUp(self)
+        self.urls = [self.server.url("image" + str(i) + ".jpg") for i in range(3)]
+
+        statistics = BatchDownloader(self.directory, refresh = True).download(self.urls)
+        assert statistics.downloaded == 3, str(statistics)
+
+    def test_not_modified(self):
+        """Test that unchanged files are counted as not modified and not rewritten."""
+        with open(os.path.join(self.directory, "image0.jpg"), "wb") as image_file:
+            image_file.write(b"local")
+
+        statistics = BatchDownloader(self.directory, refresh = True).download(self.urls)
+        assert (statistics.downloaded, statistics.not_modified) == (0, 3), str(statistics)
+
+        with open(os.path.join(self.directory, "image0.jpg"), "rb") as image_file:
+            assert image_file.read() == b"local"
+
+    def test_modified(self):
+        """Test that files with a new ETag are downloaded again."""
+        with open(os.path.join(self.directory, "image0.jpg"), "wb") as image_file:
+            image_file.write(b"local")
+
+        self.server.etag = '"jpeg-2"'
+
+        statistics = BatchDownloader(self.directory, refresh = True).download(self.urls)
+        assert (statistics.downloaded, statistics.not_modified) == (3, 0), str(statistics)
+
+        with open(os.path.join(self.directory, "image0.jpg"), "rb") as image_file:
+            assert image_file.read() == JPEG_DATA
+
+    def test_missing_file(self):
+        """Test that a file that has been removed locally is downloaded unconditionally."""
+        os.remove(os.path.join(self.directory, "image0.jpg"))
+
+        statistics = BatchDownloader(self.directory, refresh = True).download(self.urls)
+        assert (statistics.downloaded, statistics.not_modified) == (1, 2), str(statistics)
+
+class TestDeduplication(LocalServerTestCase):
+    """
+    Test class for URL and content deduplication.
+
+    All small JPEG files of the local server have the same content, while large files differ by their size.
+
+    Attributes:
+        server (object): A local image server without latency.
+        directory (str): A temporary download directory.
+    """
+
+    def test_identical_content(self):
+        """Test that files with identical content are linked to the first file and that different files are stored separately."""
+        downloader = BatchDownloader(self.directory, deduplicate = True)
+        statistics = downloader.download([self.server.url("a.jpg"), self.server.url("b.jpg"), \
+            self.server.url("c.jpg"), self.server.url("large/1000/d.jpg")])
+
+        assert statistics.downloaded == 4, str(statistics)
+        assert downloader.deduplication_index.files_linked == 2, str(downloader.deduplication_index)
+        assert downloader.deduplication_index.bytes_saved == 2 * len(JPEG_DATA), str(downloader.deduplication_index)
+
+        inodes = [os.stat(os.path.join(self.directory, name)).st_ino for name in ["a.jpg", "b.jpg", "c.jpg", "d.jpg"]]
+        assert len(set(inodes)) == 2, repr(inodes)
+
+        for name in ["a.jpg", "b.jpg", "c.jpg"]:
+            with open(os.path.join(self.directory, name), "rb") as image_file:
+                assert image_file.read() == JPEG_DATA
+
+    def test_index_across_runs(self):
+        """Test that the digest index is reused by a later run."""
+        BatchDownloader(self.directory, deduplicate = True).download([self.server.url("a.jpg")])
+
+        downloader = BatchDownloader(self.directory, deduplicate = True)
+        downloader.download([self.server.url("b.jpg")])
+
+        assert downloader.deduplication_index.files_linked == 1, str(downloader.deduplication_index)
+        assert os.path.samefile(os.path.join(self.directory, "a.jpg"), os.path.join(self.directory, "b.jpg"))
+
+    def test_rewritten_file(self):
+        """Test that a file is never linked to a canonical file that has been rewritten with other content."""
+        first, second = b"\xff\xd8first" + b"\x00" * 100, b"\xff\xd8other" + b"\x00" * 100
+        self.server.photo = first
+        BatchDownloader(self.directory, deduplicate = True).download([self.server.url("photo/a.jpg")])
+
+        # A forced download rewrites the canonical file of the first content.
+        self.server.photo = second
+        BatchDownloader(self.directory, deduplicate = True, default_overwrite = True).download([self.server.url("photo/a.jpg")])
+
+        self.server.photo = first
+        downloader = BatchDownloader(self.directory, deduplicate = True)
+        downloader.download([self.server.url("photo/b.jpg")])
+
+        # Another program rewrites the canonical file of the second content with the same size.
+        filename = os.path.join(self.directory, "a.jpg")
+
+        with open(filename, "wb") as image_file:
+            image_file.write(first)
+
+        os.utime(filename, (1, 1))
+
+        self.server.photo = second
+        downloader.download([self.server.url("photo/c.jpg")])
+
+        assert downloader.deduplication_index.files_linked == 0, str(downloader.deduplication_index)
+
+        for name, content in [("b.jpg", first), ("c.jpg", second)]:
+            with open(os.path.join(self.directory, name), "rb") as image_file:
+                assert image_file.read() == content, name
+
+    def test_relinked_file(self):
+        """Test that a canonical file that is replaced by a link to other content is dropped from the index."""
+        first, second = b"\xff\xd8first" + b"\x00" * 100, b"\xff\xd8other" + b"\x00" * 100
+        self.server.photo = first
+        BatchDownloader(self.directory, deduplicate = True).download([self.server.url("photo/a.jpg")])
+        self.server.photo = second
+        BatchDownloader(self.directory, deduplicate = True).download([self.server.url("photo/b.jpg")])
+
+        # The forced download of a.jpg with the second content links it to b.jpg.
+        BatchDownloader(self.directory, deduplicate = True, default_overwrite = True).download([self.server.url("photo/a.jpg")])
+
+        self.server.photo = first
+        downloader = BatchDownloader(self.directory, deduplicate = True)
+        downloader.download([self.server.url("photo/c.jpg")])
+
+        assert os.path.samefile(os.path.join(self.directory, "a.jpg"), os.path.join(self.directory, "b.jpg"))
+        assert downloader.deduplication_index.files_linked == 0, str(downloader.deduplication_index)
+
+        with open(os.path.join(self.directory, "c.jpg"), "rb") as image_file:
+            assert image_file.read() == first
+
+    def test_repeated_urls(self):
+        """Test that repeated URLs are dropped before they are requested."""
+        downloader = BatchDownloader(self.directory, workers = 4, deduplicate = True)
+        statistics = downloader.download([self.server.url("a.jpg")] * 5 + [self.server.url("b.jpg")])
+
+        assert (statistics.downloaded, statistics.duplicate, statistics.skipped) == (2, 4, 0), str(statistics)
+        assert downloader.connection_pool.connections_opened + downloader.connection_pool.connections_reused == 2, \
+            str(downloader.connection_pool)
+
+class TestInstrumentation(LocalServerTestCase):
+    """
+    Test class for the per-file results, the metrics and the hooks of the downloader.
+
+    Attributes:
+        server (object): A local image server that answers each request after 0.05 seconds.
+        directory (str): A temporary download directory.
+    """
+
+    server_options = {"latency": 0.05}
+
+    def test_timing(self):
+        """Test that new connections are timed in all phases and that reused connections skip the connection phases."""
+        downloader = BatchDownloader(self.directory)
+        results = []
+        downloader.add_hook(results.append)
+        downloader.download([self.server.url("a.jpg"), self.server.url("b.jpg")])
+
+        assert [result.status for result in results] == ["downloaded", "downloaded"]
+        assert results[0].dns_time is not None and results[0].connect_time is not None
+        assert results[1].dns_time is None and results[1].connect_time is None
+
+        for result in results:
+            assert result.size == len(JPEG_DATA), repr(result.size)
+            assert result.first_byte_time >= 0.05, repr(result.first_byte_time)
+            assert result.transfer_time >= 0.0 and result.duration >= result.first_byte_time, repr(result.as_dict())
+
+    def test_metrics(self):
+        """Test the counters and histograms of the built-in metrics hook, including skipped and failed files."""
+        downloader = BatchDownloader(self.directory, workers = 4)
+        downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(4)])
+
+        with self.assertRaises(IOError):
+            downloader.download([self.server.url("image0.jpg"), self.server.url("missing.png")])
+
+        metrics = downloader.metrics.as_dict()
+
+        assert metrics["files"] == {"downloaded": 4, "skipped": 1, "failed": 1}, repr(metrics)
+        assert metrics["bytes"] == 4 * len(JPEG_DATA), repr(metrics)
+        assert metrics["times"]["duration"]["count"] == 6, repr(metrics)
+        assert metrics["times"]["first_byte"]["p50"] >= 0.05, repr(metrics)
+
+    def test_json_log(self):
+        """Test that the JSON-lines log contains one record per file."""
+        import json
+
+        log_filename = os.path.join(self.directory, "log.jsonl")
+        downloader = BatchDownloader(self.directory, workers = 2, log_filename = log_filename)
+        downloader.download([self.server.url("a.jpg"), self.server.url("b.jpg"), self.server.url("a.jpg")])
+
+        with open(log_filename) as log_file:
+            records = [json.loads(line) for line in log_file]
+
+        assert sorted(record["status"] for record in records) == ["downloaded", "downloaded", "skipped"], repr(records)
+        assert all(record["url"].startswith("http://") for record in records), repr(records)
+
+    def test_progress(self):
+        """Test that the progress line knows the total number of URLs of a list file."""
+        from batchjpegdownloader import ProgressReporter
+
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+
+        list_filename = os.path.join(self.directory, "images.list")
+
+        with open(list_filename, "w") as list_file:
+            list_file.write(self.server.url("a.jpg") + "\n" + self.server.url("b.jpg") + "\n" + self.server.url("c.png") + "\n")
+
+        stream = StringIO()
+        downloader = BatchDownloader(self.directory, progress = True)
+        downloader.hooks[-1] = ProgressReporter(stream)
+        downloader.download(ListFileURLGenerator(list_filename, "*.jpg"))
+
+        assert stream.getvalue().startswith("\r2 of 2 files, "), repr(stream.getvalue())
+        assert stream.getvalue().endswith("\n"), repr(stream.getvalue())
+
+class TestRetry(LocalServerTestCase):
+    """
+    Test class for the retry policy, the circuit breaker and the failures list.
+
+    Attributes:
+        server (object): A local image server without latency.
+        directory (str): A temporary download directory.
+    """
+
+    def test_flaky(self):
+        """Test that temporary server errors are retried until the download succeeds."""
+        downloader = BatchDownloader(self.directory, workers = 2, retry_policy = RetryPolicy(attempts = 3, backoff = 0.01))
+        results = []
+        downloader.add_hook(results.append)
+        statistics = downloader.download([self.server.url("flaky/2/a.jpg"), self.server.url("flaky/1/b.jpg")])
+
+        assert statistics.downloaded == 2, str(statistics)
+        assert sorted(result.attempts for result in results) == [2, 3], repr([result.as_dict() for result in results])
+        assert downloader.metrics.retries == 3, repr(downloader.metrics.as_dict())
+
+    def test_attempts_exhausted(self):
+        """Test that a download fails after the configured number of attempts and that 404 errors are not retried."""
+        downloader = BatchDownloader(self.directory, retry_policy = RetryPolicy(attempts = 2, backoff = 0.01))
+
+        with self.assertRaises(HTTPStatusError):
+            downloader.download([self.server.url("flaky/5/a.jpg")])
+
+        with self.assertRaises(HTTPStatusError):
+            downloader.download([self.server.url("missing.png")])
+
+        assert self.server.counts == {"/flaky/5/a.jpg": 2, "/missing.png": 1}, repr(self.server.counts)
+
+    def test_delay(self):
+        """Test the exponential backoff, its jitter and the Retry-After header."""
+        policy = RetryPolicy(attempts = 5, backoff = 1.0, max_backoff = 3.0, jitter = False)
+        error = HTTPStatusError("http://localhost/a.jpg", 503)
+
+        assert [policy.delay(attempt, error) for attempt in range(1, 6)] == [1.0, 2.0, 3.0, 3.0, None]
+        assert policy.delay(1, HTTPStatusError("http://localhost/a.jpg", 404)) is None
+        assert policy.delay(1, HTTPStatusError("http://localhost/a.jpg", 429, retry_after = 2.5)) == 2.5
+        assert 0.0 <= RetryPolicy(attempts = 2, backoff = 1.0).delay(1, error) <= 1.0
+
+        assert RetryPolicy.parse_retry_after("120") == 120.0
+        assert RetryPolicy.parse_retry_after("Thu, 01 Jan 1970 00:00:00 GMT") == 0.0
+        assert RetryPolicy.parse_retry_after("soon") is None
+
+    def test_keep_going(self):
+        """Test that failed URLs are written to a failures list that can be read as a list file."""
+        failures_filename = os.path.join(self.directory, "failures.list")
+        downloader = BatchDownloader(self.directory, workers = 2, keep_going = True, failures_filename = failures_filename)
+        statistics = downloader.download([self.server.url("status/404/a.jpg"), self.server.url("c.jpg"), \
+            self.server.url("status/500/b.jpg")])
+
+        assert (statistics.downloaded, statistics.failed) == (1, 2), str(statistics)
+        assert sorted(ListFileURLGenerator(failures_filename, "*.jpg")) == \
+            [self.server.url("status/404/a.jpg"), self.server.url("status/500/b.jpg")]
+
+    def test_circuit_breaker(self):
+        """Test that no further requests are sent to a host after consecutive failures."""
+        downloader = BatchDownloader(self.directory, keep_going = True, circuit_breaker = CircuitBreaker(threshold = 2))
+        statistics = downloader.download([self.server.url("status/503/" + str(i) + ".jpg") for i in range(5)])
+
+        assert statistics.failed == 5, str(statistics)
+        assert sum(self.server.counts.values()) == 2, repr(self.server.counts)
+
+    def test_circuit_reset(self):
+        """Test that a trial request is sent after the reset timeout and closes the circuit if it succeeds."""
+        breaker = CircuitBreaker(threshold = 1, reset_timeout = 0.05)
+        breaker.record_failure("http://localhost/a.jpg")
+
+        assert not breaker.allow("http://localhost/b.jpg")
+        assert breaker.allow("http://otherhost/b.jpg")
+
+        time.sleep(0.1)
+
+        assert breaker.allow("http://localhost/b.jpg")
+        assert not breaker.allow("http://localhost/c.jpg")
+
+        breaker.record_success("http://localhost/b.jpg")
+
+        assert breaker.allow("http://localhost/c.jpg")
+
+class TestThrottle(LocalServerTestCase):
+    """
+    Test class for the request rate and bandwidth limits.
+
+    Attributes:
+        server (object): A local image server without latency.
+        directory (str): A temporary download directory.
+    """
+
+    def test_request_rate(self):
+        """Test that concurrent workers send requests evenly spaced at the rate limit."""
+        downloader = BatchDownloader(self.directory, workers = 4, throttle = Throttle(requests_per_second = 20))
+        downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(11)])
+
+        # The bucket allows a burst of two requests, the remaining requests are paced.
+        intervals = [later - earlier for earlier, later in zip(self.server.times[1:], self.server.times[2:])]
+        rate = len(intervals) / (self.server.times[-1] - self.server.times[1])
+
+        assert 17 < rate < 21, repr(rate)
+        assert min(intervals) > 0.03, repr(intervals)
+
+    def test_bandwidth(self):
+        """Test that the observed bandwidth stays at the limit."""
+        downloader = BatchDownloader(self.directory, workers = 2, buffer_size = 16384, \
+            throttle = Throttle(bytes_per_second = 2000000))
+
+        # The bucket allows a burst of a tenth of a second, the remaining bytes are paced.
+        start = time.time()
+        downloader.download([self.server.url("large/500000/a.jpg"), self.server.url("large/500000/b.jpg")])
+        rate = (1000000 - 200000) / (time.time() - start)
+
+        assert 1500000 < rate < 2100000, repr(rate)
+
+    def test_host_rate(self):
+        """Test that the request rate is limited per host, so that two hosts together reach twice the rate."""
+        urls = []
+
+        for i in range(6):
+            urls += [self.server.url("image" + str(i) + ".jpg"), self.server.url("image" + str(i) + ".jpg").replace("127.0.0.1", "localhost")]
+
+        throttle = Throttle(host_requests_per_second = 20)
+
+        downloader = BatchDownloader(self.directory, workers = 4, default_overwrite = True, throttle = throttle)
+
+        start = time.time()
+        downloader.download(urls)
+        elapsed = time.time() - start
+
+        assert 0.2 < elapsed < 0.45, repr(elapsed)
+
+    def test_token_bucket(self):
+        """Test that a bucket allows a burst of its capacity and then delays callers in evenly spaced steps."""
+        from batchjpegdownloader import TokenBucket
+
+        bucket = TokenBucket(10, capacity = 2)
+        delays = [bucket.reserve() for _ in range(5)]
+
+        assert delays[:2] == [0.0, 0.0], repr(delays)
+        assert all(abs(delay - expected) < 0.01 for delay, expected in zip(delays[2:], [0.1, 0.2, 0.3])), repr(delays)
+
+class TestValidation(LocalServerTestCase):
+    """
+    Test class for the JPEG validation of downloaded files.
+
+    Small JPEG files of the local server are valid, large files have no JPEG markers and HTML pages have the wrong type.
+
+    Attributes:
+        server (object): A local image server without latency.
+        directory (str): A temporary download directory.
+    """
+
+    def test_valid(self):
+        """Test that valid JPEG files are stored."""
+        statistics = BatchDownloader(self.directory, validate = "delete").download([self.server.url("a.jpg")])
+
+        assert statistics.downloaded == 1, str(statistics)
+        assert os.listdir(self.directory) == ["a.jpg"], repr(os.listdir(self.directory))
+
+    def test_delete(self):
+        """Test that an HTML page is rejected by its Content-Type and that nothing is stored."""
+        with self.assertRaises(InvalidFileError) as context:
+            BatchDownloader(self.directory, validate = "delete").download([self.server.url("html/a.jpg")])
+
+        assert "text/html" in str(context.exception), str(context.exception)
+        assert os.listdir(self.directory) == [], repr(os.listdir(self.directory))
+
+    def test_quarantine(self):
+        """Test that invalid files are moved to the quarantine directory and valid files are stored."""
+        downloader = BatchDownloader(self.directory, workers = 2, validate = "quarantine", keep_going = True)
+        statistics = downloader.download([self.server.url("html/a.jpg"), self.server.url("large/1000/b.jpg"), \
+            self.server.url("c.jpg")])
+
+        assert (statistics.downloaded, statistics.failed) == (1, 2), str(statistics)
+        assert sorted(os.listdir(self.directory)) == [".quarantine", "c.jpg"], repr(os.listdir(self.directory))
+        assert sorted(os.listdir(downloader.quarantine_directory)) == \
+            sorted([quarantine_name(self.server.url("html/a.jpg")), quarantine_name(self.server.url("large/1000/b.jpg"))])
+
+        with open(os.path.join(downloader.quarantine_directory, quarantine_name(self.server.url("large/1000/b.jpg"))), "rb") as image_file:
+            assert image_file.read() == large_data(0, 1000)
+
+    def test_quarantine_collisions(self):
+        """Test that invalid files with the same name from different URLs are all kept in the quarantine directory."""
+        urls = [self.server.url("html/a.jpg"), self.server.url("html/other/a.jpg"), self.server.url("large/1000/a.jpg")]
+        downloader = BatchDownloader(self.directory, workers = 3, validate = "quarantine", keep_going = True)
+        statistics = downloader.download(urls)
+
+        assert statistics.failed == 3, str(statistics)
+        assert sorted(os.listdir(downloader.quarantine_directory)) == sorted(quarantine_name(url) for url in urls), \
+            repr(os.listdir(downloader.quarantine_directory))
+
+    def test_file_urls(self):
+        """Test that file URLs are validated and recorded in the journal like HTTP URLs."""
+        try:
+            from urllib import pathname2url
+        except ImportError:
+            from urllib.request import pathname2url
+
+        from batchjpegdownloader import DownloadJournal
+
+        source = os.path.join(self.directory, "source")
+        os.mkdir(source)
+
+        with open(os.path.join(source, "a.jpg"), "wb") as image_file:
+            image_file.write(JPEG_DATA)
+
+        with open(os.path.join(source, "b.jpg"), "wb") as image_file:
+            image_file.write(b"<html><body>Not found</body></html>")
+
+        urls = ["file:" + pathname2url(os.path.join(source, name)) for name in ("a.jpg", "b.jpg")]
+        target = os.path.join(self.directory, "target")
+        downloader = BatchDownloader(target, default_create_directory = True, validate = "quarantine", keep_going = True, \
+            resume = True)
+        statistics = downloader.download(urls)
+        downloader.close()
+
+        assert (statistics.downloaded, statistics.failed) == (1, 1), str(statistics)
+        assert sorted(os.listdir(target)) == sorted([".quarantine", DownloadJournal.default_filename, "a.jpg"]), repr(os.listdir(target))
+        assert os.listdir(downloader.quarantine_directory) == [quarantine_name(urls[1])]
+
+        journal = DownloadJournal(os.path.join(target, DownloadJournal.default_filename))
+
+        assert (journal.get(urls[0])["status"], journal.get(urls[1])["status"]) == ("completed", "invalid")
+
+        journal.close()
+
+    def test_not_retried(self):
+        """Test that invalid files are not downloaded again by the retry policy."""
+        downloader = BatchDownloader(self.directory, validate = "delete", retry_policy = RetryPolicy(attempts = 3, backoff = 0.01))
+
+        with self.assertRaises(InvalidFileError):
+            downloader.download([self.server.url("large/1000/a.jpg")])
+
+        assert self.server.counts == {"/large/1000/a.jpg": 1}, repr(self.server.counts)
+
+    def test_validator_blocks(self):
+        """Test that the markers are found when the body arrives in blocks of a single byte."""
+        from batchjpegdownloader import JPEGValidator
+
+        validator = JPEGValidator({"content-type": "image/jpeg", "content-length": str(len(JPEG_DATA))})
+
+        for i in range(len(JPEG_DATA)):
+            validator.update(JPEG_DATA[i:i + 1])
+
+        assert validator.check(len(JPEG_DATA)) is None
+        assert validator.check(len(JPEG_DATA) - 1) is not None
+
+        validator = JPEGValidator({}, offset = 2, head = JPEG_DATA[:2])
+        validator.update(JPEG_DATA[2:-1])
+
+        assert validator.check(len(JPEG_DATA) - 1) is not None
+
+class TestOutputLayout(LocalServerTestCase):
+    """
+    Test class for the sharded layout, the index of existing files and the renaming of filename collisions.
+
+    Attributes:
+        server (object): A local image server without latency.
+        directory (str): A temporary download directory.
+    """
+
+    def test_sharded(self):
+        """Test that files are stored in two levels of hash directories and skipped in a later run."""
+        import hashlib
+
+        downloader = BatchDownloader(self.directory, workers = 2, layout = "sharded")
+        statistics = downloader.download([self.server.url("a.jpg"), self.server.url("b.jpg")])
+
+        assert statistics.downloaded == 2, str(statistics)
+
+        for name in ["a.jpg", "b.jpg"]:
+            digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+
+            with open(os.path.join(self.directory, digest[0:2], digest[2:4], name), "rb") as image_file:
+                assert image_file.read() == JPEG_DATA
+
+        statistics = BatchDownloader(self.directory, layout = "sharded").download([self.server.url("a.jpg")])
+        assert statistics.skipped == 1, str(statistics)
+
+    def test_index(self):
+        """Test that existing files are looked up in the index, which is built once and updated by new downloads."""
+        downloader = BatchDownloader(self.directory, layout = "sharded")
+        downloader.download([self.server.url("a.jpg")])
+
+        downloader = BatchDownloader(self.directory, layout = "sharded", index_existing = True)
+        assert downloader.existing_files == set([downloader.local_filename(self.server.url("a.jpg"))])
+
+        # The file system is not asked again, so a file that is removed after the scan is still skipped.
+        os.remove(downloader.local_filename(self.server.url("a.jpg")))
+
+        statistics = downloader.download([self.server.url("a.jpg"), self.server.url("b.jpg"), self.server.url("b.jpg")])
+        assert (statistics.downloaded, statistics.skipped) == (1, 2), str(statistics)
+
+    def test_collisions(self):
+        """Test that different URLs with the same filename are stored under different names, also in a later run."""
+        urls = [self.server.url("a.jpg"), self.server.url("redirect/a.jpg")]
+
+        downloader = BatchDownloader(self.directory, workers = 2, rename_collisions = True, resume = True)
+        statistics = downloader.download(urls)
+
+        assert statistics.downloaded == 2, str(statistics)
+        assert len([name for name in os.listdir(self.directory) if name.endswith(".jpg")]) == 2, repr(os.listdir(self.directory))
+
+        filenames = [downloader.local_filename(url) for url in urls]
+        assert all(os.path.basename(filename).startswith("a-") for filename in filenames), repr(filenames)
+
+        # In a later run, the filenames of the journal are used, regardless of the order of the URLs.
+        downloader = BatchDownloader(self.directory, rename_collisions = True, resume = True)
+        assert [downloader.local_filename(url) for url in reversed(urls)] == list(reversed(filenames))
+
+    def test_reordered_collisions(self):
+        """Test that the filenames of colliding URLs do not depend on the order of the list, also without a journal."""
+        urls = [self.server.url("a.jpg"), self.server.url("redirect/a.jpg")]
+
+        statistics = BatchDownloader(self.directory, rename_collisions = True).download(urls)
+        assert statistics.downloaded == 2, str(statistics)
+
+        # In reversed order, both files are found under their own names and skipped.
+        downloader = BatchDownloader(self.directory, rename_collisions = True)
+        statistics = downloader.download(list(reversed(urls)))
+
+        assert (statistics.downloaded, statistics.skipped) == (0, 2), str(statistics)
+        assert sorted(os.listdir(self.directory)) == sorted(os.path.basename(downloader.local_filename(url)) for url in urls)
+
+class TestSharding(LocalServerTestCase):
+    """
+    Test class for splitting a list file into shards and downloading the shards in separate processes.
+
+    Attributes:
+        server (object): A local image server without latency.
+        directory (str): A temporary download directory.
+        list_filename (str): A list file with 20 URLs, of which two pairs have the same filename.
+    """
+
+    def setUp(self):
+        """Start a local server and create a temporary download directory with a list file."""
+        LocalServerTestCase.setUp(self)
+        self.urls = [self.server.url("image" + str(i) + ".jpg") for i in range(16)] + \
+            [self.server.url("redirect/image0.jpg"), self.server.url("redirect/image1.jpg"), \
+            self.server.url("x.jpg"), self.server.url("y.jpg")]
+        self.list_filename = os.path.join(self.directory, "images.list")
+
+        with open(self.list_filename, "w") as list_file:
+            list_file.write("\n".join(self.urls) + "\n")
+
+    def test_hash_shards(self):
+        """Test that hash shards are disjoint, cover the list and keep URLs with the same filename together."""
+        shards = [list(ListFileURLGenerator(self.list_filename, "*.jpg", lazy = True, shard_index = i, shard_count = 3)) \
+            for i in range(3)]
+
+        assert sorted(sum(shards, [])) == sorted(self.urls), repr(shards)
+
+        for shard in shards:
+            assert (self.urls[0] in shard) == (self.urls[16] in shard), repr(shards)
+            assert (self.urls[1] in shard) == (self.urls[17] in shard), repr(shards)
+
+    def test_line_shards(self):
+        """Test that line shards are contiguous ranges and that the URL count of the validation pass covers the shard only."""
+        shards = [ListFileURLGenerator(self.list_filename, "*.jpg", shard_index = i, shard_count = 3, shard_by = "line") \
+            for i in range(3)]
+
+        assert sum([list(shard) for shard in shards], []) == self.urls
+        assert [shard.url_count for shard in shards] == [6, 7, 7], repr([shard.url_count for shard in shards])
+
+    def test_process_parts(self):
+        """Test that a machine downloads the same files with one and with two processes, for both kinds of shards."""
+        from batchjpegdownloader import ArgumentParser, create_shard
+
+        arguments = sys.argv
+
+        for shard_by in ("hash", "line"):
+            for machine in range(3):
+                try:
+                    sys.argv = ["batchjpegdownloader.py", "-o", self.directory, "--shard-count", "3", \
+                        "--shard-index", str(machine), "--shard-by", shard_by, self.list_filename]
+                    config = ArgumentParser()
+                finally:
+                    sys.argv = arguments
+
+                single = list(create_shard(config, machine, 3)[1])
+                parts = [list(create_shard(config, 2 * machine + process, 6, 2)[1]) for process in range(2)]
+
+                assert sorted(single) == sorted(parts[0] + parts[1]), repr((shard_by, single, parts))
+                assert not set(parts[0]) & set(parts[1]), repr(parts)
+
+    def test_invalid_shard(self):
+        """Test that invalid shards are rejected."""
+        with self.assertRaises(ValueError):
+            ListFileURLGenerator(self.list_filename, shard_index = 3, shard_count = 3)
+
+        with self.assertRaises(ValueError):
+            ListFileURLGenerator(self.list_filename, shard_count = 2, shard_by = "size")
+
+    def test_processes(self):
+        """Test that a coordinator downloads all shards in separate processes with separate journals and merges the statistics."""
+        from batchjpegdownloader import ArgumentParser, ShardCoordinator
+
+        arguments = sys.argv
+
+        try:
+            sys.argv = ["batchjpegdownloader.py", "-o", self.directory, "-r", "-k", "-j", "2", self.list_filename]
+            config = ArgumentParser()
+        finally:
+            sys.argv = arguments
+
+        statistics = ShardCoordinator(config, 2).run()
+
+        # The redirected URLs have the same filenames as two other URLs and are in the same shard, so they are skipped.
+        assert (statistics.downloaded, statistics.skipped, statistics.failed) == (18, 2, 0), str(statistics)
+        assert sorted(name for name in os.listdir(self.directory) if name.startswith(".batchjpegdownloader.journal")) == \
+            [".batchjpegdownloader.journal.0-of-2", ".batchjpegdownloader.journal.1-of-2"]
+
+    def test_processes_without_futures(self):
+        """Test that the coordinator falls back to multiprocessing.Pool without the concurrent.futures module, as on Python 2."""
+        from batchjpegdownloader import ArgumentParser, ShardCoordinator
+
+        arguments = sys.argv
+
+        try:
+            sys.argv = ["batchjpegdownloader.py", "-o", self.directory, "-k", self.list_filename]
+            config = ArgumentParser()
+        finally:
+            sys.argv = arguments
+
+        modules = dict((name, sys.modules.get(name)) for name in ("concurrent.futures", "concurrent"))
+
+        # A module set to None in sys.modules cannot be imported.
+        try:
+            sys.modules["concurrent.futures"] = None
+            statistics = ShardCoordinator(config, 2).run()
+        finally:
+            for name, module in modules.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+
+        assert (statistics.downloaded, statistics.skipped, statistics.failed) == (18, 2, 0), str(statistics)
+
+@unittest.skipIf(sys.version_info < (3, 2), "Thumbnails require the concurrent.futures module.")
+class TestThumbnails(LocalServerTestCase):
+    """
+    Test class for the thumbnails of downloaded files.
+
+    Attributes:
+        server (object): A local image server that serves an image of 800x600 pixels as photo.
+        directory (str): A temporary download directory.
+    """
+
+    def setUp(self):
+        """Start a local server with a photo and create a temporary download directory."""
+        try:
+            from PIL import Image
+        except ImportError:
+            self.skipTest("Pillow is not installed.")
+
+        import io
+
+        photo = io.BytesIO()
+        Image.new("RGB", (800, 600), (200, 100, 50)).save(photo, "JPEG")
+
+        LocalServerTestCase.setUp(self)
+        self.server.photo = photo.getvalue()
+
+    def test_thumbnails(self):
+        """Test that thumbnails of all sizes are created from the content in memory and keep the aspect ratio."""
+        from batchjpegdownloader import ThumbnailGenerator
+        from PIL import Image
+
+        thumbnails = ThumbnailGenerator([(128, 128), (320, 320)], processes = 2)
+        downloader = BatchDownloader(self.directory, workers = 2, thumbnails = thumbnails)
+        downloader.download([self.server.url("photo/a.jpg"), self.server.url("photo/b.jpg")])
+
+        assert (thumbnails.created, thumbnails.failed, thumbnails.from_memory) == (4, 0, 2), str(thumbnails)
+        assert thumbnails.memory_used == 0, repr(thumbnails.memory_used)
+
+        for name in ["a", "b"]:
+            assert Image.open(os.path.join(self.directory, name + ".128x128.jpg")).size == (128, 96)
+            assert Image.open(os.path.join(self.directory, name + ".320x320.jpg")).size == (320, 240)
+
+        # Closing the downloader stops the pool, which then accepts no further jobs.
+        downloader.close()
+
+        with self.assertRaises(RuntimeError):
+            thumbnails.executor.submit(len, [])
+
+    def test_memory_limit(self):
+        """Test that files are read from disk once the memory limit is reached and that broken images do not fail the download."""
+        from batchjpegdownloader import ThumbnailGenerator
+
+        thumbnails = ThumbnailGenerator([(64, 64)], processes = 1, memory_limit = len(self.server.photo))
+        downloader = BatchDownloader(self.directory, thumbnails = thumbnails)
+
+        # The memory limit only fits one photo, so files are either kept in memory or read back from disk.
+        statistics = downloader.download([self.server.url("photo/a.jpg"), self.server.url("photo/b.jpg"), \
+            self.server.url("c.jpg")])
+
+        assert statistics.downloaded == 3, str(statistics)
+        assert (thumbnails.created, thumbnails.failed) == (2, 1), str(thumbnails)
+        assert os.path.isfile(os.path.join(self.directory, "b.64x64.jpg"))
+
+        thumbnails.close()
+
+    def test_pending_limit(self):
+        """Test that files are dropped instead of waiting for the pool once the limit of pending files is reached."""
+        from batchjpegdownloader import ThumbnailGenerator
+
+        BatchDownloader(self.directory).download([self.server.url("photo/a.jpg"), self.server.url("photo/b.jpg")])
+
+        thumbnails = ThumbnailGenerator([(64, 64)], processes = 1, max_pending = 1)
+
+        # The first file is still waiting for the new process when the second file is submitted.
+        start = time.time()
+        thumbnails.submit(os.path.join(self.directory, "a.jpg"))
+        thumbnails.submit(os.path.join(self.directory, "b.jpg"))
+        duration = time.time() - start
+
+        thumbnails.wait()
+
+        assert (thumbnails.created, thumbnails.dropped, thumbnails.queued) == (1, 1, 0), str(thumbnails)
+        assert duration < 0.5 and "Dropped 1 files" in str(thumbnails), repr(duration)
+        assert not os.path.exists(os.path.join(self.directory, "b.64x64.jpg"))
+
+        thumbnails.close()
+
+    def test_broken_pool(self):
+        """Test that a dead process of the pool disables the thumbnails without stopping the download."""
+        from batchjpegdownloader import ThumbnailGenerator
+
+        thumbnails = ThumbnailGenerator([(64, 64)], processes = 1)
+
+        # A process that exits abruptly breaks the pool, as a process killed by the system would.
+        try:
+            thumbnails.executor.submit(os._exit, 1).result()
+        except Exception:
+            pass
+
+        downloader = BatchDownloader(self.directory, workers = 2, keep_going = True, thumbnails = thumbnails)
+        statistics = downloader.download([self.server.url("photo/image" + str(i) + ".jpg") for i in range(4)])
+
+        assert statistics.downloaded == 4, str(statistics)
+        assert thumbnails.broken and thumbnails.failed == 4 and thumbnails.memory_used == 0, str(thumbnails)
+
+        thumbnails.close()
+
+    def test_parse_sizes(self):
+        """Test the parsing of thumbnail sizes from the command line."""
+        from batchjpegdownloader import ThumbnailGenerator
+
+        assert ThumbnailGenerator.parse_sizes("128x128,640X480") == [(128, 128), (640, 480)]
+
+        with self.assertRaises(ValueError):
+            ThumbnailGenerator.parse_sizes("128")
+
+class TestResults(LocalServerTestCase):
+    """
+    Test class for the iterator over the results of a download.
+
+    Attributes:
+        server (object): A local image server that answers each request after 0.05 seconds.
+        directory (str): A temporary download directory.
+    """
+
+    server_options = {"latency": 0.05}
+
+    def test_results(self):
+        """Test that every URL yields a result record and that the summary is available at the end."""
+        downloader = BatchDownloader(self.directory, workers = 2)
+        urls = [self.server.url("image" + str(i) + ".jpg") for i in range(4)]
+        results = downloader.results(urls)
+
+        records = list(results)
+
+        assert sorted(result.url for result in records) == urls
+        assert all(result.status == "downloaded" and result.size == len(JPEG_DATA) for result in records)
+        assert all(os.path.isfile(result.filename) and result.duration >= 0.05 for result in records)
+        assert results.summary.statistics.downloaded == 4, str(results.summary)
+        assert str(results.summary).startswith("Done. Downloaded 4 files"), str(results.summary)
+        assert results.summary.as_dict()["metrics"]["bytes"] == 4 * len(JPEG_DATA)
+        assert downloader.hooks == [downloader.metrics]
+
+    def test_streaming(self):
+        """Test that results are yielded while the download is running and that closing the iterator stops it."""
+        downloader = BatchDownloader(self.directory, queue_size = 1)
+        urls = [self.server.url("image" + str(i) + ".jpg") for i in range(20)]
+
+        with downloader.results(urls) as results:
+            first = next(results)
+
+            assert first.url == urls[0] and first.status == "downloaded"
+            assert len(os.listdir(self.directory)) < len(urls)
+
+        assert 1 <= results.summary.statistics.downloaded < len(urls), str(results.summary)
+
+    def test_failure(self):
+        """Test that a failed download is yielded as a record and raised after the other results."""
+        downloader = BatchDownloader(self.directory)
+        results = downloader.results([self.server.url("a.jpg"), self.server.url("status/404/b.jpg"), \
+            self.server.url("c.jpg")])
+
+        assert next(results).status == "downloaded"
+
+        failed = next(results)
+
+        assert failed.status == "failed" and "404" in failed.error, repr(failed.as_dict())
+
+        with self.assertRaises(HTTPStatusError):
+            next(results)
+
+        assert isinstance(results.summary.error, HTTPStatusError)
+        assert results.summary.statistics.failed == 1, str(results.summary)
+        assert not os.path.isfile(os.path.join(self.directory, "c.jpg"))
+
+    def test_close(self):
+        """Test that the downloader closes its files and connections at the end of the results or of a with statement."""
+        from batchjpegdownloader import DownloadManifest
+
+        def create_downloader():
+            """Create a downloader with a journal, a digest index, a log, a failures list and a manifest."""
+            return BatchDownloader(self.directory, resume = True, deduplicate = True, \
+                log_filename = os.path.join(self.directory, "log.jsonl"), \
+                failures_filename = os.path.join(self.directory, "failures.txt"), \
+                manifest = DownloadManifest(os.path.join(self.directory, "manifest.jsonl"), self.directory))
+
+        def files(downloader):
+            """Return the file objects of the downloader and its hooks."""
+            return [downloader.journal.file, downloader.deduplication_index.file] + \
+                [hook.file for hook in downloader.hooks if hasattr(hook, "file")]
+
+        downloader = create_downloader()
+        results = downloader.results([self.server.url("a.jpg")], close = True)
+
+        assert len(files(downloader)) == 5 and not any(file.closed for file in files(downloader))
+        assert [result.status for result in results] == ["downloaded"]
+        assert all(file.closed for file in files(downloader)) and downloader.connection_pool.idle == {}
+
+        with create_downloader() as downloader:
+            downloader.download([self.server.url("b.jpg")])
+
+            assert sum(len(idle) for idle in downloader.connection_pool.idle.values()) == 1
+
+        assert all(file.closed for file in files(downloader)) and downloader.connection_pool.idle == {}
+
+        with open(os.path.join(self.directory, "manifest.jsonl")) as manifest_file:
+            assert len(manifest_file.readlines()) == 2
+
+class TestScheduler(LocalServerTestCase):
+    """
+    Test class for the priority annotations of list files and the DownloadScheduler.
+
+    Attributes:
+        server (object): A local image server.
+        directory (str): A temporary directory for list files and downloads.
+    """
+
+    def write_list(self, lines):
+        """Write a list file with the given lines and return its name."""
+        filename = os.path.join(self.directory, "list.txt")
+
+        with open(filename, "w") as list_file:
+            list_file.write("\n".join(lines) + "\n")
+
+        return filename
+
+    def test_annotations(self):
+        """Test that annotations are split from the URLs of a list file."""
+        filename = self.write_list(["http://example.com/a.jpg priority=2 size=100", "http://example.com/b.jpg", \
+            "http://example.com/c.jpg\tsize=5"])
+
+        for lazy in (False, True):
+            urls = list(ListFileURLGenerator(filename, "*.jpg", lazy = lazy))
+
+            assert urls == ["http://example.com/a.jpg", "http://example.com/b.jpg", "http://example.com/c.jpg"]
+            assert (urls[0].priority, urls[0].size, urls[2].priority, urls[2].size) == (2, 100, 0, 5)
+
+    def test_invalid_annotation(self):
+        """Test that unknown annotations and annotations without integer values are rejected."""
+        for annotation in ["weight=1", "priority=high", "size=-1"]:
+            filename = self.write_list(["http://example.com/a.jpg " + annotation])
+
+            with self.assertRaises(ValueError):
+                list(ListFileURLGenerator(filename, "*.jpg", lazy = True))
+
+    def test_priority(self):
+        """Test that URLs of a higher priority come first and that the order of the list is kept otherwise."""
+        from batchjpegdownloader import AnnotatedURL, DownloadScheduler
+
+        urls = ["a", AnnotatedURL("b", priority = 1), "c", AnnotatedURL("d", priority = -1), AnnotatedURL("e", priority = 1)]
+
+        assert list(DownloadScheduler(urls)) == ["b", "e", "a", "c", "d"]
+        assert DownloadScheduler(urls).url_count == 5
+
+        # URLs are only reordered within the window.
+        assert list(DownloadScheduler(urls, window = 1)) == urls
+
+    def test_size_policies(self):
+        """Test the largest-first and shortest-first policies with size annotations and URLs of unknown size."""
+        from batchjpegdownloader import AnnotatedURL, DownloadScheduler
+
+        urls = [AnnotatedURL("a", size = 10), "b", AnnotatedURL("c", size = 30), AnnotatedURL("d", size = 20)]
+
+        assert list(DownloadScheduler(urls, policy = "largest")) == ["c", "d", "a", "b"]
+        assert list(DownloadScheduler(urls, policy = "shortest")) == ["a", "d", "c", "b"]
+
+        with self.assertRaises(ValueError):
+            DownloadScheduler(urls, policy = "random")
+
+    @unittest.skipIf(sys.version_info < (3, 2), "Probing requires the concurrent.futures module.")
+    def test_probe(self):
+        """Test that sizes are requested with HEAD requests that keep the connections alive."""
+        from batchjpegdownloader import DownloadScheduler
+
+        urls = [self.server.url("large/" + str(size) + "/" + name + ".jpg") for name, size in [("a", 1000), ("b", 3000), \
+            ("c", 2000)]] + [self.server.url("status/404/d.jpg")]
+        pool = HTTPConnectionPool()
+        scheduler = DownloadScheduler(urls, policy = "largest", probe = True, probe_workers = 1, connection_pool = pool)
+
+        assert list(scheduler) == [urls[1], urls[2], urls[0], urls[3]]
+        assert (scheduler.probed, scheduler.probe_failures) == (4, 1)
+        assert pool.connections_opened == 1, str(pool)
+        assert not any(path.startswith("/large") for path in self.server.counts)
+
+    @unittest.skipIf(sys.version_info < (3, 2), "Probing requires the concurrent.futures module.")
+    def test_probe_limits(self):
+        """Test that HEAD requests wait for the throttle and update the circuit breaker of the downloader."""
+        from batchjpegdownloader import CircuitBreaker, DownloadScheduler, Throttle
+
+        downloader = BatchDownloader(self.directory, throttle = Throttle(requests_per_second = 10), \
+            circuit_breaker = CircuitBreaker(threshold = 1))
+        urls = [self.server.url("large/" + str(size) + "/image.jpg") for size in (1000, 2000, 3000)] + \
+            ["http://127.0.0.1:1/refused.jpg", "http://127.0.0.1:1/skipped.jpg", "http://127.0.0.1:abc/port.jpg"]
+        scheduler = DownloadScheduler(urls, policy = "largest", probe = True, probe_workers = 1, downloader = downloader)
+
+        start = time.time()
+        scheduled = list(scheduler)
+
+        # Five requests at 10 per second with a burst of one take at least 0.4 seconds. The open circuit skips one request.
+        assert scheduled[:3] == urls[2::-1] and scheduler.probe_failures == 3, repr(scheduled)
+        assert time.time() - start >= 0.35
+        assert not downloader.circuit_breaker.allow(urls[3])
+
+    def test_streaming_order(self):
+        """Test that the command line tool does not read ahead in list order and uses the scheduler otherwise."""
+        from batchjpegdownloader import ArgumentParser, DownloadScheduler, create_shard
+
+        filename = self.write_list([self.server.url("a.jpg")])
+        arguments = sys.argv
+
+        for schedule, scheduled in (("order", False), ("largest", True)):
+            try:
+                sys.argv = ["batchjpegdownloader.py", "-o", self.directory, "--schedule", schedule, filename]
+                config = ArgumentParser()
+            finally:
+                sys.argv = arguments
+
+            assert isinstance(create_shard(config)[1], DownloadScheduler) == scheduled
+
+    def test_unused_priorities(self):
+        """Test that the command line tool warns once that priority annotations are ignored in list order."""
+        from batchjpegdownloader import ArgumentParser, create_shard
+
+        filename = self.write_list([self.server.url("a.jpg") + " size=1", self.server.url("b.jpg") + " priority=1", \
+            self.server.url("c.jpg") + " priority=2"])
+        arguments = sys.argv
+        stdout = sys.stdout
+
+        try:
+            sys.argv = ["batchjpegdownloader.py", "-o", self.directory, filename]
+            config = ArgumentParser()
+
+            # Capture the standard output. For compatibility, try both the Python 2 and the Python 3 module name.
+            try:
+                from StringIO import StringIO
+            except ImportError:
+                from io import StringIO
+
+            sys.stdout = StringIO()
+
+            urls = list(create_shard(config)[1])
+
+            lines = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.argv = arguments
+            sys.stdout = stdout
+
+        assert urls == [self.server.url(name) for name in ("a.jpg", "b.jpg", "c.jpg")], repr(urls)
+        assert len([line for line in lines if "Priority annotations are ignored" in line]) == 1, repr(lines)
+
+    def test_download(self):
+        """Test that the downloader accepts the scheduled URLs and starts them in the order of the schedule."""
+        from batchjpegdownloader import DownloadScheduler
+
+        filename = self.write_list([self.server.url("small.jpg") + " size=1", self.server.url("urgent.jpg") + " priority=1", \
+            self.server.url("large.jpg") + " size=100"])
+        downloader = BatchDownloader(self.directory)
+        results = []
+        downloader.add_hook(results.append)
+        downloader.download(DownloadScheduler(ListFileURLGenerator(filename, "*.jpg"), policy = "largest"))
+
+        assert [os.path.basename(result.filename) for result in results] == ["urgent.jpg", "large.jpg", "small.jpg"]
+
+class TestStartup(LocalServerTestCase):
+    """
+    Test class for the start of the program: the modules that are loaded and the time until the first request.
+
+    Attributes:
+        server (object): A local image server.
+        directory (str): A temporary directory for the list file and the downloads.
+    """
+
+    # Upper bound in seconds for the time from starting the program to its first request. 
+    # It is far above the typical time, so that the test only fails if the start becomes much slower.
+    max_first_request_time = 2.0
+
+    def loaded_modules(self, code):
+        """Run `code` in a new interpreter and return the modules that it has loaded in addition to the interpreter itself."""
+        script = "import sys\nbefore = set(sys.modules)\n" + code + "\nprint(' '.join(sorted(set(sys.modules) - before)))\n"
+        output = subprocess.check_output([sys.executable, "-c", script], cwd = os.path.dirname(os.path.abspath(__file__)))
+
+        return output.decode("utf-8").split()
+
+    def test_import(self):
+        """Test that importing the module does not load any other module, in particular not argparse."""
+        assert self.loaded_modules("import batchjpegdownloader") == ["batchjpegdownloader"]
+
+    def test_no_url_check(self):
+        """Test that lists are read without any check and without the regular expression modules for simple patterns."""
+        filename = os.path.join(self.directory, "list.txt")
+
+        with open(filename, "w") as list_file:
+            list_file.write("http://example.com/a.jpg\nnot-a-url.jpg\nhttp://example.com/b.png\n")
+
+        assert list(ListFileURLGenerator(filename, "*.jpg", check_urls = False)) == ["http://example.com/a.jpg", "not-a-url.jpg"]
+
+        modules = self.loaded_modules("import batchjpegdownloader\n" + \
+            "list(batchjpegdownloader.ListFileURLGenerator(" + repr(filename) + ", '*.jpg', check_urls = False))")
+
+        assert "fnmatch" not in modules and "validators" not in modules, repr(modules)
+
+    def test_first_request(self):
+        """Test the time from starting the program to its first request and the time that the program reports."""
+        filename = os.path.join(self.directory, "list.txt")
+
+        with open(filename, "w") as list_file:
+            list_file.write(self.server.url("a.jpg") + "\n")
+
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "batchjpegdownloader.py"), \
+            "-o", os.path.join(self.directory, "output"), "-c", "True", "--no-url-check", filename]
+
+        start = time.time()
+        output = subprocess.check_output(command).decode("utf-8")
+
+        assert "First request after " in output, output
+        assert self.server.times[0] - start < self.max_first_request_time, repr(self.server.times[0] - start)
+
+    def python2(self):
+        """Return the command of a working Python 2 interpreter, or None if there is none."""
+        if sys.version_info[0] == 2:
+            return sys.executable
+
+        for command in ("python2.7", "python2"):
+            try:
+                subprocess.check_output([command, "-c", "pass"], stderr = subprocess.STDOUT)
+                return command
+            except (OSError, subprocess.CalledProcessError):
+                pass
+
+        return None
+
+    def test_python2(self):
+        """Test that the program downloads a list file with a Python 2 interpreter."""
+        python2 = self.python2()
+
+        if python2 is None:
+            self.skipTest("No Python 2 interpreter is installed.")
+
+        filename = os.path.join(self.directory, "list.txt")
+
+        with open(filename, "w") as list_file:
+            list_file.write(self.server.url("a.jpg") + "\n" + self.server.url("b.jpg") + "\n")
+
+        command = [python2, os.path.join(os.path.dirname(os.path.abspath(__file__)), "batchjpegdownloader.py"), \
+            "-o", os.path.join(self.directory, "output"), "-c", "True", "--no-url-check", "-j", "2", filename]
+
+        output = subprocess.check_output(command).decode("utf-8")
+
+        assert "Downloaded 2 files" in output, output
+        assert sorted(os.listdir(os.path.join(self.directory, "output"))) == ["a.jpg", "b.jpg"]
+
+class TestManifest(LocalServerTestCase):
+    """
+    Test class for the manifest of downloaded files and its diff mode.
+
+    Attributes:
+        server (object): A local image server.
+        directory (str): A temporary download directory.
+        manifest_directory (str): A temporary directory for the manifests.
+    """
+
+    def setUp(self):
+        """Start a local server and create temporary directories."""
+        LocalServerTestCase.setUp(self)
+        self.manifest_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Stop the server and remove the temporary directories."""
+        LocalServerTestCase.tearDown(self)
+        shutil.rmtree(self.manifest_directory)
+
+    def download(self, manifest, paths, **options):
+        """Download the files with the given paths of the server with a manifest and return the statistics."""
+        downloader = BatchDownloader(self.directory, manifest = manifest, **options)
+        statistics = downloader.download([self.server.url(path) for path in paths])
+        manifest.close()
+
+        return statistics
+
+    def test_jsonl(self):
+        """Test the records of downloaded and skipped files in a JSON-lines manifest."""
+        import hashlib
+        from batchjpegdownloader import DownloadManifest
+
+        filename = os.path.join(self.manifest_directory, "manifest.jsonl")
+        self.download(DownloadManifest(filename, self.directory), ["a.jpg", "b.jpg"], layout = "sharded")
+        self.download(DownloadManifest(filename, self.directory), ["a.jpg"], layout = "sharded")
+
+        records = list(DownloadManifest.read(filename))
+
+        assert [record["status"] for record in records] == ["downloaded", "downloaded", "skipped"]
+        assert records[0]["sha256"] == hashlib.sha256(JPEG_DATA).hexdigest() and records[0]["size"] == len(JPEG_DATA)
+        assert records[0]["url"] == self.server.url("a.jpg") and records[0]["path"].endswith("/a.jpg")
+        assert records[0]["path"].count("/") == 2 and records[0]["change"] is None, repr(records[0])
+        assert records[0]["timestamp"] <= records[1]["timestamp"] <= time.time()
+
+    def test_csv(self):
+        """Test that a CSV manifest has a single header line and the same records as a JSON-lines manifest."""
+        from batchjpegdownloader import DownloadManifest
+
+        filename = os.path.join(self.manifest_directory, "manifest.csv")
+        self.download(DownloadManifest(filename, self.directory), ["a.jpg"])
+        self.download(DownloadManifest(filename, self.directory), ["status/404/b.jpg"], keep_going = True)
+
+        with open(filename) as manifest_file:
+            assert manifest_file.readline().strip() == "url,path,size,sha256,timestamp,status,change"
+            assert len(manifest_file.readlines()) == 2
+
+        records = list(DownloadManifest.read(filename))
+
+        assert (records[0]["path"], records[0]["size"], records[0]["status"]) == ("a.jpg", len(JPEG_DATA), "downloaded")
+        assert (records[1]["path"], records[1]["size"], records[1]["sha256"], records[1]["status"]) == \
+            ("b.jpg", None, None, "failed")
+
+    def test_diff(self):
+        """Test that the diff mode records only files that have been added or changed since the previous manifest."""
+        from batchjpegdownloader import DownloadManifest
+
+        filename = os.path.join(self.manifest_directory, "manifest.jsonl")
+        self.download(DownloadManifest(filename, self.directory, previous_filename = filename, diff = True), \
+            ["photo/a.jpg", "b.jpg"])
+        shutil.copy(filename, filename + ".previous")
+
+        self.server.photo = JPEG_DATA + b"changed"
+        manifest = DownloadManifest(filename, self.directory, previous_filename = filename, diff = True)
+        statistics = self.download(manifest, ["photo/a.jpg", "b.jpg", "c.jpg"], default_overwrite = True)
+
+        assert statistics.downloaded == 3, str(statistics)
+        assert (manifest.added, manifest.changed) == (1, 1), str(manifest)
+        assert [(record["path"], record["change"]) for record in DownloadManifest.read(filename)] == \
+            [("a.jpg", "added"), ("b.jpg", "added"), ("a.jpg", "changed"), ("c.jpg", "added")]
+        assert sorted((record["path"], record["change"]) for record in \
+            DownloadManifest.changes(filename + ".previous", filename)) == [("a.jpg", "changed"), ("c.jpg", "added")]
+
+    def test_flush(self):
+        """Test that records are written to the manifest file while the download is still running."""
+        from batchjpegdownloader import DownloadManifest
+
+        filename = os.path.join(self.manifest_directory, "manifest.jsonl")
+        manifest = DownloadManifest(filename, self.directory, flush_interval = 0.0)
+        downloader = BatchDownloader(self.directory, manifest = manifest)
+        written = []
+        downloader.add_hook(lambda result: written.append(len(list(DownloadManifest.read(filename)))))
+        downloader.download([self.server.url("a.jpg"), self.server.url("b.jpg")])
+        manifest.close()
+
+        assert written == [1, 2], repr(written)
+
+class TestAdmission(LocalServerTestCase):
+    """
+    Test class for the admission control by free space and open files.
+
+    The free space of the volume is simulated by replacing the free_space() method of the admission control.
+
+    Attributes:
+        server (object): A local image server.
+        directory (str): A temporary download directory.
+        free (list): The simulated free space in bytes as the only element.
+    """
+
+    def setUp(self):
+        """Start a local server, create a temporary directory and simulate 1 GB of free space."""
+        LocalServerTestCase.setUp(self)
+        self.free = [10 ** 9]
+
+    def admission(self, **options):
+        """Return an admission control for the download directory that sees the simulated free space."""
+        from batchjpegdownloader import AdmissionControl
+
+        admission = AdmissionControl(self.directory, check_interval = 0.01, **options)
+        admission.free_space = lambda directory: self.free[0]
+
+        return admission
+
+    def test_free_space(self):
+        """Test that the free space of a real directory is a positive number of bytes."""
+        from batchjpegdownloader import AdmissionControl
+
+        assert AdmissionControl.free_space(self.directory) > 0
+
+    def test_reserve(self):
+        """Test that a file that does not fit into the free space fails before its file is created."""
+        admission = self.admission(low_water = 1000)
+        downloader = BatchDownloader(self.directory, keep_going = True, resume = True, admission = admission)
+        errors = []
+        downloader.add_hook(lambda result: errors.append(result.error))
+        self.free[0] = 100000
+        statistics = downloader.download([self.server.url("large/200000/image.jpg"), self.server.url("small.jpg")])
+
+        assert statistics.failed == 1 and statistics.downloaded == 1, str(statistics)
+        assert "Not enough free space" in errors[0], repr(errors)
+        assert not os.path.exists(os.path.join(self.directory, "image.jpg.part"))
+        assert admission.open_files == 0 and admission.reserved == 0
+
+    def test_pause(self):
+        """Test that new transfers are paused below the low-water mark and resumed above the high-water mark."""
+        import threading
+
+        admission = self.admission(low_water = 10000, high_water = 20000)
+        downloader = BatchDownloader(self.directory, workers = 2, admission = admission)
+        self.free[0] = 5000
+
+        # Space between the marks does not resume the transfers, only space above the high-water mark does,
+        # which becomes available after a while, for example because files have been moved away.
+        threading.Timer(0.1, lambda: self.free.__setitem__(0, 15000)).start()
+        timer = threading.Timer(0.2, lambda: self.free.__setitem__(0, 30000))
+        timer.start()
+
+        try:
+            statistics = downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(4)])
+        finally:
+            timer.cancel()
+
+        histogram = downloader.metrics.histograms["admission"]
+
+        assert statistics.downloaded == 4, str(statistics)
+        assert admission.pauses == 1 and not admission.paused
+        assert histogram.count == 4 and histogram.maximum >= 0.15, repr(histogram.as_dict())
+        assert admission.waited >= 0.1 and "Paused 1 times" in downloader.summary(statistics)
+
+    def test_max_wait(self):
+        """Test that a transfer fails after it has waited for free space for longer than the maximum wait."""
+        from batchjpegdownloader import DiskSpaceError
+
+        admission = self.admission(low_water = 10000, max_wait = 0.1)
+        downloader = BatchDownloader(self.directory, admission = admission)
+        self.free[0] = 5000
+
+        with self.assertRaises(DiskSpaceError):
+            downloader.download([self.server.url("image.jpg")])
+
+        assert admission.open_files == 0 and admission.waited >= 0.1
+
+    def test_open_files(self):
+        """Test that no more transfers than the limit of open files run at the same time."""
+        self.server.latency = 0.02
+        admission = self.admission(max_open_files = 2)
+        downloader = BatchDownloader(self.directory, workers = 8, admission = admission)
+        statistics = downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(8)])
+
+        assert statistics.downloaded == 8, str(statistics)
+        assert self.server.max_active == 2, repr(self.server.max_active)
+        assert admission.open_files == 0 and admission.reserved == 0
+
+    def test_slot_wait(self):
+        """Test that workers that wait for an open file slot are woken up by the release of a slot instead of polling."""
+        from batchjpegdownloader import AdmissionControl
+
+        admission = AdmissionControl(self.directory, max_open_files = 1)
+        acquire = admission.acquire
+        calls = []
+
+        def counting_acquire(url, since = None):
+            calls.append(url)
+
+            return acquire(url, since)
+
+        admission.acquire = counting_acquire
+
+        # Three workers wait for 0.1 seconds per file, which is ten times the interval of polling engines.
+        self.server.latency = 0.1
+        downloader = BatchDownloader(self.directory, workers = 4, admission = admission)
+        statistics = downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(4)])
+
+        assert statistics.downloaded == 4 and self.server.max_active == 1, str(statistics)
+        assert len(calls) <= 12, repr(len(calls))
+
+    def test_reservations(self):
+        """Test that concurrent transfers reserve their Content-Length, so that they cannot fill the volume together."""
+        admission = self.admission()
+        downloader = BatchDownloader(self.directory, workers = 4, keep_going = True, admission = admission)
+
+        # Only two of the four files fit, which is only known because the other files have reserved their space.
+        self.server.latency = 0.05
+        self.free[0] = 250000
+        statistics = downloader.download([self.server.url("large/100000/image" + str(i) + ".jpg") for i in range(4)])
+
+        assert statistics.downloaded == 2 and statistics.failed == 2, str(statistics)
+
+@unittest.skipIf(sys.version_info < (3, 6), "The asyncio engine requires Python 3.6 or higher.")
+class TestAsyncBatchDownloader(LocalServerTestCase):
+    """
+    Test class for the AsyncBatchDownloader class.
+
+    All files are served by a local server with an artificial latency.
+
+    Attributes:
+        server (object): A local image server that answers each request after 0.1 seconds.
+        directory (str): A temporary download directory.
+    """
+
+    server_options = {"latency": 0.1}
+
+    def test_valid(self):
+        """Test that all files are downloaded concurrently with the same filenames as the thread engine."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        urls = [self.server.url("image" + str(i) + ".jpg") for i in range(16)]
+        downloader = AsyncBatchDownloader(self.directory, workers = 16)
+
+        start = time.time()
+        statistics = downloader.download(urls)
+        elapsed = time.time() - start
+
+        assert statistics.downloaded == 16, str(statistics)
+        assert elapsed < 0.8, repr(elapsed)
+
+        for url in urls:
+            with open(downloader.local_filename(url), "rb") as image_file:
+                assert image_file.read() == JPEG_DATA
+
+    def test_timing(self):
+        """Test that the asyncio engine reports the timing of every file to the hooks."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        downloader = AsyncBatchDownloader(self.directory, workers = 4)
+        results = []
+        downloader.add_hook(results.append)
+        downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(4)])
+
+        assert len(results) == 4 and downloader.metrics.bytes == 4 * len(JPEG_DATA), repr(downloader.metrics.as_dict())
+
+        for result in results:
+            assert result.dns_time is not None and result.connect_time is not None, repr(result.as_dict())
+            assert result.first_byte_time >= 0.1 and result.size == len(JPEG_DATA), repr(result.as_dict())
+
+    def test_retry(self):
+        """Test that the asyncio engine retries temporary server errors and continues after failures."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        downloader = AsyncBatchDownloader(self.directory, retry_policy = RetryPolicy(attempts = 3, backoff = 0.01), \
+            keep_going = True)
+        statistics = downloader.download([self.server.url("flaky/2/a.jpg"), self.server.url("missing.png")])
+
+        assert (statistics.downloaded, statistics.failed) == (1, 1), str(statistics)
+        assert self.server.counts == {"/flaky/2/a.jpg": 3, "/missing.png": 1}, repr(self.server.counts)
+
+    def test_throttle(self):
+        """Test that the asyncio engine keeps the request rate limit."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        downloader = AsyncBatchDownloader(self.directory, workers = 16, throttle = Throttle(requests_per_second = 20))
+        downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(11)])
+
+        rate = 9 / (self.server.times[-1] - self.server.times[1])
+
+        assert 17 < rate < 21, repr(rate)
+
+    def test_validate(self):
+        """Test that the asyncio engine moves invalid files to the quarantine directory."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        downloader = AsyncBatchDownloader(self.directory, validate = "quarantine", keep_going = True)
+        statistics = downloader.download([self.server.url("html/a.jpg"), self.server.url("b.jpg")])
+
+        assert (statistics.downloaded, statistics.failed) == (1, 1), str(statistics)
+        assert os.listdir(downloader.quarantine_directory) == [quarantine_name(self.server.url("html/a.jpg"))]
+
+    def test_sharded(self):
+        """Test that the asyncio engine creates the directories of the sharded layout."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        downloader = AsyncBatchDownloader(self.directory, layout = "sharded")
+        statistics = downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(4)])
+
+        assert statistics.downloaded == 4, str(statistics)
+        assert len(downloader.scan_download_directory()) == 4
+
+    def test_results(self):
+        """Test that the asyncio engine yields the results of a download that runs in a background thread."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        downloader = AsyncBatchDownloader(self.directory, workers = 8)
+        urls = [self.server.url("image" + str(i) + ".jpg") for i in range(8)]
+        results = downloader.results(urls)
+
+        assert sorted(result.url for result in results) == sorted(urls)
+        assert results.summary.statistics.downloaded == 8, str(results.summary)
+
+    def test_manifest(self):
+        """Test that the asyncio engine records the digests of the streamed files in the manifest."""
+        import hashlib
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+        from batchjpegdownloader import DownloadManifest
+
+        filename = os.path.join(self.directory, "manifest.csv")
+        manifest = DownloadManifest(filename, self.directory)
+        downloader = AsyncBatchDownloader(self.directory, manifest = manifest)
+        downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(4)])
+        manifest.close()
+
+        records = list(DownloadManifest.read(filename))
+
+        assert len(records) == 4 and all(record["sha256"] == hashlib.sha256(JPEG_DATA).hexdigest() for record in records)
+
+    def test_admission(self):
+        """Test that the asyncio engine waits for open file slots without blocking the event loop."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+        from batchjpegdownloader import AdmissionControl
+
+        self.server.latency = 0.02
+        admission = AdmissionControl(self.directory, max_open_files = 2)
+        downloader = AsyncBatchDownloader(self.directory, workers = 8, admission = admission)
+        statistics = downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(8)])
+
+        assert statistics.downloaded == 8, str(statistics)
+        assert self.server.max_active == 2, repr(self.server.max_active)
+        assert downloader.metrics.histograms["admission"].count == 8 and admission.open_files == 0
+
+    def test_timeout(self):
+        """Test that a server that does not answer fails the download after the timeout instead of stalling it."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        self.server.latency = 1.0
+        downloader = AsyncBatchDownloader(self.directory, timeout = 0.2, keep_going = True)
+
+        start = time.time()
+        statistics = downloader.download([self.server.url("image.jpg")])
+
+        assert statistics.failed == 1 and time.time() - start < 0.9, str(statistics)
+
+    def test_malformed_response(self):
+        """Test that malformed status lines, Content-Lengths and chunk sizes fail as IO Errors and malformed URLs are skipped."""
+        import socket
+        import threading
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        responses = [b"HTTP/1.1 abc OK\r\n\r\n", b"HTTP/1.1 200 OK\r\nContent-Length: many\r\n\r\n", \
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nxyz\r\n"]
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(len(responses))
+
+        def serve():
+            for response in responses:
+                connection = listener.accept()[0]
+                connection.recv(65536)
+                connection.sendall(response)
+                connection.close()
+
+        thread = threading.Thread(target = serve)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            url = "http://127.0.0.1:" + str(listener.getsockname()[1]) + "/image"
+            downloader = AsyncBatchDownloader(self.directory, workers = 1, keep_going = True)
+            statistics = downloader.download([url + str(i) + ".jpg" for i in range(len(responses))] + \
+                ["http://127.0.0.1:abc/port.jpg"])
+        finally:
+            listener.close()
+
+        assert statistics.failed == 4, str(statistics)
+
+    def test_keep_alive(self):
+        """Test that the asyncio engine reuses a connection for later requests and replaces a connection the server has closed."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        self.server.latency = 0.0
+        downloader = AsyncBatchDownloader(self.directory, workers = 1)
+        urls = [self.server.url("image" + str(i) + ".jpg") for i in range(4)]
+
+        statistics = downloader.download(urls)
+
+        assert statistics.downloaded == 4, str(statistics)
+        assert "Connections: 1 opened, 3 reused." in downloader.summary(statistics), downloader.summary(statistics)
+
+        # A server that closes the first connection when the second request arrives, as after an idle timeout, 
+        # makes the downloader send the request again over a new connection.
+        import socket
+        import threading
+
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(2)
+
+        def serve():
+            for requests in (2, 1):
+                connection = listener.accept()[0]
+                connection.recv(65536)
+                connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: " + str(len(JPEG_DATA)).encode("ascii") + \
+                    b"\r\n\r\n" + JPEG_DATA)
+
+                if requests == 2:
+                    connection.recv(65536)
+
+                connection.close()
+
+        thread = threading.Thread(target = serve)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            url = "http://127.0.0.1:" + str(listener.getsockname()[1]) + "/"
+            downloader = AsyncBatchDownloader(self.directory, workers = 1)
+            statistics = downloader.download([url + "closed0.jpg", url + "closed1.jpg"])
+        finally:
+            listener.close()
+
+        assert statistics.downloaded == 2, str(statistics)
+        assert (downloader.connection_pool.connections_opened, downloader.connection_pool.connections_reused) == (2, 1), \
+            str(downloader.connection_pool)
+
+    def test_address_fallback(self):
+        """Test that the asyncio engine tries the next address of a host if a connection to the first one is refused."""
+        import socket
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        getaddrinfo = socket.getaddrinfo
+
+        # The server only listens on 127.0.0.1, so connections to 127.0.0.2 are refused.
+        def addresses(host, port, *arguments, **options):
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port)) for address in ("127.0.0.2", "127.0.0.1")]
+
+        socket.getaddrinfo = addresses
+
+        try:
+            statistics = AsyncBatchDownloader(self.directory).download([self.server.url("image.jpg")])
+        finally:
+            socket.getaddrinfo = getaddrinfo
+
+        assert statistics.downloaded == 1, str(statistics)
+
+    def test_unsupported_scheme(self):
+        """Test that URLs other than HTTP(S) fail with a message that points to the thread engine."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        downloader = AsyncBatchDownloader(self.directory)
+        results = []
+        downloader.add_hook(results.append)
+
+        with self.assertRaises(IOError):
+            downloader.download(["ftp://127.0.0.1/image.jpg"])
+
+        assert "thread engine" in results[0].error, repr(results[0].as_dict())
+
+    def test_blocking_hook(self):
+        """Test that slow hooks and file operations run outside the event loop, so that other downloads continue."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        downloader = AsyncBatchDownloader(self.directory, workers = 4)
+        downloader.add_hook(lambda result: time.sleep(0.3))
+
+        start = time.time()
+        statistics = downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(4)])
+        elapsed = time.time() - start
+
+        assert statistics.downloaded == 4 and elapsed < 0.8, repr(elapsed)
+
+    def test_filename_locks(self):
+        """Test that the asyncio engine drops the lock of a filename after its last download."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        downloader = AsyncBatchDownloader(self.directory, workers = 4)
+        statistics = downloader.download([self.server.url("image" + str(i % 3) + ".jpg") for i in range(9)])
+
+        assert (statistics.downloaded, statistics.skipped) == (3, 6) and downloader.filename_locks == {}, str(statistics)
+
+    def test_host_limit(self):
+        """Test that no more than `host_limit` requests are sent to the same host at once."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        downloader = AsyncBatchDownloader(self.directory, workers = 16, host_limit = 2)
+        statistics = downloader.download([self.server.url("image" + str(i) + ".jpg") for i in range(8)])
+
+        assert statistics.downloaded == 8, str(statistics)
+        assert self.server.max_active == 2, repr(self.server.max_active)
+
+    def test_resume_partial(self):
+        """Test that the asyncio engine resumes a partial file from the thread engine with a Range request."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        url = self.server.url("large/300000/image.jpg")
+
+        self.server.fail_after = 100000
+
+        try:
+            BatchDownloader(self.directory, resume = True).download([url])
+        except IOError:
+            pass
+
+        self.server.fail_after = None
+        AsyncBatchDownloader(self.directory, resume = True).download([url])
+
+        assert self.server.ranges == [None, "bytes=100000-"], repr(self.server.ranges)
+
+        with open(os.path.join(self.directory, "image.jpg"), "rb") as image_file:
+            assert image_file.read() == large_data(0, 300000)
+
+    def test_refresh(self):
+        """Test that the asyncio engine answers unchanged files in refresh mode as not modified."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        urls = [self.server.url("image" + str(i) + ".jpg") for i in range(3)]
+
+        statistics = AsyncBatchDownloader(self.directory, refresh = True).download(urls)
+        assert statistics.downloaded == 3, str(statistics)
+
+        statistics = AsyncBatchDownloader(self.directory, refresh = True).download(urls)
+        assert statistics.not_modified == 3, str(statistics)
+
+    def test_list_file(self):
+        """Test downloading from the asynchronous list file generator and skipping existing files."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader, AsyncListFileURLGenerator
+
+        list_filename = os.path.join(self.directory, "images.list")
+
+        with open(list_filename, "w") as list_file:
+            list_file.write(self.server.url("a.jpg") + "\n" + self.server.url("b.jpg") + "\n" + self.server.url("c.png") + "\n")
+
+        downloader = AsyncBatchDownloader(self.directory, workers = 4)
+
+        statistics = downloader.download(AsyncListFileURLGenerator(list_filename, "*.jpg"))
+        assert (statistics.downloaded, statistics.skipped) == (2, 0), str(statistics)
+
+        statistics = downloader.download(AsyncListFileURLGenerator(list_filename, "*.jpg"))
+        assert (statistics.downloaded, statistics.skipped) == (0, 2), str(statistics)
+
+    def test_incorrect_link(self):
+        """Test a link to a missing file. The code should throw an exception."""
+        from asyncbatchjpegdownloader import AsyncBatchDownloader
+
+        downloader = AsyncBatchDownloader(self.directory, workers = 4)
+
+        try:
+            downloader.download([self.server.url("image.jpg"), self.server.url("missing.png")])
+
+            # We should not be able to reach this code line
+            assert False
+        except IOError:
+            # This example should fail with an IO Error
+            assert True
+
 # If this is the main document, call the unit test main function to automatically run all unit tests
 if __name__ == "__main__":
     unittest.main()